@@ -0,0 +1,142 @@
+"""Compares handing decoded row groups to another process by pickling Python
+column lists with handing them over as Arrow batches in shared memory
+(spectrify.utils.ipc).
+
+Both transports send the same, distinct row groups through a multiprocessing
+queue to a consumer process.  The consumer sums every column (the lengths of
+strings, timestamps in seconds), so both transports pay for reading every
+value: with pyarrow.compute over the mapped batches, in Python over the
+unpickled lists.  The sums are checked to agree:
+
+    python benchmarks/ipc.py --rows 250000 --groups 8
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+import math
+import multiprocessing
+import time
+from datetime import datetime, timedelta
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import sqlalchemy as sa
+
+from spectrify.utils.ipc import put_batch, take_batch
+from spectrify.utils.parquet import Writer
+
+TABLE = sa.Table(
+    'benchmark_table',
+    sa.MetaData(),
+    sa.Column('id', sa.BIGINT),
+    sa.Column('amount', sa.FLOAT),
+    sa.Column('status', sa.VARCHAR),
+    sa.Column('description', sa.VARCHAR),
+    sa.Column('created_at', sa.TIMESTAMP),
+)
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def make_columns(num_rows, offset=0):
+    """Returns a row group of num_rows rows, starting with row number offset"""
+    start = datetime(2020, 1, 1)
+    rows = range(offset, offset + num_rows)
+    return [
+        list(rows),
+        [i * 0.25 for i in rows],
+        [('active', 'inactive', 'pending')[i % 3] for i in rows],
+        ['description of row number {}'.format(i) for i in rows],
+        [start + timedelta(seconds=i) for i in rows],
+    ]
+
+
+def sum_lists(columns):
+    ids, amounts, statuses, descriptions, timestamps = columns
+    return [
+        sum(ids),
+        sum(amounts),
+        sum(len(value) for value in statuses),
+        sum(len(value) for value in descriptions),
+        # In seconds, so that the sum fits in an int64
+        sum((value - EPOCH) // timedelta(seconds=1) for value in timestamps),
+    ]
+
+
+def sum_batch(batch):
+    ids, amounts, statuses, descriptions, timestamps = batch.columns
+    return [
+        pc.sum(ids).as_py(),
+        pc.sum(amounts).as_py(),
+        pc.sum(pc.utf8_length(statuses)).as_py(),
+        pc.sum(pc.utf8_length(descriptions)).as_py(),
+        pc.sum(pc.divide(timestamps.cast(pa.int64()), 10**9)).as_py(),
+    ]
+
+
+def consume(transport, queue, results):
+    results.put('ready')
+    totals = [0] * len(TABLE.columns)
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        if transport == 'pickle':
+            # The queue already unpickled the lists
+            sums = sum_lists(item)
+        else:
+            sums = sum_batch(take_batch(item))
+        totals = [total + value for total, value in zip(totals, sums)]
+    results.put(totals)
+
+
+def run(transport, groups):
+    """Returns the seconds taken to hand all groups to the consumer, and the
+    consumer's column sums
+    """
+    ctx = multiprocessing.get_context('spawn')
+    queue = ctx.Queue(2)
+    results = ctx.Queue()
+    consumer = ctx.Process(target=consume, args=(transport, queue, results))
+    consumer.start()
+    # Don't count the consumer's startup
+    results.get()
+
+    start = time.time()
+    for group in groups:
+        queue.put(group if transport == 'pickle' else put_batch(group))
+    queue.put(None)
+    totals = results.get()
+    elapsed = time.time() - start
+    consumer.join()
+    return elapsed, totals
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=250000, help='Rows per row group')
+    parser.add_argument('--groups', type=int, default=8, help='Number of row groups')
+    args = parser.parse_args()
+
+    groups = [make_columns(args.rows, i * args.rows) for i in range(args.groups)]
+    # Building the batches is work the producer does either way (the Writer
+    # needs Arrow arrays), so it isn't counted against the shared memory transport
+    build_start = time.time()
+    writer = Writer(None, TABLE)
+    batches = [writer.to_record_batch(columns) for columns in groups]
+    build_seconds = time.time() - build_start
+
+    pickle_seconds, pickle_totals = run('pickle', groups)
+    ipc_seconds, ipc_totals = run('ipc', batches)
+    if not all(math.isclose(a, b, rel_tol=1e-9) for a, b in zip(pickle_totals, ipc_totals)):
+        raise AssertionError('Column sums differ: {} != {}'.format(pickle_totals, ipc_totals))
+
+    total_rows = args.rows * args.groups
+    print('{:<28} {:>8.3f}s'.format('build Arrow batches', build_seconds))
+    for name, seconds in [('pickle column lists', pickle_seconds), ('shared memory Arrow IPC', ipc_seconds)]:
+        print('{:<28} {:>8.3f}s {:>12,.0f} rows/s'.format(name, seconds, total_rows / seconds))
+    print('speedup: {:.1f}x'.format(pickle_seconds / ipc_seconds))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+"""Measures CLI startup time and the time to spawn a pool worker ready to convert.
+
+Exits with status 1 if either takes longer than its budget (in seconds), so
+this can be run in CI:
+
+    python benchmarks/startup.py --help-budget 0.5 --worker-budget 1.5
+"""
+from __future__ import absolute_import, division, print_function
+import argparse
+import subprocess
+import sys
+import timeit
+
+HELP_SCRIPT = "from spectrify.main import cli; cli(['--help'])"
+
+# A spawned (rather than forked) worker has to import everything itself, as
+# every pool worker does on platforms without fork.  Unpickling a conversion
+# task imports spectrify.convert (and SqlAlchemy, for the table), and
+# converting imports the Parquet writer and s3fs, so the worker imports those.
+WORKER_MODULES = ['spectrify.convert', 'sqlalchemy', 'spectrify.utils.parquet', 's3fs']
+
+WORKER_SCRIPT = """
+import multiprocessing
+import spectrify.main
+if __name__ == '__main__':
+    pool = multiprocessing.get_context('spawn').Pool(1)
+    pool.apply(exec, ('import {}', {{}}))
+    pool.close()
+    pool.join()
+""".format(', '.join(WORKER_MODULES))
+
+
+def best_time(script, repeat):
+    def run():
+        subprocess.check_call([sys.executable, '-c', script], stdout=subprocess.DEVNULL)
+    return min(timeit.repeat(run, number=1, repeat=repeat))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--help-budget', type=float, default=0.5)
+    parser.add_argument('--worker-budget', type=float, default=1.5)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    ok = True
+    for name, script, budget in [
+        ('spectrify --help', HELP_SCRIPT, args.help_budget),
+        ('worker spawn', WORKER_SCRIPT, args.worker_budget),
+    ]:
+        elapsed = best_time(script, args.repeat)
+        within_budget = elapsed <= budget
+        ok = ok and within_budget
+        print('{:<20} {:.3f}s (budget {:.3f}s) {}'.format(name, elapsed, budget, 'OK' if within_budget else 'SLOW'))
+
+    sys.exit(0 if ok else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -22,7 +22,6 @@ requirements = [
     's3fs',
     'sqlalchemy',
     'sqlalchemy-redshift>=0.7.1',
-    'unicodecsv'
 ]
 
 setup_requirements = [
@@ -0,0 +1,234 @@
+"""Merges the small Parquet files of a spectrum directory into larger ones.
+
+Incremental loads, and conversions which write one file per UNLOAD slice,
+leave many small files with small row groups, which Spectrum scans slowly.
+Compaction rewrites runs of small files into files of about a target size
+with full row groups, one directory (i.e. one partition) at a time.
+
+Spectrum ignores files whose names start with an underscore, so merged files
+are written under hidden names and only made visible once complete.  A
+journal records which files a merged file replaces, so that an interrupted
+compaction is finished (or undone) by the next run instead of leaving
+duplicate rows behind.  Queries running while the replaced files are being
+deleted may still see both the merged file and some of the files it replaces.
+
+The lineage file of a directory maps each merged file to the original files
+(and their row counts) it holds, so that `spectrify verify` can still match
+merged files to the manifest entries they were converted from.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import json
+import uuid
+from collections import namedtuple
+from os import environ, path
+
+import click
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from spectrify.utils.parquet import SPECTRIFY_COMPRESSION, find_partition_dirs, is_data_file, read_footer
+
+# Files are merged up to about this size.  Files of at least half this size
+# are left alone.
+SPECTRIFY_COMPACT_TARGET_SIZE = int(environ.get('SPECTRIFY_COMPACT_TARGET_SIZE') or 256 * 2**20)  # 256MB
+
+# Rows per row group in merged files (see SPECTRIFY_ROWS_PER_GROUP)
+SPECTRIFY_COMPACT_ROWS_PER_GROUP = int(
+    environ.get('SPECTRIFY_COMPACT_ROWS_PER_GROUP') or environ.get('SPECTRIFY_ROWS_PER_GROUP') or 250000)
+
+JOURNAL_NAME = '_spectrify_compact.json'
+LINEAGE_NAME = '_spectrify_lineage.json'
+
+DataFile = namedtuple('DataFile', ['name', 'size', 'num_rows', 'schema'])
+
+
+def plain_schema(schema):
+    """Returns schema with dictionary types replaced by their value types.
+    Whether a column is dictionary encoded is decided per file, so files
+    differing only in that can still be merged.
+    """
+    return pa.schema([
+        pa.field(field.name, field.type.value_type if pa.types.is_dictionary(field.type) else field.type)
+        for field in schema
+    ])
+
+
+def read_lineage(s3_config, dir_path):
+    """Returns a dict of merged file name -> {original file name: num_rows}"""
+    lineage_path = path.join(dir_path, LINEAGE_NAME)
+    if not s3_config.fs_exists(lineage_path):
+        return {}
+    with s3_config.fs_open(lineage_path, 'rb') as lineage_file:
+        return json.loads(lineage_file.read().decode('utf-8'))
+
+
+class ParquetCompactor(object):
+    def __init__(self, s3_config, target_size=SPECTRIFY_COMPACT_TARGET_SIZE,
+                 rows_per_group=SPECTRIFY_COMPACT_ROWS_PER_GROUP, compression=SPECTRIFY_COMPRESSION):
+        self.s3_config = s3_config
+        self.target_size = target_size
+        self.rows_per_group = rows_per_group
+        self.compression = compression
+
+    def log(self, msg):
+        """By default, we log to console with click"""
+        click.echo(msg)
+
+    def compact(self, partitions=None):
+        """Compacts the spectrum directory and every partition below it, or
+        only the given partitions (paths relative to the spectrum directory).
+        Returns the number of files replaced.
+        """
+        spectrum_dir = self.s3_config.get_spectrum_dir()
+        if partitions:
+            dirs = [path.join(spectrum_dir, partition) for partition in partitions]
+        else:
+            dirs = find_partition_dirs(self.s3_config, spectrum_dir)
+        return sum(self.compact_dir(dir_path) for dir_path in dirs)
+
+    def compact_dir(self, dir_path):
+        """Merges the small files of one directory.  Returns the number of files replaced"""
+        self.recover(dir_path)
+        num_replaced = 0
+        for group in self.plan(dir_path):
+            self.merge(dir_path, group)
+            num_replaced += len(group)
+        return num_replaced
+
+    def plan(self, dir_path):
+        """Returns lists of small files to merge.  Each list adds up to at most
+        the target size, and its files have the same schema.
+        """
+        small_files = [
+            data_file for data_file in self.list_data_files(dir_path)
+            if data_file.size < self.target_size // 2
+        ]
+
+        groups = []
+        group = []
+        group_size = 0
+        for data_file in small_files:
+            if group and (group_size + data_file.size > self.target_size or
+                          not data_file.schema.equals(group[0].schema)):
+                groups.append(group)
+                group = []
+                group_size = 0
+            group.append(data_file)
+            group_size += data_file.size
+        groups.append(group)
+
+        # A single file gains nothing from being rewritten
+        return [group for group in groups if len(group) > 1]
+
+    def list_data_files(self, dir_path):
+        data_files = []
+        for name in sorted(self.s3_config.fs_listdir(dir_path)):
+            if not is_data_file(name):
+                continue
+            file_path = path.join(dir_path, name)
+            metadata = read_footer(self.s3_config, file_path)
+            schema = plain_schema(metadata.schema.to_arrow_schema())
+            data_files.append(DataFile(name, self.s3_config.fs_size(file_path), metadata.num_rows, schema))
+        return data_files
+
+    def merge(self, dir_path, group):
+        token = uuid.uuid4().hex[:12]
+        temp_path = path.join(dir_path, '_spectrify_compact_{}.parq'.format(token))
+        new_path = path.join(dir_path, 'compacted_{}.parq'.format(token))
+        replaced_paths = [path.join(dir_path, data_file.name) for data_file in group]
+        self.log('Merging %d files in [%s] into [%s]' % (len(group), dir_path, new_path))
+
+        # The original files of files merged before are carried over
+        lineage = read_lineage(self.s3_config, dir_path)
+        sources = {}
+        for data_file in group:
+            sources.update(lineage.get(data_file.name) or {data_file.name: data_file.num_rows})
+
+        expected_rows = sum(data_file.num_rows for data_file in group)
+        self.write_merged(temp_path, replaced_paths, group[0].schema)
+        num_rows = read_footer(self.s3_config, temp_path).num_rows
+        if num_rows != expected_rows:
+            self.s3_config.fs_remove(temp_path)
+            raise ValueError('Merged file has {} rows, expected {}'.format(num_rows, expected_rows))
+
+        # From here on, an interrupted merge is finished by recover()
+        journal = {
+            'temp_path': temp_path,
+            'new_path': new_path,
+            'replaced_paths': replaced_paths,
+            'sources': sources,
+        }
+        self.write_journal(dir_path, journal)
+        self.s3_config.fs_move(temp_path, new_path)
+        self.finish(dir_path, journal)
+
+    def write_merged(self, out_path, in_paths, schema):
+        # Timestamps read back as nanoseconds were stored as INT96
+        int96 = any(pa.types.is_timestamp(field.type) and field.type.unit == 'ns' for field in schema)
+        with self.s3_config.fs_open(out_path, 'wb') as out_file:
+            writer = pq.ParquetWriter(
+                out_file, schema, compression=self.compression, use_deprecated_int96_timestamps=int96)
+            try:
+                pending = []
+                pending_rows = 0
+                for in_path in in_paths:
+                    with self.s3_config.fs_open(in_path, 'rb') as in_file:
+                        table = pq.read_table(in_file).cast(schema)
+                    pending.append(table)
+                    pending_rows += table.num_rows
+
+                    # Write out full row groups, carrying the remainder over
+                    if pending_rows >= self.rows_per_group:
+                        merged = pa.concat_tables(pending)
+                        num_full = pending_rows - pending_rows % self.rows_per_group
+                        writer.write_table(merged.slice(0, num_full), row_group_size=self.rows_per_group)
+                        pending = [merged.slice(num_full)]
+                        pending_rows -= num_full
+
+                if pending_rows:
+                    writer.write_table(pa.concat_tables(pending), row_group_size=self.rows_per_group)
+            finally:
+                writer.close()
+
+    def get_journal_path(self, dir_path):
+        return path.join(dir_path, JOURNAL_NAME)
+
+    def write_journal(self, dir_path, journal):
+        with self.s3_config.fs_open(self.get_journal_path(dir_path), 'wb') as journal_file:
+            journal_file.write(json.dumps(journal).encode('utf-8'))
+
+    def recover(self, dir_path):
+        """Finishes (or undoes) a merge which was interrupted after being journaled"""
+        journal_path = self.get_journal_path(dir_path)
+        if not self.s3_config.fs_exists(journal_path):
+            return
+        with self.s3_config.fs_open(journal_path, 'rb') as journal_file:
+            journal = json.loads(journal_file.read().decode('utf-8'))
+
+        if self.s3_config.fs_exists(journal['new_path']):
+            self.log('Finishing interrupted merge into [%s]' % journal['new_path'])
+            if self.s3_config.fs_exists(journal['temp_path']):
+                self.s3_config.fs_remove(journal['temp_path'])
+            self.finish(dir_path, journal)
+        else:
+            self.log('Undoing interrupted merge into [%s]' % journal['new_path'])
+            if self.s3_config.fs_exists(journal['temp_path']):
+                self.s3_config.fs_remove(journal['temp_path'])
+            self.s3_config.fs_remove(journal_path)
+
+    def finish(self, dir_path, journal):
+        replaced_paths = journal['replaced_paths']
+        if 'sources' in journal:
+            self.update_lineage(dir_path, path.basename(journal['new_path']), journal['sources'], replaced_paths)
+        for replaced_path in replaced_paths:
+            if self.s3_config.fs_exists(replaced_path):
+                self.s3_config.fs_remove(replaced_path)
+        self.s3_config.fs_remove(self.get_journal_path(dir_path))
+
+    def update_lineage(self, dir_path, new_name, sources, replaced_paths):
+        lineage = read_lineage(self.s3_config, dir_path)
+        for replaced_path in replaced_paths:
+            lineage.pop(path.basename(replaced_path), None)
+        lineage[new_name] = sources
+        with self.s3_config.fs_open(path.join(dir_path, LINEAGE_NAME), 'wb') as lineage_file:
+            lineage_file.write(json.dumps(lineage, sort_keys=True).encode('utf-8'))
@@ -1,5 +1,5 @@
 from __future__ import absolute_import, division, print_function
-from future.standard_library import install_aliases
+from spectrify.utils.compat import install_aliases
 install_aliases()  # noqa
 from builtins import list
 
@@ -7,18 +7,28 @@ import sys
 import csv
 import gc
 import json
+import math
+import threading
+import time
 from datetime import datetime, date
 from decimal import Decimal, Context, setcontext
 from os import path, environ, getenv
 from multiprocessing import Pool, cpu_count
+from queue import Queue
 
 import click
-from spectrify.utils.timestamps import iso8601_to_nanos, iso8601_to_days_since_epoch
-from spectrify.utils.parquet import Writer
-from spectrify.utils.s3 import S3GZipCSVReader
+from spectrify.utils.timestamps import (
+    iso8601_to_days_since_epoch, iso8601_to_micros, iso8601_to_millis, iso8601_to_nanos
+)
+from spectrify.utils.memoize import MemoizedConverter
+from spectrify.utils.parquet import SPECTRIFY_TIMESTAMP_UNIT, DictionaryColumn, SpillingWriter, Writer, new_columns
+from spectrify.utils.s3 import (
+    PrefetchingS3Config, S3GZipCSVReader, S3RangeCSVReader, SPECTRIFY_PREFETCH_FILES, plan_byte_ranges
+)
 
 # Redshift allows up to 38 bits of decimal/numeric precision. Set the Python
-# decimal context accordingly
+# decimal context accordingly.  DECIMAL/NUMERIC columns with a known precision
+# and scale skip Decimal objects entirely (see spectrify.utils.decimals).
 redshift_context = Context(prec=38)
 setcontext(redshift_context)
 
@@ -30,16 +40,29 @@ setcontext(redshift_context)
 # are required in memory for processing.
 SPECTRIFY_ROWS_PER_GROUP = environ.get('SPECTRIFY_ROWS_PER_GROUP') or 250000
 
-# Python2 csv builtin library has limited support with unicode CSVs
-# (see: https://github.com/hellonarrativ/spectrify/issues/16).
-# Therefore, there is an option to replace the builtin csv module with `unicodecsv` module.
-# By default this option is disabled - `unicodecsv` can have a pretty serious performance
-# impact.
-SPECTRIFY_USE_UNICODE_CSV = bool(getenv("SPECTRIFY_USE_UNICODE_CSV")) or False
+# For tables too wide to hold a row group in memory: rows are converted this
+# many at a time, and spilled to a temporary file on disk (see SpillingWriter,
+# SPECTRIFY_SPILL_DIR) until a whole row group can be written.  Row groups
+# hold whole segments, so pick a divisor of SPECTRIFY_ROWS_PER_GROUP.
+# Unset (or 0) keeps row groups in memory.
+SPECTRIFY_SPILL_ROWS = int(environ.get('SPECTRIFY_SPILL_ROWS') or 0)
 
-# These are the values Redshift uses for true/false in its CSVs
-POSTGRES_TRUE_VAL = 't'
-POSTGRES_FALSE_VAL = 'f'
+# Memoize the conversion of repetitive columns (see MemoizedConverter).
+# Converted values are cached per row group.
+SPECTRIFY_MEMOIZE = bool(getenv('SPECTRIFY_MEMOIZE')) or False
+
+# Uncompressed data files are split into byte ranges of this size, which are
+# converted in parallel.  Each range produces its own numbered Parquet file.
+SPECTRIFY_SPLIT_SIZE = int(environ.get('SPECTRIFY_SPLIT_SIZE') or 64 * 2**20)  # 64MB
+
+# Data files with these extensions are compressed as a single stream and
+# can't be split into byte ranges.
+COMPRESSED_EXTENSIONS = ('.gz', '.bz2', '.zst')
+
+# These are the values Redshift uses for true/false in its CSVs.  UNLOAD files
+# are parsed to bytes; other CSV dialects are parsed to strings.
+POSTGRES_TRUE_VALS = ('t', b't')
+POSTGRES_FALSE_VALS = ('f', b'f')
 
 
 def postgres_bool_to_python_bool(val):
@@ -47,16 +70,22 @@ def postgres_bool_to_python_bool(val):
         columns. This function parses the string and returns a python bool
     """
     if val:
-        if val == POSTGRES_TRUE_VAL:
+        if val in POSTGRES_TRUE_VALS:
             return True
-        elif val == POSTGRES_FALSE_VAL:
+        elif val in POSTGRES_FALSE_VALS:
             return False
         else:
             raise ValueError("Unknown boolean value {}".format(val))
     return None
 
 
-""" The CSV reader passes in strings, and we want to convert them to various
+def string_to_decimal(val):
+    if isinstance(val, bytes):
+        val = val.decode('ascii')
+    return Decimal(val)
+
+
+""" The CSV reader passes in strings (or bytes), and we want to convert them to various
 Arrow/Parquet types.  Unfortunately Arrow doesn't know how to convert from
 string directly to those types.  The functions below will convert a string
 to an appropriate Python type, such that it can be parsed into the corresponding
@@ -66,30 +95,56 @@ string_converters = {
     int: int,
     float: float,
     bool: postgres_bool_to_python_bool,
-    Decimal: Decimal,
+    Decimal: string_to_decimal,
     datetime: iso8601_to_nanos,
     date: iso8601_to_days_since_epoch,  # Actually converts to int via datetime!
 }
 
+# Timestamps are converted straight to integers in the unit they are stored in
+# (see SPECTRIFY_TIMESTAMP_UNIT), rather than to nanoseconds and then downcast
+timestamp_converters = {
+    'int96': iso8601_to_nanos,
+    'us': iso8601_to_micros,
+    'ms': iso8601_to_millis,
+}
+
+# Columns of these types are worth memoizing: their conversion functions are
+# expensive, or (for strings) memoizing lets repeated values share one object.
+memoized_types = {datetime, date, Decimal, str}
+
 if sys.version_info[0] < 3:
     string_converters.update({
         int: long,
         long: long,
-        str: unicode,
     })
+    memoized_types.add(unicode)
 
 
 class CsvConverter:
     def __init__(self, sa_table, s3_config, delimiter='|', escapechar='\\', quoting=csv.QUOTE_NONE,
-                 unicode_csv=SPECTRIFY_USE_UNICODE_CSV, **kwargs):
+                 unicode_csv=None, memoize=SPECTRIFY_MEMOIZE, dictionary_columns=None,
+                 timestamp_unit=SPECTRIFY_TIMESTAMP_UNIT, spill_rows=SPECTRIFY_SPILL_ROWS, **kwargs):
+        # unicode_csv is deprecated and ignored: UNLOAD files are parsed as bytes
         self.sa_table = sa_table
         self.s3_config = s3_config
         self.delimiter = delimiter
         self.escapechar = escapechar
         self.quoting = quoting
-        self.unicode_csv = unicode_csv
+        self.memoize = memoize
+        self.dictionary_columns = dictionary_columns
+        self.timestamp_unit = timestamp_unit
+        self.spill_rows = spill_rows
         self.kwargs = kwargs
 
+    def get_worker_kwargs(self):
+        """Keyword arguments for the CsvConverter instances created by pool workers"""
+        return {
+            'memoize': self.memoize,
+            'dictionary_columns': self.dictionary_columns,
+            'timestamp_unit': self.timestamp_unit,
+            'spill_rows': self.spill_rows,
+        }
+
     def log(self, msg):
         """By default, we log to console with click"""
         click.echo(msg)
@@ -98,18 +153,30 @@ class CsvConverter:
         with self.s3_config.fs_open(self.s3_config.get_manifest_path()) as manifest_file:
             return json.loads(manifest_file.read().decode('utf-8'))
 
-    def convert_csv(self, file_path):
-        """Converts an individual datafile on S3 to parquet"""
+    def get_output_path(self, file_path, part=None):
+        """Returns the Parquet path for a datafile, or for one numbered part of
+        a datafile which was split into byte ranges.
+        """
         filename, ext = path.splitext(path.basename(file_path))
         out_dir = self.s3_config.get_spectrum_dir()
         out_path = path.join(out_dir, filename)
+        if part is not None:
+            out_path += '.{:04d}'.format(part)
         if not out_path.endswith('.parq'):
             out_path += '.parq'
+        return out_path
+
+    def convert_csv(self, file_path, byte_range=None, part=None):
+        """Converts an individual datafile on S3 to parquet
+        If byte_range is given, only the records starting within that range of
+        the (uncompressed) datafile are converted.
+        """
+        out_path = self.get_output_path(file_path, part)
 
         self.log('Converting file [%s] to [%s]' % (file_path, out_path))
 
         with self.s3_config.fs_open(out_path, 'wb') as s3_file:
-            with Writer(s3_file, self.sa_table) as writer:
+            with self.get_writer(s3_file) as writer:
                 # Read the data in chunks (to control memory usage) and write to parquet.
                 # The obvious choice is to use Pandas for this, but issues with null values and
                 # difficulty with type conversions were a blocker when I originally wrote this code.
@@ -117,11 +184,28 @@ class CsvConverter:
                 #
                 # Assuming those issues have solutions, using Pandas would probably be much more
                 # efficient in terms of CPU and memory.
-                for chunk in self.columnar_data_chunks(file_path, self.sa_table, SPECTRIFY_ROWS_PER_GROUP):
+                chunks = self.columnar_data_chunks(
+                    file_path, self.sa_table, self.get_chunk_size(), byte_range=byte_range)
+                for chunk in chunks:
                     writer.write_row_group(chunk)
 
         self.log('Done converting file [%s] to [%s]' % (file_path, out_path))
 
+    def is_spilling(self):
+        return 0 < self.spill_rows < int(SPECTRIFY_ROWS_PER_GROUP)
+
+    def get_chunk_size(self):
+        """Rows converted at a time: a row group, or a part of one when spilling"""
+        return self.spill_rows if self.is_spilling() else int(SPECTRIFY_ROWS_PER_GROUP)
+
+    def get_writer(self, py_fd):
+        if self.is_spilling():
+            return SpillingWriter(
+                py_fd, self.sa_table, int(SPECTRIFY_ROWS_PER_GROUP), dictionary_columns=self.dictionary_columns,
+                timestamp_unit=self.timestamp_unit)
+        return Writer(
+            py_fd, self.sa_table, dictionary_columns=self.dictionary_columns, timestamp_unit=self.timestamp_unit)
+
     def _clear_and_collect(self, data):
         for col in data:
             col.clear()
@@ -135,15 +219,16 @@ class CsvConverter:
         """Converts the CSV string element to an intermediary python datatype
         This is necessary because Arrow can't parse strings itself, it expects
         an intermediary data type (actual type is determined by the destination
-        arrow datatype)
+        arrow datatype).  String columns are left as bytes (or str); the Writer
+        decodes a whole column at once.
         """
-        if value == '':
+        if not value:
             value = None
         elif py_type:
             value = py_type(value)
         return value
 
-    def columnar_data_chunks(self, data_path, sa_table, chunk_size):
+    def columnar_data_chunks(self, data_path, sa_table, chunk_size, byte_range=None):
         """A generator function that returns chunk_size rows (or whatever is left
         at the end of the file) in columnar format
         This function also performs conversion from string to python datatype based on the given
@@ -153,10 +238,15 @@ class CsvConverter:
         # An array of functions corresponding to the CSV columns that take a string and return the
         # corresponding Python datatype
         type_converters = self.table_to_conversion_funcs(sa_table)
-        with self.get_csv_reader(data_path) as reader:
+        memoizers = []
+        if self.memoize:
+            type_converters, memoizers = self.memoize_conversion_funcs(sa_table, type_converters)
+
+        with self.get_csv_reader(data_path, byte_range) as reader:
             num_cols = len(sa_table.columns)
             col_indices = range(num_cols)
-            data = [list() for i in range(num_cols)]
+            # String columns are accumulated as dictionary indices where possible
+            data = new_columns(sa_table, self.dictionary_columns)
 
             # Read in CSV and store it by column (makes passing to Arrow easier)
             for row in reader:
@@ -170,29 +260,184 @@ class CsvConverter:
 
                 if len(data[0]) == chunk_size:
                     yield data
+                    self._clear_memoizers(memoizers)
                     self._clear_and_collect(data)
 
             # Number of rows in file is not necessarily divisible by chunk_size
             # So make sure there isn't any lingering data to process
             if data[0]:
                 yield data
+                self._clear_memoizers(memoizers)
                 self._clear_and_collect(data)
 
+        if memoizers:
+            self.log_memoization_stats(data_path, memoizers)
+
     def table_to_conversion_funcs(self, sa_table):
         cols = sa_table.columns
-        return [string_converters.get(col.type.python_type) for col in cols]
-
-    def get_csv_reader(self, data_path):
+        return [self.column_to_conversion_func(col) for col in cols]
+
+    def column_to_conversion_func(self, col):
+        py_type = col.type.python_type
+        if py_type is Decimal and col.type.precision is not None and col.type.scale is not None:
+            # Fixed-scale decimal strings are passed through untouched; the
+            # Writer parses them straight into Arrow's decimal128 representation
+            return None
+        if py_type is datetime:
+            return timestamp_converters[self.timestamp_unit]
+        return string_converters.get(py_type)
+
+    def memoize_conversion_funcs(self, sa_table, type_converters):
+        """Wraps the conversion functions of memoizable columns in a
+        MemoizedConverter.  Returns the new conversion functions, and a list of
+        (column name, MemoizedConverter) pairs.
+        """
+        memoizers = []
+        funcs = []
+        for col, func in zip(sa_table.columns, type_converters):
+            if col.type.python_type in memoized_types:
+                func = MemoizedConverter(func)
+                memoizers.append((col.description, func))
+            funcs.append(func)
+        return funcs, memoizers
+
+    def _clear_memoizers(self, memoizers):
+        for _, memoizer in memoizers:
+            memoizer.clear()
+
+    def log_memoization_stats(self, data_path, memoizers):
+        for col_name, memoizer in memoizers:
+            stats = memoizer.stats()
+            self.log('Memoized column [%s] of [%s]: %d hits, %d misses, %d evictions, %.1f%% hit rate%s' % (
+                col_name, data_path, stats['hits'], stats['misses'], stats['evictions'],
+                stats['hit_rate'] * 100, '' if stats['enabled'] else ' (disabled)'
+            ))
+
+    def get_csv_reader(self, data_path, byte_range=None):
+        if byte_range is not None:
+            start, end = byte_range
+            return S3RangeCSVReader(
+                self.s3_config,
+                data_path,
+                start,
+                end,
+                delimiter=self.delimiter,
+                escapechar=self.escapechar,
+                quoting=self.quoting,
+            )
         return S3GZipCSVReader(
             self.s3_config,
             data_path,
             delimiter=self.delimiter,
             escapechar=self.escapechar,
             quoting=self.quoting,
-            unicode_csv=self.unicode_csv
         )
 
 
+class _EncoderThread(object):
+    """Writes row groups handed over by the parsing thread.  Building Arrow
+    arrays and encoding/compressing Parquet mostly release the GIL, so they
+    overlap with parsing the next chunk.
+    """
+    _DONE = object()
+
+    def __init__(self, writer, max_chunks=1):
+        self.writer = writer
+        self.chunks = Queue(max_chunks)
+        self.error = None
+        # Time the parsing thread spent waiting for the encoder
+        self.wait_seconds = 0.0
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            chunk = self.chunks.get()
+            if chunk is self._DONE:
+                return
+            if self.error is None:
+                try:
+                    self.writer.write_row_group(chunk)
+                except Exception as e:
+                    # Keep draining, so that the parsing thread never blocks on a full queue
+                    self.error = e
+
+    def put(self, chunk):
+        if self.error is not None:
+            raise self.error
+        wait_start = time.time()
+        self.chunks.put(chunk)
+        self.wait_seconds += time.time() - wait_start
+
+    def finish(self):
+        self.chunks.put(self._DONE)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+class PipelinedCsvConverter(CsvConverter):
+    """Converts a file with three overlapping stages: a thread downloading and
+    decompressing ahead (see ReadAheadFile), CSV parsing in the calling
+    thread, and a thread encoding the parsed row groups.  Only parsing holds
+    the GIL for long, so one process keeps more than one core busy.
+
+    After each file, python_fraction holds the share of the time which was
+    spent in the GIL-bound parsing stage.
+    """
+
+    def __init__(self, *args, **kwargs):
+        CsvConverter.__init__(self, *args, **kwargs)
+        self.reader = None
+        self.python_fraction = None
+
+    def convert_csv(self, file_path, byte_range=None, part=None):
+        out_path = self.get_output_path(file_path, part)
+
+        self.log('Converting file [%s] to [%s]' % (file_path, out_path))
+
+        start = time.time()
+        with self.s3_config.fs_open(out_path, 'wb') as s3_file:
+            with self.get_writer(s3_file) as writer:
+                encoder = _EncoderThread(writer)
+                try:
+                    chunks = self.columnar_data_chunks(
+                        file_path, self.sa_table, self.get_chunk_size(), byte_range=byte_range)
+                    for chunk in chunks:
+                        # The generator reuses its outer list; the columns are replaced, not cleared
+                        encoder.put(list(chunk))
+                finally:
+                    parse_seconds = time.time() - start
+                    encoder.finish()
+        wall_seconds = time.time() - start
+
+        read_wait_seconds = getattr(self.reader, 'read_wait_seconds', 0.0)
+        python_seconds = max(0.0, parse_seconds - read_wait_seconds - encoder.wait_seconds)
+        self.python_fraction = min(1.0, python_seconds / wall_seconds) if wall_seconds else 1.0
+
+        self.log('Done converting file [%s] to [%s]' % (file_path, out_path))
+
+    def _clear_and_collect(self, data):
+        # The encoder thread may still be using the previous lists
+        for i in range(len(data)):
+            data[i] = data[i].empty() if isinstance(data[i], DictionaryColumn) else list()
+
+    def get_csv_reader(self, data_path, byte_range=None):
+        if byte_range is not None:
+            self.reader = CsvConverter.get_csv_reader(self, data_path, byte_range)
+        else:
+            self.reader = S3GZipCSVReader(
+                self.s3_config,
+                data_path,
+                read_ahead=True,
+                delimiter=self.delimiter,
+                escapechar=self.escapechar,
+                quoting=self.quoting,
+            )
+        return self.reader
+
+
 class _PoolManager(object):
     """Pool in Python 2 doesn't act as a context manager. So just make one here"""
 
@@ -211,26 +456,165 @@ class _PoolManager(object):
 
 
 def _parallel_wrapper(arg_tuple):
-    data_path, sa_table, s3_config, delimiter, escapechar, quoting, unicode_csv = arg_tuple
-    CsvConverter(sa_table, s3_config, delimiter, escapechar, quoting, unicode_csv).convert_csv(data_path)
+    data_path, sa_table, s3_config, delimiter, escapechar, quoting, converter_kwargs = arg_tuple
+    converter = CsvConverter(sa_table, s3_config, delimiter, escapechar, quoting, **converter_kwargs)
+    converter.convert_csv(data_path)
+
+
+def _parallel_batch_wrapper(arg_tuple):
+    """Converts a batch of files in order, prefetching the next few files in the
+    batch while the current one is converted.
+    """
+    (data_paths, prefetch_files, sa_table, s3_config, delimiter, escapechar, quoting,
+     converter_kwargs) = arg_tuple
+    with PrefetchingS3Config(s3_config) as prefetching_config:
+        converter = CsvConverter(
+            sa_table, prefetching_config, delimiter, escapechar, quoting, **converter_kwargs)
+        for i, data_path in enumerate(data_paths):
+            prefetching_config.prefetch(data_paths[i + 1:i + 1 + prefetch_files])
+            converter.convert_csv(data_path)
+
+
+def _parallel_range_wrapper(arg_tuple):
+    (data_path, byte_range, part, sa_table, s3_config, delimiter, escapechar, quoting,
+     converter_kwargs) = arg_tuple
+    converter = CsvConverter(sa_table, s3_config, delimiter, escapechar, quoting, **converter_kwargs)
+    converter.convert_csv(data_path, byte_range=byte_range, part=part)
 
 
 class ConcurrentManifestConverter(CsvConverter):
-    """Converts CSV files concurrently using a multiprocessing pool."""
+    """Converts CSV files concurrently using a multiprocessing pool.
+
+    Unless prefetching is disabled (prefetch_files=0), files are handed to the
+    workers in small batches (see get_batches) so each worker knows which
+    files come next, and can fetch their first block while converting the
+    current one.
+    """
 
     def convert_manifest(self):
         num_workers = self.kwargs.get('num_workers') or cpu_count()
+        prefetch_files = self.kwargs.get('prefetch_files', SPECTRIFY_PREFETCH_FILES)
         manifest = self.get_manifest()
+        urls = [entry['url'] for entry in manifest['entries']]
+
+        if not prefetch_files:
+            convert_args = [
+                (
+                    url, self.sa_table, self.s3_config, self.delimiter,
+                    self.escapechar, self.quoting, self.get_worker_kwargs()
+                )
+                for url in urls
+            ]
+            with _PoolManager(num_workers) as pool:
+                pool.map(_parallel_wrapper, convert_args, chunksize=1)
+            return
+
         convert_args = [
             (
-                entry['url'], self.sa_table, self.s3_config, self.delimiter,
-                self.escapechar, self.quoting, self.unicode_csv
+                batch, prefetch_files, self.sa_table, self.s3_config, self.delimiter,
+                self.escapechar, self.quoting, self.get_worker_kwargs()
             )
-            for entry in manifest['entries']
+            for batch in get_batches(urls, num_workers, prefetch_files)
         ]
+        with _PoolManager(num_workers) as pool:
+            pool.map(_parallel_batch_wrapper, convert_args, chunksize=1)
+
+
+def get_batches(urls, num_workers, prefetch_files):
+    """Splits urls into the batches converted by ConcurrentManifestConverter's
+    workers.  Two batches per worker would give each a run of files to
+    prefetch, but with many files one slow batch keeps the run waiting on a
+    single worker.  So a batch holds at most a file and the files prefetched
+    while it's converted.
+    """
+    batch_size = max(1, min(len(urls) // (num_workers * 2), prefetch_files + 1))
+    return [urls[i:i + batch_size] for i in range(0, len(urls), batch_size)]
+
+
+class SplittingManifestConverter(CsvConverter):
+    """Converts CSV files concurrently, splitting uncompressed files into byte
+    ranges so that a single large file is converted by several processes.
+    Each range is written to its own numbered Parquet file.  Compressed files
+    can't be split, and are converted whole.
+    """
+
+    def convert_manifest(self):
+        num_workers = self.kwargs.get('num_workers') or cpu_count()
+        split_size = self.kwargs.get('split_size') or SPECTRIFY_SPLIT_SIZE
+        manifest = self.get_manifest()
+        convert_args = []
+        for entry in manifest['entries']:
+            for byte_range, part in self.get_splits(entry, split_size):
+                convert_args.append((
+                    entry['url'], byte_range, part, self.sa_table, self.s3_config, self.delimiter,
+                    self.escapechar, self.quoting, self.get_worker_kwargs()
+                ))
 
         with _PoolManager(num_workers) as pool:
-            pool.map(_parallel_wrapper, convert_args, chunksize=1)
+            pool.map(_parallel_range_wrapper, convert_args, chunksize=1)
+
+    def get_splits(self, entry, split_size):
+        """Returns a list of (byte_range, part) tuples for a manifest entry"""
+        url = entry['url']
+        if url.endswith(COMPRESSED_EXTENSIONS):
+            return [(None, None)]
+
+        # Manifests written with UNLOAD ... MANIFEST VERBOSE include the file size
+        size = entry.get('meta', {}).get('content_length')
+        if size is None:
+            size = self.s3_config.fs_size(url)
+        byte_ranges = plan_byte_ranges(size, split_size)
+        if len(byte_ranges) == 1:
+            return [(byte_ranges[0], None)]
+        return [(byte_range, part) for part, byte_range in enumerate(byte_ranges)]
+
+
+def _parallel_pipelined_wrapper(arg_tuple):
+    data_path, sa_table, s3_config, delimiter, escapechar, quoting, converter_kwargs = arg_tuple
+    converter = PipelinedCsvConverter(
+        sa_table, s3_config, delimiter, escapechar, quoting, **converter_kwargs)
+    converter.convert_csv(data_path)
+
+
+class HybridManifestConverter(CsvConverter):
+    """Converts CSV files with a pool of processes, each running the threads of
+    a PipelinedCsvConverter.
+
+    The first file is converted in this process to measure how much of the
+    conversion is bound to the GIL.  The pool then gets ceil(cpus * fraction)
+    processes (unless num_workers is given): the less time is spent in
+    Python, the more of each core the threads of a single process can use,
+    without the memory cost of a process per core.
+    """
+
+    def convert_manifest(self):
+        manifest = self.get_manifest()
+        urls = [entry['url'] for entry in manifest['entries']]
+        if not urls:
+            return
+
+        calibration_converter = PipelinedCsvConverter(
+            self.sa_table, self.s3_config, self.delimiter, self.escapechar, self.quoting,
+            **self.get_worker_kwargs())
+        calibration_converter.log = self.log
+        calibration_converter.convert_csv(urls[0])
+        num_workers = self.kwargs.get('num_workers') or self.get_num_workers(calibration_converter.python_fraction)
+        self.log('Python-bound fraction of conversion: %.2f, using %d processes' % (
+            calibration_converter.python_fraction, num_workers))
+
+        convert_args = [
+            (
+                url, self.sa_table, self.s3_config, self.delimiter,
+                self.escapechar, self.quoting, self.get_worker_kwargs()
+            )
+            for url in urls[1:]
+        ]
+        with _PoolManager(num_workers) as pool:
+            pool.map(_parallel_pipelined_wrapper, convert_args, chunksize=1)
+
+    def get_num_workers(self, python_fraction):
+        num_cpus = cpu_count()
+        return max(1, min(num_cpus, int(math.ceil(num_cpus * python_fraction))))
 
 
 class SimpleManifestConverter(CsvConverter):
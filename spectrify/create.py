@@ -1,5 +1,5 @@
 from __future__ import absolute_import, division, print_function
-from future.standard_library import install_aliases
+from spectrify.utils.compat import install_aliases
 import abc
 install_aliases()  # noqa
 
@@ -13,20 +13,44 @@ type_map = {
 }
 
 
+# Spectrum's planner assumes a default size for external tables whose numRows
+# property isn't set
+set_num_rows_query = """
+    alter table {table_name} set table properties ('numRows'='{num_rows}')
+    """
+
+
+def get_external_table_name(schema_name, table_name):
+    # If we are converting a table from another schema, include the schema
+    # in the table name.
+    return '.'.join([schema_name, table_name.replace('.', '_')])
+
+
 class TableCreator(object):
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, engine, schema_name, table_name, sa_table, s3_config):
+    def __init__(self, engine, schema_name, table_name, sa_table, s3_config, num_rows=None):
         self.engine = engine
         self.schema_name = schema_name
         self.table_name = table_name
         self.sa_table = sa_table
         self.s3_config = s3_config
+        # Row count published as the numRows table property, if known
+        self.num_rows = num_rows
 
     @property
     def query(self):
         return self.format_query()
 
+    @property
+    def statistics_query(self):
+        if self.num_rows is None:
+            return None
+        return set_num_rows_query.format(
+            table_name=get_external_table_name(self.schema_name, self.table_name),
+            num_rows=int(self.num_rows),
+        )
+
     def log(self, msg):
         """By default, we log to console with click"""
         click.echo(msg)
@@ -61,12 +85,16 @@ class TableCreator(object):
             cursor.execution_options(isolation_level='AUTOCOMMIT')
             self.log('Creating table...')
             cursor.execute(self.query)
+            if self.statistics_query:
+                cursor.execute(self.statistics_query)
             self.log('Done.')
 
     def log_query(self):
         self.log('')
         self.log('*** CREATE TABLE SQL ***')
         self.log(self.query)
+        if self.statistics_query:
+            self.log(self.statistics_query)
         self.log('')
 
     def confirm(self):
@@ -82,15 +110,12 @@ class SpectrumTableCreator(TableCreator):
     location '{s3_location}'
     """
 
-    def __init__(self, engine, schema_name, table_name, sa_table, s3_config):
-        TableCreator.__init__(self, engine, schema_name, table_name, sa_table, s3_config)
+    def __init__(self, engine, schema_name, table_name, sa_table, s3_config, num_rows=None):
+        TableCreator.__init__(self, engine, schema_name, table_name, sa_table, s3_config, num_rows)
 
     def format_query(self):
-        # If we are converting a table from another schema, include the schema
-        # in the table name.
-        table_name = self.table_name.replace('.', '_')
         return self.create_query.format(
-            table_name='.'.join([self.schema_name, table_name]),
+            table_name=get_external_table_name(self.schema_name, self.table_name),
             column_list=self.get_table_columns_ddl(),
             s3_location=self.s3_config.get_spectrum_dir(),
         )
@@ -122,19 +147,17 @@ class OpenCSVSerdeTableCreator(TableCreator):
         s3_config,
         delimiter="|",
         gzipped=True,
-        use_manifest=True
+        use_manifest=True,
+        num_rows=None
     ):
-        TableCreator.__init__(self, engine, schema_name, table_name, sa_table, s3_config)
+        TableCreator.__init__(self, engine, schema_name, table_name, sa_table, s3_config, num_rows)
         self.delimiter = delimiter
         self.gzipped = gzipped
         self.use_manifest = use_manifest
 
     def format_query(self):
-        # If we are converting a table from another schema, include the schema
-        # in the table name.
-        table_name = self.table_name.replace('.', '_')
         return self.create_query.format(
-            table_name='.'.join([self.schema_name, table_name]),
+            table_name=get_external_table_name(self.schema_name, self.table_name),
             column_list=self.get_table_columns_ddl(),
             delimiter=self.delimiter,
             s3_location=self._get_s3_location(),
@@ -152,3 +175,55 @@ class OpenCSVSerdeTableCreator(TableCreator):
             return 'gzip'
 
         return 'none'
+
+
+class SpectrumPartitionAdder(object):
+    """Registers a partition (a Hive-style directory below the spectrum
+    directory, e.g. "dt=2020-01-01") of an existing Spectrum table, and updates
+    the table's numRows to include it.
+    """
+    add_partition_query = """
+    alter table {table_name}
+    add if not exists partition ({partition_spec})
+    location '{s3_location}'
+    """
+
+    def __init__(self, engine, schema_name, table_name, s3_config, partition, num_rows=None):
+        self.engine = engine
+        self.schema_name = schema_name
+        self.table_name = table_name
+        self.s3_config = s3_config
+        self.partition = partition.strip('/')
+        # Row count of the whole table (all partitions), if known
+        self.num_rows = num_rows
+
+    def log(self, msg):
+        """By default, we log to console with click"""
+        click.echo(msg)
+
+    def get_partition_spec(self):
+        spec = []
+        for part in self.partition.split('/'):
+            key, _, value = part.partition('=')
+            spec.append("{}='{}'".format(key, value.replace("'", "''")))
+        return ', '.join(spec)
+
+    def format_queries(self):
+        table_name = get_external_table_name(self.schema_name, self.table_name)
+        s3_location = '/'.join([self.s3_config.get_spectrum_dir().rstrip('/'), self.partition, ''])
+        queries = [self.add_partition_query.format(
+            table_name=table_name,
+            partition_spec=self.get_partition_spec(),
+            s3_location=s3_location.replace("'", "''"),
+        )]
+        if self.num_rows is not None:
+            queries.append(set_num_rows_query.format(table_name=table_name, num_rows=int(self.num_rows)))
+        return queries
+
+    def add(self):
+        with self.engine.connect() as cursor:
+            cursor.execution_options(isolation_level='AUTOCOMMIT')
+            self.log('Adding partition [%s]...' % self.partition)
+            for query in self.format_queries():
+                cursor.execute(query)
+            self.log('Done.')
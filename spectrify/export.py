@@ -1,24 +1,157 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
-from future.standard_library import install_aliases
+from spectrify.utils.compat import install_aliases
 install_aliases()  # noqa
 
-import boto3
+import json
+import math
+from collections import namedtuple
+from datetime import date, datetime
+from multiprocessing.pool import ThreadPool
+from os import environ
+
 import click
+import sqlalchemy as sa
+
+from spectrify.stream import count_selected_rows, get_row_width, get_table_size_mb
+from spectrify.utils.s3 import ShardS3Config
+from spectrify.utils.schema import project_table
+
+# Number of ranges a sharded export splits the table into, and how many of
+# their UNLOADs run at the same time
+SPECTRIFY_UNLOAD_SHARDS = int(environ.get('SPECTRIFY_UNLOAD_SHARDS') or 8)
+SPECTRIFY_UNLOAD_CONCURRENCY = int(environ.get('SPECTRIFY_UNLOAD_CONCURRENCY') or 4)
+
+# Aim for this many UNLOAD files per conversion worker, so that workers which
+# finish early pick up more files instead of idling
+SPECTRIFY_UNLOAD_FILES_PER_WORKER = int(environ.get('SPECTRIFY_UNLOAD_FILES_PER_WORKER') or 2)
+
+# UNLOAD files are kept below this size, however few workers there are, so a
+# single file doesn't hold up the end of a conversion for too long.  This
+# bounds time rather than memory: workers convert a file a row group at a
+# time, so their memory is bounded by SPECTRIFY_ROWS_PER_GROUP instead.
+SPECTRIFY_UNLOAD_MAX_FILE_MB = int(environ.get('SPECTRIFY_UNLOAD_MAX_FILE_MB') or 1024)
+
+# Files smaller than this aren't worth the per-file overhead of converting them
+SPECTRIFY_UNLOAD_MIN_FILE_MB = int(environ.get('SPECTRIFY_UNLOAD_MIN_FILE_MB') or 16)
+
+# Limits of MAXFILESIZE allowed by Redshift
+REDSHIFT_MIN_FILE_MB = 5
+REDSHIFT_MAX_FILE_MB = 6200
+
+NUM_SLICES_QUERY = sa.text('select count(*) from stv_slices')
+
+# Settings of an UNLOAD: whether every slice writes its own files in
+# parallel, and the size at which files are split
+UnloadLayout = namedtuple('UnloadLayout', ['parallel', 'max_file_size_mb'])
+
+DEFAULT_LAYOUT = UnloadLayout(True, 256)
+
+
+def plan_unload_layout(table_size_mb, num_slices, num_workers, files_per_worker=SPECTRIFY_UNLOAD_FILES_PER_WORKER,
+                       min_file_mb=SPECTRIFY_UNLOAD_MIN_FILE_MB, max_file_mb=SPECTRIFY_UNLOAD_MAX_FILE_MB):
+    """Picks UNLOAD settings which produce about num_workers * files_per_worker
+    files for a table of table_size_mb, assuming the table is spread evenly
+    over num_slices slices.
+
+    With PARALLEL ON, every slice writes at least one file.  If that would
+    give many more files than needed, each well below min_file_mb, the
+    table is unloaded serially (PARALLEL OFF) instead.
+    """
+    target_files = max(1, num_workers * files_per_worker)
+    slice_size_mb = table_size_mb / num_slices
+    if num_slices > target_files and slice_size_mb < min_file_mb:
+        parallel = False
+        file_size_mb = table_size_mb / target_files
+    else:
+        parallel = True
+        files_per_slice = int(math.ceil(target_files / num_slices))
+        file_size_mb = slice_size_mb / files_per_slice
+
+    file_size_mb = min(max(file_size_mb, min_file_mb), max_file_mb)
+    file_size_mb = min(max(int(math.ceil(file_size_mb)), REDSHIFT_MIN_FILE_MB), REDSHIFT_MAX_FILE_MB)
+    return UnloadLayout(parallel, file_size_mb)
+
+
+def get_num_slices(engine):
+    """Returns the number of slices of the cluster, or None if it is unknown"""
+    try:
+        with engine.connect() as cursor:
+            return cursor.execute(NUM_SLICES_QUERY).scalar()
+    except sa.exc.DBAPIError:
+        return None
+
+
+def estimate_export_size_mb(engine, table_name, sa_table=None, columns=None, where=None):
+    """Estimates the size of an export from the table's size in svv_table_info,
+    or returns None if it is unknown.
+
+    That size is of all rows and columns, compressed in Redshift's columnar
+    format, so it's scaled by the share of the declared column widths that
+    the columns selected make up (given the whole table as sa_table), and by
+    the share of rows the where predicate selects.  Neither this nor the
+    compression of CSV output is measured, so this is a rough estimate;
+    `spectrify export --table-size-mb` gives a better one where known.
+    """
+    table_size_mb = get_table_size_mb(engine, table_name)
+    if not table_size_mb:
+        return table_size_mb
+    if columns and sa_table is not None:
+        table_size_mb *= get_row_width(project_table(sa_table, columns)) / get_row_width(sa_table)
+    if where:
+        num_rows = count_selected_rows(engine, table_name)
+        num_selected = count_selected_rows(engine, table_name, where)
+        if num_rows and num_selected is not None:
+            table_size_mb *= num_selected / num_rows
+    return table_size_mb
+
+
+def get_unload_layout(engine, table_name, num_workers, table_size_mb=None, num_shards=1, sa_table=None,
+                      columns=None, where=None):
+    """Plans the UNLOAD layout of an export (see plan_unload_layout) from its
+    size, estimated with estimate_export_size_mb unless given.  Each of
+    num_shards shards is planned to keep all workers busy on its own, since
+    shards are converted as they finish.  Falls back to DEFAULT_LAYOUT if the
+    size or slice count is unknown.
+    """
+    if table_size_mb is None:
+        table_size_mb = estimate_export_size_mb(engine, table_name, sa_table, columns, where)
+    num_slices = get_num_slices(engine)
+    if not table_size_mb or not num_slices:
+        return DEFAULT_LAYOUT
+    return plan_unload_layout(table_size_mb / num_shards, num_slices, num_workers)
+
+
+def quote_column(column):
+    return '"{}"'.format(column.replace('"', '""'))
 
 
 class RedshiftDataExporter:
     UNLOAD_QUERY = """
-    UNLOAD ('select * from {table_name}')
+    UNLOAD ('{select_query}')
     to %(s3_path)s
     CREDENTIALS %(credentials)s
-    ESCAPE MANIFEST GZIP ALLOWOVERWRITE
+    ESCAPE MANIFEST VERBOSE {compression_config} ALLOWOVERWRITE
     {region_config}
-    MAXFILESIZE 256 mb;
+    PARALLEL {parallel}
+    MAXFILESIZE {max_file_size_mb} mb;
     """
 
-    def __init__(self, sa_engine, s3_config):
+    def __init__(self, sa_engine, s3_config, gzip=True, columns=None, where=None, credentials=None,
+                 layout=DEFAULT_LAYOUT):
         self.sa_engine = sa_engine
         self.s3_config = s3_config
+        # An UnloadLayout, see get_unload_layout
+        self.layout = layout
+        # Looked up with boto3 unless given
+        self.credentials = credentials
+        # Uncompressed exports are larger, but can be split into byte ranges
+        # and converted in parallel (see SplittingManifestConverter)
+        self.gzip = gzip
+        # Only export these columns (in this order), and only rows matching
+        # the where predicate.  The converter and the Spectrum table must use
+        # the same columns (see spectrify.utils.schema.project_table)
+        self.columns = columns
+        self.where = where
 
     def export_to_csv(self, table_name):
         s3_path = self.s3_config.get_csv_dir()
@@ -38,10 +171,29 @@ class RedshiftDataExporter:
         if self.s3_config.get_bucket_region():
             region_config = 'REGION \'{}\''.format(self.s3_config.get_bucket_region())
         return self.UNLOAD_QUERY.format(
+            select_query=self.get_select_query(table_name),
             table_name=table_name,
-            region_config=region_config)
+            compression_config='GZIP' if self.gzip else '',
+            region_config=region_config,
+            parallel='ON' if self.layout.parallel else 'OFF',
+            max_file_size_mb=self.layout.max_file_size_mb)
+
+    def get_select_query(self, table_name):
+        """Returns the query to unload, escaped for use inside UNLOAD ('...')"""
+        column_list = '*'
+        if self.columns:
+            column_list = ', '.join(quote_column(col) for col in self.columns)
+        query = 'select {} from {}'.format(column_list, table_name)
+        if self.where:
+            query += ' where {}'.format(self.where)
+        # Quotes are doubled inside the UNLOAD string literal, and percent
+        # signs are doubled because the UNLOAD is executed with parameters
+        return query.replace("'", "''").replace('%', '%%')
 
     def get_credentials(self):
+        if self.credentials:
+            return self.credentials
+        import boto3
         session = boto3.Session()
         credentials = session.get_credentials()
         creds_str = 'aws_access_key_id={};aws_secret_access_key={}'.format(
@@ -51,3 +203,135 @@ class RedshiftDataExporter:
         if credentials.token:
             creds_str += ';token={}'.format(credentials.token)
         return creds_str
+
+
+def get_shard_bounds(low, high, num_shards):
+    """Returns the distinct lower bounds of num_shards ranges of equal width
+    from low to high.  Works for numbers, dates and timestamps.
+    """
+    bounds = []
+    for i in range(num_shards):
+        offset = (high - low) * i
+        bound = low + (offset / num_shards if isinstance(offset, float) else offset // num_shards)
+        if not bounds or bound > bounds[-1]:
+            bounds.append(bound)
+    return bounds
+
+
+def sql_literal(value):
+    if isinstance(value, datetime):
+        return "'{}'".format(value.isoformat(' '))
+    if isinstance(value, date):
+        return "'{}'".format(value.isoformat())
+    return str(value)
+
+
+def get_shard_predicates(column, bounds):
+    """Returns SQL predicates selecting the ranges starting at each bound.
+    NULLs go to the first shard.  A single range needs no predicate (None).
+    """
+    column = quote_column(column)
+    if len(bounds) < 2:
+        return [None]
+    predicates = []
+    for i, bound in enumerate(bounds):
+        conditions = []
+        if i > 0:
+            conditions.append('{} >= {}'.format(column, sql_literal(bound)))
+        if i + 1 < len(bounds):
+            conditions.append('{} < {}'.format(column, sql_literal(bounds[i + 1])))
+        predicate = ' and '.join(conditions)
+        if i == 0:
+            predicate = '{} or {} is null'.format(predicate, column)
+        predicates.append(predicate)
+    return predicates
+
+
+class ShardedRedshiftDataExporter(RedshiftDataExporter):
+    """Exports a table as several UNLOADs of ranges of shard_column (a number,
+    date or timestamp column), up to concurrency of them at a time.  Each shard
+    is unloaded to its own prefix in the CSV directory (see ShardS3Config), so
+    it can be converted as soon as its UNLOAD finishes, while the other shards
+    are still being exported.
+
+    Once every shard is exported, their manifests are merged into the usual
+    manifest, so the export can also be converted and verified as a whole.
+    """
+    RANGE_QUERY = 'select min({column}), max({column}) from {table_name}'
+
+    def __init__(self, sa_engine, s3_config, shard_column, num_shards=SPECTRIFY_UNLOAD_SHARDS,
+                 concurrency=SPECTRIFY_UNLOAD_CONCURRENCY, **kwargs):
+        RedshiftDataExporter.__init__(self, sa_engine, s3_config, **kwargs)
+        self.shard_column = shard_column
+        self.num_shards = num_shards
+        self.concurrency = concurrency
+
+    def export_to_csv(self, table_name, on_shard_exported=None):
+        """Exports every shard, and returns their ShardS3Configs.
+        on_shard_exported(shard_config) is called in this thread as each shard
+        finishes, while the remaining shards keep exporting.
+        """
+        predicates = self.get_shard_predicates(table_name)
+        credentials = self.get_credentials()
+        shard_configs = [ShardS3Config(self.s3_config, shard) for shard in range(len(predicates))]
+        click.echo('Exporting table to CSV in %d shards...' % len(shard_configs))
+
+        def export_shard(args):
+            return self.export_shard(table_name, credentials, *args)
+
+        pool = ThreadPool(max(1, min(self.concurrency, len(shard_configs))))
+        try:
+            for shard_config in pool.imap_unordered(export_shard, zip(shard_configs, predicates)):
+                if on_shard_exported:
+                    on_shard_exported(shard_config)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.merge_manifests(shard_configs)
+        click.echo('Done.')
+        return shard_configs
+
+    def export_shard(self, table_name, credentials, shard_config, predicate):
+        where = predicate
+        if self.where and predicate:
+            where = '({}) and ({})'.format(self.where, predicate)
+        elif self.where:
+            where = self.where
+        exporter = RedshiftDataExporter(
+            self.sa_engine, shard_config, gzip=self.gzip, columns=self.columns, where=where, credentials=credentials,
+            layout=self.layout)
+        exporter.export_to_csv(table_name)
+        click.echo('Exported shard [%s]' % shard_config.get_manifest_path())
+        return shard_config
+
+    def get_shard_predicates(self, table_name):
+        low, high = self.get_column_range(table_name)
+        if low is None:
+            # No rows (or only NULLs) to split
+            return [None]
+        try:
+            bounds = get_shard_bounds(low, high, self.num_shards)
+        except TypeError:
+            raise ValueError('Can\'t split column {} of type {} into ranges'.format(
+                self.shard_column, type(low).__name__))
+        return get_shard_predicates(self.shard_column, bounds)
+
+    def get_column_range(self, table_name):
+        query = self.RANGE_QUERY.format(column=quote_column(self.shard_column), table_name=table_name)
+        if self.where:
+            query += ' where {}'.format(self.where)
+        with self.sa_engine.connect() as cursor:
+            return tuple(cursor.execute(sa.text(query)).first())
+
+    def merge_manifests(self, shard_configs):
+        manifest = {'entries': []}
+        for shard_config in shard_configs:
+            with self.s3_config.fs_open(shard_config.get_manifest_path()) as manifest_file:
+                shard_manifest = json.loads(manifest_file.read().decode('utf-8'))
+            manifest['entries'].extend(shard_manifest['entries'])
+            # MANIFEST VERBOSE adds the column schema, which is the same for every shard
+            if 'schema' in shard_manifest:
+                manifest['schema'] = shard_manifest['schema']
+        with self.s3_config.fs_open(self.s3_config.get_manifest_path(), 'wb') as manifest_file:
+            manifest_file.write(json.dumps(manifest).encode('utf-8'))
@@ -1,16 +1,33 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, division, print_function
-"""Console script for spectrify."""
+"""Console script for spectrify.
+
+Subcommands import what they need when they run, so that `spectrify --help`
+(and anything else which just imports this module) doesn't pay for importing
+pyarrow, SQLAlchemy, boto3 and s3fs.
+"""
 
 import click
 
-from spectrify.convert import ConcurrentManifestConverter
-from spectrify.create import SpectrumTableCreator
-from spectrify.export import RedshiftDataExporter
-from spectrify.transform import TableTransformer
 from spectrify.utils.redshift import ConnectionParameters, get_sa_engine
-from spectrify.utils.schema import SqlAlchemySchemaReader
-from spectrify.utils.s3 import SimpleS3Config
+
+COLUMNS_HELP = 'Comma separated list of columns to keep (default: all)'
+WHERE_HELP = 'Only export rows matching this SQL predicate'
+SHARD_COLUMN_HELP = 'Export ranges of this number, date or timestamp column with separate, concurrent UNLOADs'
+
+shards_option = click.option(
+    '--shards', type=int, default=8, envvar='SPECTRIFY_UNLOAD_SHARDS',
+    help='Number of ranges of --shard-column to export')
+
+dictionary_columns_option = click.option(
+    '--dictionary-columns', envvar='SPECTRIFY_DICTIONARY_COLUMNS',
+    help="Comma separated list of string columns to always dictionary encode; prefix with '-' to never encode")
+
+# Kept in sync with spectrify.utils.parquet.TIMESTAMP_UNITS, which isn't
+# imported here to keep the CLI quick to start
+timestamp_unit_option = click.option(
+    '--timestamp-unit', type=click.Choice(['int96', 'us', 'ms']), default='int96', envvar='SPECTRIFY_TIMESTAMP_UNIT',
+    help='How Parquet stores timestamps: legacy INT96, or INT64 micro/milliseconds')
 
 
 @click.group()
@@ -32,12 +49,29 @@ def cli(ctx, **kwargs):
 @click.option('--dest-schema', default='spectrum')
 @click.option('--dest-table')
 @click.option('--s3-region')
+@click.option('--columns', help=COLUMNS_HELP)
+@click.option('--where', help=WHERE_HELP)
+@click.option('--stream/--no-stream', default=None,
+              help='Stream rows straight into Parquet instead of using UNLOAD (default: by size of the rows selected)')
+@click.option('--shard-column', help=SHARD_COLUMN_HELP + ', converting each as soon as it is exported')
+@shards_option
+@dictionary_columns_option
+@timestamp_unit_option
 @click.pass_context
-def transform(ctx, table, s3_path, dest_schema, dest_table, s3_region):
+def transform(ctx, table, s3_path, dest_schema, dest_table, s3_region, columns, where, stream, shard_column, shards,
+              dictionary_columns, timestamp_unit):
+    from spectrify.transform import TableTransformer
+    from spectrify.utils.parquet import parse_dictionary_columns
+    from spectrify.utils.schema import parse_column_list
+    from spectrify.utils.s3 import SimpleS3Config
+
     dest_table = dest_table or table
     engine = get_sa_engine(ctx)
     s3_config = SimpleS3Config.from_base_path(s3_path, region=s3_region)
-    transformer = TableTransformer(engine, table, s3_config, dest_schema, dest_table)
+    transformer = TableTransformer(
+        engine, table, s3_config, dest_schema, dest_table,
+        columns=parse_column_list(columns), where=where, stream=stream, timestamp_unit=timestamp_unit,
+        shard_column=shard_column, num_shards=shards, dictionary_columns=parse_dictionary_columns(dictionary_columns))
     transformer.transform()
 
 
@@ -45,44 +79,304 @@ def transform(ctx, table, s3_path, dest_schema, dest_table, s3_region):
 @click.argument('table')
 @click.argument('s3_path')
 @click.option('--s3-region')
+@click.option('--uncompressed', is_flag=True, help='Export uncompressed CSVs, which can be split for conversion')
+@click.option('--columns', help=COLUMNS_HELP)
+@click.option('--where', help=WHERE_HELP)
+@click.option('--shard-column', help=SHARD_COLUMN_HELP)
+@shards_option
+@click.option('--num-workers', type=int,
+              help='Number of conversion workers to size the UNLOAD files for (default: number of CPUs)')
+@click.option('--table-size-mb', type=int,
+              help='Estimated export size in MB, instead of one scaled from the size in svv_table_info')
 @click.pass_context
-def export(ctx, table, s3_path, s3_region):
+def export(ctx, table, s3_path, s3_region, uncompressed, columns, where, shard_column, shards, num_workers,
+           table_size_mb):
+    from multiprocessing import cpu_count
+    from spectrify.export import RedshiftDataExporter, ShardedRedshiftDataExporter, get_unload_layout
+    from spectrify.utils.schema import CachedSchemaReader, parse_column_list
+    from spectrify.utils.s3 import SimpleS3Config
+
     engine = get_sa_engine(ctx)
     s3_config = SimpleS3Config.from_base_path(s3_path, region=s3_region)
-    RedshiftDataExporter(engine, s3_config).export_to_csv(table)
+    column_names = parse_column_list(columns)
+    # The size estimate is scaled by the widths of the columns selected
+    sa_table = None
+    if column_names and table_size_mb is None:
+        sa_table = CachedSchemaReader(engine).get_table_schema(table)
+    layout = get_unload_layout(
+        engine, table, num_workers or cpu_count(), table_size_mb=table_size_mb,
+        num_shards=shards if shard_column else 1, sa_table=sa_table, columns=column_names, where=where)
+    click.echo('Unloading with PARALLEL {} and MAXFILESIZE {} mb'.format(
+        'ON' if layout.parallel else 'OFF', layout.max_file_size_mb))
+    exporter_kwargs = {
+        'gzip': not uncompressed, 'columns': column_names, 'where': where, 'layout': layout,
+    }
+    if shard_column:
+        exporter = ShardedRedshiftDataExporter(
+            engine, s3_config, shard_column, num_shards=shards, **exporter_kwargs)
+    else:
+        exporter = RedshiftDataExporter(engine, s3_config, **exporter_kwargs)
+    exporter.export_to_csv(table)
 
 
 @cli.command()
 @click.argument('table')
 @click.argument('s3_path')
+@click.option('--split-size', type=int, help='Split uncompressed CSVs into ranges of this many MB')
+@click.option('--memoize/--no-memoize', default=None,
+              help='Cache conversions of repeated values (default: SPECTRIFY_MEMOIZE)')
+@click.option('--hybrid', is_flag=True, envvar='SPECTRIFY_HYBRID',
+              help='Overlap download, parsing and encoding in threads, with fewer processes')
+@click.option('--columns', help='Columns the CSVs were exported with (see export --columns)')
+@click.option('--spill-rows', type=int,
+              help='Convert this many rows at a time, buffering row groups in temporary files on disk')
+@dictionary_columns_option
+@timestamp_unit_option
 @click.pass_context
-def convert(ctx, table, s3_path):
+def convert(ctx, table, s3_path, split_size, memoize, hybrid, columns, spill_rows, dictionary_columns, timestamp_unit):
+    from spectrify.convert import ConcurrentManifestConverter, HybridManifestConverter, SplittingManifestConverter
+    from spectrify.utils.parquet import parse_dictionary_columns
+    from spectrify.utils.schema import CachedSchemaReader, get_projected_schema
+    from spectrify.utils.s3 import SimpleS3Config
+
     engine = get_sa_engine(ctx)
-    sa_table = SqlAlchemySchemaReader(engine).get_table_schema(table)
+    sa_table = get_projected_schema(CachedSchemaReader(engine), table, columns)
     s3_config = SimpleS3Config.from_base_path(s3_path)
 
-    converter = ConcurrentManifestConverter(sa_table, s3_config)
+    converter_kwargs = {
+        'timestamp_unit': timestamp_unit, 'dictionary_columns': parse_dictionary_columns(dictionary_columns),
+    }
+    # Unless given, the converters' defaults follow the environment
+    if memoize is not None:
+        converter_kwargs['memoize'] = memoize
+    if spill_rows is not None:
+        converter_kwargs['spill_rows'] = spill_rows
+    if split_size:
+        converter = SplittingManifestConverter(
+            sa_table, s3_config, split_size=split_size * 2**20, **converter_kwargs)
+    elif hybrid:
+        converter = HybridManifestConverter(sa_table, s3_config, **converter_kwargs)
+    else:
+        converter = ConcurrentManifestConverter(sa_table, s3_config, **converter_kwargs)
     converter.convert_manifest()
 
 
+@cli.command()
+@click.argument('s3_path')
+@click.option('--queue-url', required=True, help='SqlAlchemy URL of the work queue database')
+@click.option('--job-id', help='Defaults to the manifest path')
+@click.option('--wait', is_flag=True, help='Wait until every entry is converted')
+def convert_enqueue(s3_path, queue_url, job_id, wait):
+    """Queue a manifest for conversion by convert-worker processes"""
+    import time
+    from spectrify.workqueue import QueueManifestConverter, SqlWorkQueue
+    from spectrify.utils.s3 import SimpleS3Config
+
+    s3_config = SimpleS3Config.from_base_path(s3_path)
+    converter = QueueManifestConverter(None, s3_config, queue_url, job_id=job_id)
+    job_id = converter.enqueue_manifest()
+
+    queue = SqlWorkQueue.from_url(queue_url)
+    while wait and not queue.is_finished(job_id):
+        time.sleep(10)
+    click.echo('Job [{}]: {}'.format(job_id, queue.status(job_id)))
+
+
+@cli.command()
+@click.argument('table')
+@click.argument('s3_path')
+@click.option('--queue-url', required=True, help='SqlAlchemy URL of the work queue database')
+@click.option('--job-id', help='Defaults to the manifest path')
+@click.option('--num-workers', type=int, help='Defaults to the number of CPUs')
+@click.option('--columns', help='Columns the CSVs were exported with (see export --columns)')
+@timestamp_unit_option
+@click.pass_context
+def convert_worker(ctx, table, s3_path, queue_url, job_id, num_workers, columns, timestamp_unit):
+    """Convert entries of a queued manifest until none are left"""
+    from spectrify.workqueue import QueueManifestConverter
+    from spectrify.utils.schema import CachedSchemaReader, get_projected_schema
+    from spectrify.utils.s3 import SimpleS3Config
+
+    engine = get_sa_engine(ctx)
+    sa_table = get_projected_schema(CachedSchemaReader(engine), table, columns)
+    s3_config = SimpleS3Config.from_base_path(s3_path)
+    converter = QueueManifestConverter(
+        sa_table, s3_config, queue_url, job_id=job_id, num_workers=num_workers, timestamp_unit=timestamp_unit)
+    num_converted = converter.convert_manifest()
+    click.echo('Converted {} files'.format(num_converted))
+
+
+@cli.command()
+@click.argument('table')
+@click.argument('s3_path')
+@click.option('--key', 'key_column', required=True, help='Column identifying rows, e.g. the primary key')
+@click.option('--changed-column', required=True, help='Column which increases whenever a row changes, e.g. updated_at')
+@click.option('--since', help='Value of --changed-column the existing files are current to (first merge only)')
+@click.option('--columns', help=COLUMNS_HELP)
+@timestamp_unit_option
+@click.pass_context
+def merge(ctx, table, s3_path, key_column, changed_column, since, columns, timestamp_unit):
+    """Merge rows changed since the last merge into the existing Parquet files"""
+    from spectrify.merge import IncrementalMerger
+    from spectrify.utils.schema import CachedSchemaReader, get_projected_schema, parse_column_list
+    from spectrify.utils.s3 import SimpleS3Config
+
+    engine = get_sa_engine(ctx)
+    sa_table = get_projected_schema(CachedSchemaReader(engine), table, columns)
+    s3_config = SimpleS3Config.from_base_path(s3_path)
+    merger = IncrementalMerger(
+        engine, table, sa_table, s3_config, key_column, changed_column, columns=parse_column_list(columns),
+        timestamp_unit=timestamp_unit)
+    merger.merge(since=since)
+
+
+@cli.command()
+@click.option('--bind', default='127.0.0.1', envvar='SPECTRIFY_SERVICE_HOST', help='Address of the HTTP API')
+@click.option('--port', type=int, default=8745, envvar='SPECTRIFY_SERVICE_PORT', help='Port of the HTTP API')
+@click.option('--num-workers', type=int, help='Defaults to the number of CPUs')
+@click.option('--watch', nargs=2, multiple=True, metavar='TABLE PREFIX',
+              help='Convert exports of TABLE as they appear under PREFIX (at PREFIX/<name>/csv/manifest)')
+@click.option('--watch-interval', type=int, default=60, envvar='SPECTRIFY_WATCH_SECONDS',
+              help='Seconds between listings of watched prefixes')
+@timestamp_unit_option
+@click.pass_context
+def serve(ctx, bind, port, num_workers, watch, watch_interval, timestamp_unit):
+    """Convert jobs submitted over HTTP, or found by watching prefixes, with a warm pool of workers"""
+    from spectrify.service import ConversionService, ManifestWatcher, make_server
+    from spectrify.utils.schema import CachedSchemaReader
+
+    engine = get_sa_engine(ctx)
+    with ConversionService(CachedSchemaReader(engine), num_workers=num_workers) as service:
+        watchers = [
+            ManifestWatcher(service, table, prefix, interval=watch_interval, timestamp_unit=timestamp_unit)
+            for table, prefix in watch
+        ]
+        for watcher in watchers:
+            watcher.start()
+        server = make_server(service, bind, port)
+        click.echo('Listening on http://{}:{}/'.format(bind, port))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            for watcher in watchers:
+                watcher.stop()
+
+
+@cli.command()
+@click.argument('table')
+@click.argument('s3_path')
+@click.option('--columns', help='Columns the CSVs were exported with (see export --columns)')
+@timestamp_unit_option
+@click.pass_context
+def verify(ctx, table, s3_path, columns, timestamp_unit):
+    """Check the converted Parquet files against the UNLOAD manifest"""
+    from spectrify.verify import ManifestVerifier
+    from spectrify.utils.schema import CachedSchemaReader, get_projected_schema
+    from spectrify.utils.s3 import SimpleS3Config
+
+    engine = get_sa_engine(ctx)
+    sa_table = get_projected_schema(CachedSchemaReader(engine), table, columns)
+    s3_config = SimpleS3Config.from_base_path(s3_path)
+    verifier = ManifestVerifier(sa_table, s3_config, timestamp_unit=timestamp_unit)
+    if verifier.log_results(verifier.verify()):
+        raise click.ClickException('Verification failed')
+
+
+@cli.command()
+@click.argument('table')
+@click.argument('s3_path')
+@click.option('--columns', help='Columns the CSVs were exported with (see export --columns)')
+@click.option('--sample-files', type=int, help='Number of data files to sample')
+@click.option('--sample-size', type=int, help='MB to read from each sampled file')
+@click.option('--compression', envvar='SPECTRIFY_COMPRESSION', default='gzip',
+              help='Parquet compression codec the conversion will use')
+@click.option('--split-size', type=int,
+              help='MB per byte range uncompressed CSVs will be converted in (default: SPECTRIFY_SPLIT_SIZE)')
+@click.option('--json', 'as_json', is_flag=True, help='Print the estimates as JSON')
+@dictionary_columns_option
+@timestamp_unit_option
+@click.pass_context
+def plan(ctx, table, s3_path, columns, sample_files, sample_size, compression, split_size, as_json,
+         dictionary_columns, timestamp_unit):
+    """Estimate conversion time, memory and output size from a sample of the export"""
+    import json
+    from spectrify.convert import SPECTRIFY_SPLIT_SIZE
+    from spectrify.plan import (
+        ConversionPlanner, SPECTRIFY_PLAN_SAMPLE_BYTES, SPECTRIFY_PLAN_SAMPLE_FILES, format_plan
+    )
+    from spectrify.utils.parquet import parse_dictionary_columns
+    from spectrify.utils.schema import CachedSchemaReader, get_projected_schema
+    from spectrify.utils.s3 import SimpleS3Config
+
+    engine = get_sa_engine(ctx)
+    sa_table = get_projected_schema(CachedSchemaReader(engine), table, columns)
+    s3_config = SimpleS3Config.from_base_path(s3_path)
+    planner = ConversionPlanner(
+        sa_table, s3_config,
+        sample_files=sample_files or SPECTRIFY_PLAN_SAMPLE_FILES,
+        sample_bytes=sample_size * 2**20 if sample_size else SPECTRIFY_PLAN_SAMPLE_BYTES,
+        compression=compression, dictionary_columns=parse_dictionary_columns(dictionary_columns),
+        split_size=split_size * 2**20 if split_size else SPECTRIFY_SPLIT_SIZE, timestamp_unit=timestamp_unit)
+    if as_json:
+        # Keep stdout parseable
+        planner.log = lambda msg: click.echo(msg, err=True)
+        click.echo(json.dumps(planner.plan(), indent=2, sort_keys=True))
+    else:
+        for line in format_plan(planner.plan()):
+            click.echo(line)
+
+
+@cli.command()
+@click.argument('s3_path')
+@click.option('--partition', multiple=True,
+              help='Only compact this partition (e.g. dt=2020-01-01).  May be repeated')
+@click.option('--target-size', type=int, help='Merge small files into files of about this many MB')
+@click.option('--compression', envvar='SPECTRIFY_COMPRESSION', default='gzip', help='Parquet compression codec')
+def compact(s3_path, partition, target_size, compression):
+    """Merge small Parquet files in the spectrum directory into larger ones"""
+    from spectrify.compact import ParquetCompactor, SPECTRIFY_COMPACT_TARGET_SIZE
+    from spectrify.utils.s3 import SimpleS3Config
+
+    s3_config = SimpleS3Config.from_base_path(s3_path)
+    compactor = ParquetCompactor(
+        s3_config,
+        target_size=target_size * 2**20 if target_size else SPECTRIFY_COMPACT_TARGET_SIZE,
+        compression=compression,
+    )
+    num_replaced = compactor.compact(partition)
+    click.echo('Replaced {} small files'.format(num_replaced))
+
+
 @cli.command()
 @click.argument('s3-path')
 @click.argument('source-table')
 @click.argument('dest-table')
 @click.option('--dest-schema', default='spectrum')
+@click.option('--columns', help='Columns the data was exported with (see export --columns)')
+@click.option('--no-stats', is_flag=True, help="Don't count rows to set the numRows table property")
 @click.pass_context
-def create_table(ctx, s3_path, source_table, dest_table, dest_schema):
+def create_table(ctx, s3_path, source_table, dest_table, dest_schema, columns, no_stats):
+    from spectrify.create import SpectrumTableCreator
+    from spectrify.utils.parquet import count_rows
+    from spectrify.utils.schema import CachedSchemaReader, get_projected_schema
+    from spectrify.utils.s3 import SimpleS3Config
+
     click.echo('Create Spectrum table')
     engine = get_sa_engine(ctx)
-    sa_table = SqlAlchemySchemaReader(engine).get_table_schema(source_table)
+    sa_table = get_projected_schema(CachedSchemaReader(engine), source_table, columns)
     s3_config = SimpleS3Config.from_base_path(s3_path)
+    num_rows = None if no_stats else count_rows(s3_config, s3_config.get_spectrum_dir())[0]
 
     table_creator = SpectrumTableCreator(
         engine,
         dest_schema,
         dest_table,
         sa_table,
-        s3_config
+        s3_config,
+        num_rows=num_rows
     )
     table_creator.log_query()
     table_creator.confirm()
@@ -90,6 +384,35 @@ def create_table(ctx, s3_path, source_table, dest_table, dest_schema):
 
 
 @cli.command()
+@click.argument('tables', nargs=-1, required=True)
 @click.pass_context
-def add_part():
-    click.echo('TODO: Add Spectrum partition')
+def cache_schemas(ctx, tables):
+    """Reflect many tables at once and store their schemas in the local cache"""
+    from spectrify.utils.schema import CachedSchemaReader
+
+    engine = get_sa_engine(ctx)
+    sa_tables = CachedSchemaReader(engine).get_table_schemas(tables)
+    click.echo('Cached schemas of {} tables'.format(len(sa_tables)))
+
+
+@cli.command()
+@click.argument('s3_path')
+@click.argument('dest-table')
+@click.argument('partition')
+@click.option('--dest-schema', default='spectrum')
+@click.option('--no-stats', is_flag=True, help="Don't count rows to update the numRows table property")
+@click.pass_context
+def add_part(ctx, s3_path, dest_table, partition, dest_schema, no_stats):
+    """Register a partition directory (e.g. dt=2020-01-01) of a Spectrum table"""
+    from spectrify.create import SpectrumPartitionAdder
+    from spectrify.utils.parquet import count_rows
+    from spectrify.utils.s3 import SimpleS3Config
+
+    engine = get_sa_engine(ctx)
+    s3_config = SimpleS3Config.from_base_path(s3_path)
+    num_rows = None
+    if not no_stats:
+        num_rows, partition_rows = count_rows(s3_config, s3_config.get_spectrum_dir())
+        click.echo('Partition [{}] has {} of {} rows'.format(
+            partition, partition_rows.get(partition.strip('/'), 0), num_rows))
+    SpectrumPartitionAdder(engine, dest_schema, dest_table, s3_config, partition, num_rows=num_rows).add()
@@ -0,0 +1,277 @@
+"""Incremental merge of changed rows into existing Parquet files.
+
+Tables whose rows are updated in place (e.g. dimension tables) would
+otherwise have to be transformed again in full.  A merge unloads only the
+rows whose changed column (e.g. updated_at) is past the watermark of the last
+merge, and finds the files holding their keys with a key index kept in the
+spectrum directory.  Only those files are rewritten, with the old versions of
+the rows replaced; rows with new keys go to a new file.  The cost is in
+proportion to the changes, not to the table.
+
+The index (a Parquet file of key and file name) and the merge state (the
+watermark, and the files the index covers) are hidden from Spectrum by their
+leading underscore.  The index is rebuilt from the key column of every file
+if the files in the spectrum directory no longer match it, e.g. after a full
+transform or a compaction.
+
+An interrupted merge is finished by the next one: the upper bound of the
+changes is recorded before anything is rewritten, so the same rows are
+merged again, and merging a row twice gives the same result.  Deleted rows
+aren't seen by UNLOAD, so they aren't removed.  Only unpartitioned spectrum
+directories are supported.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import hashlib
+import json
+import uuid
+from datetime import date, datetime
+from os import path
+
+import click
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+import sqlalchemy as sa
+
+from spectrify.compact import plain_schema
+from spectrify.convert import SPECTRIFY_ROWS_PER_GROUP, ConcurrentManifestConverter
+from spectrify.export import RedshiftDataExporter, quote_column
+from spectrify.utils.parquet import SPECTRIFY_COMPRESSION, SPECTRIFY_TIMESTAMP_UNIT, is_data_file
+from spectrify.utils.s3 import MergeS3Config
+
+STATE_NAME = '_spectrify_merge.json'
+INDEX_NAME = '_spectrify_key_index.parq'
+
+# New rows are written to files named with this prefix
+INSERT_PREFIX = 'merged_'
+
+MAX_CHANGED_QUERY = 'select max({column}) from {table_name} where {column} > :watermark'
+
+INDEX_KEY = 'key'
+INDEX_FILE = 'file'
+
+
+def format_watermark(value):
+    """Returns a value of the changed column as it is stored in the merge state"""
+    if isinstance(value, datetime):
+        return value.isoformat(' ')
+    if isinstance(value, date):
+        return value.isoformat()
+    return str(value)
+
+
+def quote_literal(value):
+    # Redshift converts quoted literals to the type of the column compared
+    return "'{}'".format(value.replace("'", "''"))
+
+
+class IncrementalMerger(object):
+    def __init__(self, engine, table_name, sa_table, s3_config, key_column, changed_column, columns=None,
+                 timestamp_unit=SPECTRIFY_TIMESTAMP_UNIT, credentials=None):
+        self.engine = engine
+        self.table_name = table_name
+        self.sa_table = sa_table
+        self.s3_config = s3_config
+        self.key_column = key_column
+        # A column which increases whenever a row changes (e.g. updated_at)
+        self.changed_column = changed_column
+        self.columns = columns
+        self.timestamp_unit = timestamp_unit
+        self.credentials = credentials
+        # Changed rows are exported and converted outside the spectrum directory
+        self.merge_config = MergeS3Config(s3_config)
+
+    def log(self, msg):
+        """By default, we log to console with click"""
+        click.echo(msg)
+
+    def merge(self, since=None):
+        """Merges the rows changed since the last merge (or since `since`, a
+        value of the changed column the existing files are current to).
+        Returns a dict of counts.
+        """
+        state = self.read_state() or {}
+        if since is not None:
+            state = dict(state, watermark=since, pending=None)
+        if state.get('watermark') is None:
+            raise ValueError(
+                'No merge state in {}; pass since, the value of {} the existing files are current to'.format(
+                    self.get_state_path(), self.changed_column))
+
+        # An interrupted merge is repeated with the same upper bound
+        upper = state.get('pending') or self.get_max_changed(state['watermark'])
+        if upper is None:
+            self.log('No rows of [%s] changed since [%s]' % (self.table_name, state['watermark']))
+            return {'changed_rows': 0, 'updated_files': 0, 'inserted_rows': 0}
+        state['pending'] = upper
+        self.write_state(state)
+
+        self.log('Merging rows of [%s] with %s in (%s, %s]' % (
+            self.table_name, self.changed_column, state['watermark'], upper))
+        self.export_changes(state['watermark'], upper)
+        self.convert_changes()
+        changes = self.read_changes()
+
+        index = self.get_index(state)
+        counts = self.merge_changes(changes, index, self.get_insert_name(state['watermark'], upper))
+
+        self.write_state({
+            'key_column': self.key_column,
+            'changed_column': self.changed_column,
+            'watermark': upper,
+            'pending': None,
+            'files': self.list_data_files(),
+        })
+        self.log('Merged %(changed_rows)d changed rows: %(updated_files)d files rewritten, '
+                 '%(inserted_rows)d rows inserted' % counts)
+        return counts
+
+    def get_state_path(self):
+        return path.join(self.s3_config.get_spectrum_dir(), STATE_NAME)
+
+    def get_index_path(self):
+        return path.join(self.s3_config.get_spectrum_dir(), INDEX_NAME)
+
+    def read_state(self):
+        state_path = self.get_state_path()
+        if not self.s3_config.fs_exists(state_path):
+            return None
+        with self.s3_config.fs_open(state_path, 'rb') as state_file:
+            return json.loads(state_file.read().decode('utf-8'))
+
+    def write_state(self, state):
+        with self.s3_config.fs_open(self.get_state_path(), 'wb') as state_file:
+            state_file.write(json.dumps(state).encode('utf-8'))
+
+    def get_changed_predicate(self, watermark, upper):
+        column = quote_column(self.changed_column)
+        return '{column} > {watermark} and {column} <= {upper}'.format(
+            column=column, watermark=quote_literal(watermark), upper=quote_literal(upper))
+
+    def get_max_changed(self, watermark):
+        """Returns the upper bound of the changes to merge, or None if no rows changed"""
+        query = MAX_CHANGED_QUERY.format(column=quote_column(self.changed_column), table_name=self.table_name)
+        with self.engine.connect() as cursor:
+            value = cursor.execute(sa.text(query), {'watermark': watermark}).scalar()
+        return None if value is None else format_watermark(value)
+
+    def export_changes(self, watermark, upper):
+        exporter = RedshiftDataExporter(
+            self.engine, self.merge_config, columns=self.columns, where=self.get_changed_predicate(watermark, upper),
+            credentials=self.credentials)
+        exporter.export_to_csv(self.table_name)
+
+    def convert_changes(self):
+        # Files of an earlier merge would be read as changes
+        for name in self.list_data_files(self.merge_config.get_spectrum_dir()):
+            self.s3_config.fs_remove(path.join(self.merge_config.get_spectrum_dir(), name))
+        converter = ConcurrentManifestConverter(self.sa_table, self.merge_config, timestamp_unit=self.timestamp_unit)
+        converter.convert_manifest()
+
+    def list_data_files(self, dir_path=None):
+        dir_path = dir_path or self.s3_config.get_spectrum_dir()
+        if not self.s3_config.fs_exists(dir_path):
+            return []
+        return sorted(name for name in self.s3_config.fs_listdir(dir_path) if is_data_file(name))
+
+    def read_table(self, file_path, columns=None):
+        with self.s3_config.fs_open(file_path, 'rb') as parquet_file:
+            table = pq.read_table(parquet_file, columns=columns)
+        # Whether a column is dictionary encoded is decided per file
+        return table.cast(plain_schema(table.schema))
+
+    def read_changes(self):
+        """Returns the changed rows, with the last version of each key"""
+        changes_dir = self.merge_config.get_spectrum_dir()
+        tables = [self.read_table(path.join(changes_dir, name)) for name in self.list_data_files(changes_dir)]
+        if not tables:
+            return None
+        changes = pa.concat_tables(tables)
+
+        last_rows = {}
+        for i, key in enumerate(changes.column(self.key_column).to_pylist()):
+            last_rows[key] = i
+        if None in last_rows:
+            self.log('Skipping changed rows without a key')
+            del last_rows[None]
+        if len(last_rows) < changes.num_rows:
+            changes = changes.take(pa.array(sorted(last_rows.values()), pa.int64()))
+        return changes
+
+    def get_index(self, state):
+        """Returns the key index, rebuilding it unless it covers exactly the
+        files in the spectrum directory.
+        """
+        index_path = self.get_index_path()
+        if (state.get('key_column') == self.key_column and state.get('files') == self.list_data_files()
+                and self.s3_config.fs_exists(index_path)):
+            return self.read_table(index_path)
+        return self.build_index()
+
+    def build_index(self):
+        spectrum_dir = self.s3_config.get_spectrum_dir()
+        names = self.list_data_files()
+        self.log('Indexing [%s] of %d files in [%s]' % (self.key_column, len(names), spectrum_dir))
+        tables = []
+        for name in names:
+            keys = self.read_table(path.join(spectrum_dir, name), columns=[self.key_column]).column(0)
+            tables.append(pa.table([keys, pa.array([name] * len(keys), pa.string())], [INDEX_KEY, INDEX_FILE]))
+        if not tables:
+            return None
+        return pa.concat_tables(tables)
+
+    def get_insert_name(self, watermark, upper):
+        # Named after the changes, so a repeated merge overwrites the same file
+        token = hashlib.sha1('{}\0{}'.format(watermark, upper).encode('utf-8')).hexdigest()[:12]
+        return '{}{}.parq'.format(INSERT_PREFIX, token)
+
+    def merge_changes(self, changes, index, insert_name):
+        """Rewrites the files holding changed keys, and writes rows with new
+        keys to insert_name.  Returns a dict of counts.
+        """
+        counts = {'changed_rows': 0, 'updated_files': 0, 'inserted_rows': 0}
+        if changes is None or changes.num_rows == 0:
+            return counts
+        counts['changed_rows'] = changes.num_rows
+        changed_keys = changes.column(self.key_column)
+
+        key_files = {}
+        if index is not None:
+            affected = index.filter(pc.is_in(index.column(INDEX_KEY), value_set=changed_keys.combine_chunks()))
+            key_files = dict(zip(affected.column(INDEX_KEY).to_pylist(), affected.column(INDEX_FILE).to_pylist()))
+
+        # The file each changed row goes to
+        targets = [key_files.get(key, insert_name) for key in changed_keys.to_pylist()]
+        spectrum_dir = self.s3_config.get_spectrum_dir()
+        for name in sorted(set(targets)):
+            rows = changes.take(pa.array([i for i, target in enumerate(targets) if target == name], pa.int64()))
+            file_path = path.join(spectrum_dir, name)
+            if name == insert_name:
+                counts['inserted_rows'] = rows.num_rows
+                self.write_table(file_path, rows)
+                continue
+            existing = self.read_table(file_path)
+            keep = pc.invert(pc.is_in(existing.column(self.key_column), value_set=changed_keys.combine_chunks()))
+            self.write_table(file_path, pa.concat_tables([existing.filter(keep), rows.cast(existing.schema)]))
+            counts['updated_files'] += 1
+
+        self.write_index(index, changed_keys, targets)
+        return counts
+
+    def write_index(self, index, changed_keys, targets):
+        new_entries = pa.table([changed_keys, pa.array(targets, pa.string())], [INDEX_KEY, INDEX_FILE])
+        if index is not None:
+            kept = index.filter(pc.invert(pc.is_in(index.column(INDEX_KEY), value_set=changed_keys.combine_chunks())))
+            new_entries = pa.concat_tables([kept, new_entries.cast(kept.schema)])
+        self.write_table(self.get_index_path(), new_entries)
+
+    def write_table(self, file_path, table):
+        """Writes a table under a hidden name, then moves it into place"""
+        temp_path = path.join(path.dirname(file_path), '_spectrify_merge_{}.parq'.format(uuid.uuid4().hex[:12]))
+        # Timestamps read back as nanoseconds were stored as INT96
+        int96 = any(pa.types.is_timestamp(field.type) and field.type.unit == 'ns' for field in table.schema)
+        with self.s3_config.fs_open(temp_path, 'wb') as out_file:
+            pq.write_table(
+                table, out_file, row_group_size=int(SPECTRIFY_ROWS_PER_GROUP), compression=SPECTRIFY_COMPRESSION,
+                use_deprecated_int96_timestamps=int96)
+        self.s3_config.fs_move(temp_path, file_path)
@@ -0,0 +1,346 @@
+"""Estimates how long converting an export will take, how much memory each
+worker needs and how large the Parquet output will be, before committing to
+a long conversion.
+
+A few data files spread over the manifest are sampled: the first
+sample_bytes of each (as stored on S3) are parsed by the same CsvConverter
+code and encoded by the same Writer a conversion uses.  The measurements per
+row are scaled up to the number of rows in the whole export (from the
+manifest's record counts if it was written with MANIFEST VERBOSE, otherwise
+from the file sizes).
+"""
+from __future__ import absolute_import, division, print_function
+import math
+import resource
+import sys
+import time
+from io import BytesIO
+from multiprocessing import cpu_count
+from os import environ
+
+from spectrify.convert import COMPRESSED_EXTENSIONS, SPECTRIFY_ROWS_PER_GROUP, SPECTRIFY_SPLIT_SIZE, CsvConverter
+from spectrify.utils.parquet import SPECTRIFY_COMPRESSION, Writer, new_columns
+from spectrify.utils.s3 import plan_byte_ranges
+
+# Number of data files sampled, and how much of each (compressed size) is read
+SPECTRIFY_PLAN_SAMPLE_FILES = int(environ.get('SPECTRIFY_PLAN_SAMPLE_FILES') or 3)
+SPECTRIFY_PLAN_SAMPLE_BYTES = int(environ.get('SPECTRIFY_PLAN_SAMPLE_BYTES') or 8 * 2**20)  # 8MB
+
+# Codecs whose output size is estimated, in addition to SPECTRIFY_COMPRESSION
+SPECTRIFY_PLAN_CODECS = (environ.get('SPECTRIFY_PLAN_CODECS') or 'snappy,gzip,zstd').split(',')
+
+# The recommended row group size holds about this much data in Arrow memory.
+# Larger row groups compress better and scan faster, at the cost of memory.
+SPECTRIFY_PLAN_ROW_GROUP_BYTES = int(environ.get('SPECTRIFY_PLAN_ROW_GROUP_BYTES') or 128 * 2**20)  # 128MB
+
+MIN_ROWS_PER_GROUP = 10000
+MAX_ROWS_PER_GROUP = 1000000
+
+# While a row group is written, its Python values and its Arrow arrays are in
+# memory together, and encoding needs about as much again for pages
+ARROW_COPIES = 2
+
+
+class CountingFile(object):
+    """Wraps a file object, counting the bytes read from it"""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes_read = 0
+
+    def __getattr__(self, name):
+        if name == 'fileobj':
+            raise AttributeError(name)
+        return getattr(self.fileobj, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.fileobj.close()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.bytes_read += len(data)
+        return data
+
+
+class _SamplingS3Config(object):
+    """Wraps an S3Config, remembering the CountingFile of the last file opened"""
+
+    def __init__(self, s3_config):
+        self.s3_config = s3_config
+        self.last_file = None
+
+    def __getattr__(self, name):
+        if name == 's3_config':
+            raise AttributeError(name)
+        return getattr(self.s3_config, name)
+
+    def fs_open(self, path, mode='rb', cache=False, **kwargs):
+        # Samples read the start of a file, which the slice cache would
+        # download whole first
+        fileobj = self.s3_config.fs_open(path, mode, **kwargs)
+        if mode != 'rb':
+            return fileobj
+        self.last_file = CountingFile(fileobj)
+        return self.last_file
+
+
+class _SampleReader(object):
+    """Wraps a CSV reader of a compressed file, stopping at the first record
+    after max_bytes were read from the file.
+    """
+
+    def __init__(self, reader, counting_file, max_bytes):
+        self.reader = reader
+        self.counting_file = counting_file
+        self.max_bytes = max_bytes
+        self.exhausted = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.reader.close()
+
+    def __iter__(self):
+        for row in self.reader:
+            yield row
+            if self.counting_file.bytes_read >= self.max_bytes:
+                self.exhausted = False
+                return
+
+
+def python_size(columns):
+    """Approximate memory held by columnar Python values"""
+    return sum(
+        sys.getsizeof(col) + sum(sys.getsizeof(value) for value in col if value is not None)
+        for col in columns
+    )
+
+
+def get_max_rss():
+    """Peak resident memory of this process in bytes"""
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return max_rss if sys.platform == 'darwin' else max_rss * 1024
+
+
+class ConversionPlanner(CsvConverter):
+    def __init__(self, sa_table, s3_config, sample_files=SPECTRIFY_PLAN_SAMPLE_FILES,
+                 sample_bytes=SPECTRIFY_PLAN_SAMPLE_BYTES, codecs=SPECTRIFY_PLAN_CODECS,
+                 compression=SPECTRIFY_COMPRESSION, worker_counts=None, split_size=SPECTRIFY_SPLIT_SIZE, **kwargs):
+        """compression is the codec the conversion will use, which the time
+        estimates are based on.  worker_counts defaults to powers of two up to
+        the number of CPUs.  Uncompressed files are assumed to be converted in
+        byte ranges of split_size (see SplittingManifestConverter).
+        """
+        CsvConverter.__init__(self, sa_table, _SamplingS3Config(s3_config), **kwargs)
+        self.sample_files = sample_files
+        self.sample_bytes = sample_bytes
+        self.compression = compression
+        self.codecs = [compression] + [codec for codec in codecs if codec and codec != compression]
+        self.worker_counts = worker_counts or self.default_worker_counts()
+        self.split_size = split_size
+        self.sample_reader = None
+
+    def default_worker_counts(self):
+        num_cpus = cpu_count()
+        counts = []
+        count = 1
+        while count < num_cpus:
+            counts.append(count)
+            count *= 2
+        return counts + [num_cpus]
+
+    def get_csv_reader(self, data_path, byte_range=None):
+        reader = CsvConverter.get_csv_reader(self, data_path, byte_range)
+        if byte_range is not None:
+            # Byte ranges stop at the end of the sample by themselves
+            return reader
+        self.sample_reader = _SampleReader(reader, self.s3_config.last_file, self.sample_bytes)
+        return self.sample_reader
+
+    def plan(self):
+        """Returns the estimates as a dict (see format_plan)"""
+        base_rss = get_max_rss()
+        manifest = self.get_manifest()
+        entries = manifest['entries']
+        if not entries:
+            raise ValueError('The manifest has no entries')
+
+        sizes = [self.get_entry_size(entry) for entry in entries]
+        samples = [self.sample_entry(entry, size) for entry, size in self.choose_samples(entries, sizes)]
+
+        sample_rows = sum(sample['rows'] for sample in samples)
+        sample_bytes = sum(sample['bytes'] for sample in samples)
+        if not sample_rows:
+            raise ValueError('The sampled files have no rows')
+        rows_per_byte = sample_rows / sample_bytes
+
+        file_rows = []
+        task_rows = []
+        for entry, size in zip(entries, sizes):
+            record_count = entry.get('meta', {}).get('record_count')
+            file_rows.append(record_count if record_count is not None else int(round(size * rows_per_byte)))
+            task_rows.extend(self.split_rows(entry, size, file_rows[-1]))
+        total_rows = sum(file_rows)
+
+        python_bytes_per_row = sum(sample['python_bytes'] for sample in samples) / sample_rows
+        arrow_bytes_per_row = sum(sample['arrow_bytes'] for sample in samples) / sample_rows
+        seconds_per_row = sum(
+            sample['parse_seconds'] + sample['encode_seconds'][self.compression] for sample in samples
+        ) / sample_rows
+
+        current_rows_per_group = int(SPECTRIFY_ROWS_PER_GROUP)
+        recommended_rows_per_group = self.recommend_rows_per_group(arrow_bytes_per_row)
+        peak_rss = int(base_rss + current_rows_per_group * (python_bytes_per_row + ARROW_COPIES * arrow_bytes_per_row))
+
+        return {
+            'table': self.sa_table.name,
+            'files': len(entries),
+            'input_bytes': sum(sizes),
+            'estimated_rows': total_rows,
+            'sample': {
+                'files': len(samples),
+                'bytes': sample_bytes,
+                'rows': sample_rows,
+                'seconds': sum(sample['parse_seconds'] for sample in samples),
+            },
+            'rows_per_group': {
+                'current': current_rows_per_group,
+                'recommended': recommended_rows_per_group,
+            },
+            'peak_rss_per_worker': peak_rss,
+            'output_bytes': {
+                codec: int(total_rows * sum(sample['output_bytes'][codec] for sample in samples) / sample_rows)
+                for codec in self.codecs
+            },
+            'workers': [
+                {
+                    'workers': num_workers,
+                    'seconds': self.estimate_seconds(task_rows, seconds_per_row, num_workers),
+                    'peak_rss': num_workers * peak_rss,
+                }
+                for num_workers in self.worker_counts
+            ],
+        }
+
+    def get_entry_size(self, entry):
+        # Manifests written with UNLOAD ... MANIFEST VERBOSE include the file size
+        size = entry.get('meta', {}).get('content_length')
+        if size is None:
+            size = self.s3_config.fs_size(entry['url'])
+        return size
+
+    def choose_samples(self, entries, sizes):
+        """Returns (entry, size) pairs spread evenly over the manifest"""
+        num_samples = min(self.sample_files, len(entries))
+        indices = sorted(set(i * len(entries) // num_samples for i in range(num_samples)))
+        return [(entries[i], sizes[i]) for i in indices]
+
+    def sample_entry(self, entry, size):
+        url = entry['url']
+        self.log('Sampling [%s]' % url)
+        byte_range = None
+        if not url.endswith(COMPRESSED_EXTENSIONS):
+            byte_range = (0, min(size, self.sample_bytes))
+
+        start = time.time()
+        columns = new_columns(self.sa_table, self.dictionary_columns)
+        for chunk in self.columnar_data_chunks(url, self.sa_table, MAX_ROWS_PER_GROUP, byte_range=byte_range):
+            # Chunks are cleared once the next one is read
+            for column, values in zip(columns, chunk):
+                column.extend(values)
+        parse_seconds = time.time() - start
+
+        if byte_range is not None:
+            sampled_bytes = byte_range[1]
+        elif self.sample_reader.exhausted:
+            sampled_bytes = size
+        else:
+            sampled_bytes = self.sample_reader.counting_file.bytes_read
+
+        sample = {
+            'url': url,
+            'bytes': sampled_bytes,
+            'rows': len(columns[0]),
+            'parse_seconds': parse_seconds,
+            'python_bytes': python_size(columns),
+            'arrow_bytes': 0,
+            'encode_seconds': {},
+            'output_bytes': {},
+        }
+        for codec in self.codecs:
+            out_file = BytesIO()
+            start = time.time()
+            with Writer(out_file, self.sa_table, dictionary_columns=self.dictionary_columns,
+                        timestamp_unit=self.timestamp_unit, compression=codec) as writer:
+                batch = writer.to_record_batch(columns)
+                writer.write_batch(batch)
+            sample['encode_seconds'][codec] = time.time() - start
+            sample['output_bytes'][codec] = len(out_file.getvalue())
+            sample['arrow_bytes'] = batch.nbytes
+        return sample
+
+    def recommend_rows_per_group(self, arrow_bytes_per_row):
+        if not arrow_bytes_per_row:
+            return MAX_ROWS_PER_GROUP
+        rows = int(SPECTRIFY_PLAN_ROW_GROUP_BYTES / arrow_bytes_per_row) // MIN_ROWS_PER_GROUP * MIN_ROWS_PER_GROUP
+        return max(MIN_ROWS_PER_GROUP, min(MAX_ROWS_PER_GROUP, rows))
+
+    def split_rows(self, entry, size, num_rows):
+        """Returns the rows of each task a file is converted in: compressed
+        files are converted whole, uncompressed ones in byte ranges
+        """
+        if entry['url'].endswith(COMPRESSED_EXTENSIONS) or not size:
+            return [num_rows]
+        return [num_rows * (end - start) / size for start, end in plan_byte_ranges(size, self.split_size)]
+
+    def estimate_seconds(self, task_rows, seconds_per_row, num_workers):
+        """A task (a whole file, or a byte range) runs in one worker, so the
+        largest task bounds the wall time, and workers beyond the number of
+        CPUs don't add throughput.
+        """
+        parallelism = min(num_workers, cpu_count())
+        total_seconds = sum(task_rows) * seconds_per_row
+        return max(total_seconds / parallelism, max(task_rows) * seconds_per_row)
+
+
+def format_size(num_bytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if num_bytes < 1024:
+            return '{:.1f}{}'.format(num_bytes, unit)
+        num_bytes /= 1024
+    return '{:.1f}TB'.format(num_bytes)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(math.ceil(seconds)), 60)
+    hours, minutes = divmod(minutes, 60)
+    return '{:d}:{:02d}:{:02d}'.format(hours, minutes, seconds)
+
+
+def format_plan(plan):
+    """Returns the lines of a human-readable summary of a plan"""
+    sample = plan['sample']
+    lines = [
+        'Table:           {}'.format(plan['table']),
+        'Input:           {} files, {}'.format(plan['files'], format_size(plan['input_bytes'])),
+        'Estimated rows:  {:,}'.format(plan['estimated_rows']),
+        'Sampled:         {:,} rows ({}) from {} of {} files'.format(
+            sample['rows'], format_size(sample['bytes']), sample['files'], plan['files']),
+        'Rows per group:  {:,} (recommended {:,})'.format(
+            plan['rows_per_group']['current'], plan['rows_per_group']['recommended']),
+        'Peak RSS/worker: {}'.format(format_size(plan['peak_rss_per_worker'])),
+        '',
+        '{:<10} {:>12}'.format('Codec', 'Output size'),
+    ]
+    for codec, num_bytes in sorted(plan['output_bytes'].items(), key=lambda item: item[1]):
+        lines.append('{:<10} {:>12}'.format(codec, format_size(num_bytes)))
+    lines.extend(['', '{:>7} {:>12} {:>12}'.format('Workers', 'Wall time', 'Total RSS')])
+    for estimate in plan['workers']:
+        lines.append('{:>7} {:>12} {:>12}'.format(
+            estimate['workers'], format_duration(estimate['seconds']), format_size(estimate['peak_rss'])))
+    return lines
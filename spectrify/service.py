@@ -0,0 +1,431 @@
+"""A long-running conversion service with a warm pool of worker processes.
+
+Each `spectrify convert` starts a process, imports pyarrow and s3fs, creates
+a pool, reflects the table schema and sets up an S3 session before converting
+anything.  For small, frequent loads that overhead dominates.  The service
+pays it once: its pool processes import and connect when they start, and
+table schemas are cached for the life of the service.
+
+Jobs (a table, and the base path of an UNLOAD export) are submitted through a
+small HTTP API on a local port, or by a ManifestWatcher which polls a prefix
+for new exports.  The files of every job share the pool, and each job keeps
+metrics (files, rows, bytes, queue and conversion time) which the API reports.
+
+    POST /jobs        {"table": ..., "s3_path": ..., "columns": ..., "timestamp_unit": ...}
+    GET  /jobs        all jobs
+    GET  /jobs/<id>   one job
+    GET  /status      pool size and number of jobs per state
+
+"columns" (optional) selects the columns converted, either as a list of names
+or as a comma separated string.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+from spectrify.utils.compat import install_aliases
+install_aliases()  # noqa
+
+import functools
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from multiprocessing import Pool, cpu_count
+from os import environ
+from queue import Queue
+
+import click
+
+from spectrify.convert import CsvConverter
+from spectrify.utils.parquet import SPECTRIFY_TIMESTAMP_UNIT
+from spectrify.utils.schema import get_projected_schema, parse_column_list
+from spectrify.utils.s3 import SimpleS3Config
+
+# The HTTP API only listens locally unless told otherwise
+SPECTRIFY_SERVICE_HOST = environ.get('SPECTRIFY_SERVICE_HOST') or '127.0.0.1'
+SPECTRIFY_SERVICE_PORT = int(environ.get('SPECTRIFY_SERVICE_PORT') or 8745)
+
+# How often a ManifestWatcher lists its prefix
+SPECTRIFY_WATCH_SECONDS = int(environ.get('SPECTRIFY_WATCH_SECONDS') or 60)
+
+QUEUED = 'queued'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+_STOP = object()
+
+
+def _init_service_worker(warm_s3):
+    """Runs once in each pool process, so that jobs don't pay for imports and
+    S3 session setup.  s3fs caches filesystem instances, so the converters of
+    later jobs reuse the connected one.
+    """
+    import pyarrow.parquet  # noqa: F401
+    if warm_s3:
+        SimpleS3Config('', '').get_fs().connect()
+
+
+def _service_worker(arg_tuple):
+    """Converts one file of a job.  Errors are returned rather than raised, so
+    that the job (rather than the pool) records them.
+    """
+    url, sa_table, s3_config, converter_kwargs = arg_tuple
+    start = time.time()
+    try:
+        converter = CsvConverter(sa_table, s3_config, **converter_kwargs)
+        converter.convert_csv(url)
+        output_bytes = s3_config.fs_size(converter.get_output_path(url))
+    except Exception as e:
+        return {'url': url, 'error': '{}: {}'.format(e.__class__.__name__, e)}
+    return {'url': url, 'seconds': time.time() - start, 'output_bytes': output_bytes}
+
+
+class Job(object):
+    """A manifest converted by the service, and its metrics"""
+
+    def __init__(self, job_id, table, s3_path, columns=None, timestamp_unit=SPECTRIFY_TIMESTAMP_UNIT):
+        self.job_id = job_id
+        self.table = table
+        self.s3_path = s3_path
+        self.columns = columns
+        self.timestamp_unit = timestamp_unit
+        self.state = QUEUED
+        self.error = None
+        self.submitted_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self.files_total = 0
+        self.files_done = 0
+        self.files_failed = 0
+        self.rows = 0
+        self.input_bytes = 0
+        self.output_bytes = 0
+        # Summed over the pool's processes
+        self.convert_seconds = 0.0
+        self.lock = threading.Lock()
+        self.finished = threading.Event()
+
+    def start(self, entries):
+        with self.lock:
+            self.state = RUNNING
+            self.started_at = time.time()
+            self.files_total = len(entries)
+            for entry in entries:
+                # Manifests written with UNLOAD ... MANIFEST VERBOSE include these
+                meta = entry.get('meta', {})
+                self.rows += meta.get('record_count', 0)
+                self.input_bytes += meta.get('content_length', 0)
+        if not entries:
+            self.finish()
+
+    def file_done(self, result):
+        with self.lock:
+            if 'error' in result:
+                self.files_failed += 1
+                self.error = self.error or '{}: {}'.format(result['url'], result['error'])
+            else:
+                self.files_done += 1
+                self.output_bytes += result['output_bytes']
+                self.convert_seconds += result['seconds']
+            finished = self.files_done + self.files_failed == self.files_total
+        if finished:
+            self.finish()
+
+    def fail(self, error):
+        with self.lock:
+            self.error = error
+        self.finish()
+
+    def finish(self):
+        with self.lock:
+            self.state = FAILED if self.error else DONE
+            self.finished_at = time.time()
+        self.finished.set()
+
+    def wait(self, timeout=None):
+        """Returns True once the job has finished"""
+        return self.finished.wait(timeout)
+
+    def to_dict(self):
+        with self.lock:
+            now = time.time()
+            started_at = self.started_at or now
+            wall_seconds = (self.finished_at or now) - started_at if self.started_at else 0.0
+            return {
+                'job_id': self.job_id,
+                'table': self.table,
+                's3_path': self.s3_path,
+                'state': self.state,
+                'error': self.error,
+                'files_total': self.files_total,
+                'files_done': self.files_done,
+                'files_failed': self.files_failed,
+                'rows': self.rows,
+                'input_bytes': self.input_bytes,
+                'output_bytes': self.output_bytes,
+                'queue_seconds': started_at - self.submitted_at,
+                'wall_seconds': wall_seconds,
+                'convert_seconds': self.convert_seconds,
+                'rows_per_second': self.rows / wall_seconds if wall_seconds else None,
+            }
+
+
+class ConversionService(object):
+    """Converts submitted jobs with a pool of warm worker processes.  Jobs are
+    prepared (schema and manifest read) in turn by a dispatcher thread; their
+    files are then converted by the pool alongside those of other jobs.
+    """
+
+    def __init__(self, schema_reader, num_workers=None, warm_s3=True, **converter_kwargs):
+        self.schema_reader = schema_reader
+        self.num_workers = num_workers or cpu_count()
+        self.warm_s3 = warm_s3
+        self.converter_kwargs = converter_kwargs
+        self.jobs = {}
+        self.job_ids = itertools.count(1)
+        self.schemas = {}
+        self.lock = threading.Lock()
+        self.pending = Queue()
+        self.pool = None
+        self.dispatcher = None
+
+    def log(self, msg):
+        """By default, we log to console with click"""
+        click.echo(msg)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    def start(self):
+        self.pool = Pool(self.num_workers, initializer=_init_service_worker, initargs=(self.warm_s3,))
+        self.dispatcher = threading.Thread(target=self.run_dispatcher)
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+        self.log('Started conversion service with %d workers' % self.num_workers)
+
+    def stop(self):
+        """Waits for the submitted jobs to finish, then stops the pool"""
+        self.pending.put(_STOP)
+        self.dispatcher.join()
+        self.pool.close()
+        self.pool.join()
+
+    def submit(self, table, s3_path, columns=None, timestamp_unit=SPECTRIFY_TIMESTAMP_UNIT):
+        with self.lock:
+            job = Job(str(next(self.job_ids)), table, s3_path, columns, timestamp_unit)
+            self.jobs[job.job_id] = job
+        self.log('Job [%s]: queued [%s] from [%s]' % (job.job_id, table, s3_path))
+        self.pending.put(job)
+        return job
+
+    def get_job(self, job_id):
+        with self.lock:
+            return self.jobs.get(job_id)
+
+    def list_jobs(self):
+        with self.lock:
+            jobs = list(self.jobs.values())
+        return sorted(jobs, key=lambda job: int(job.job_id))
+
+    def status(self):
+        states = {}
+        for job in self.list_jobs():
+            states[job.state] = states.get(job.state, 0) + 1
+        return {'num_workers': self.num_workers, 'jobs': states}
+
+    def get_s3_config(self, s3_path):
+        return SimpleS3Config.from_base_path(s3_path)
+
+    def get_table_schema(self, table, columns=None):
+        """Table schemas are reflected once per service"""
+        key = (table, tuple(parse_column_list(columns) or ()))
+        if key not in self.schemas:
+            self.schemas[key] = get_projected_schema(self.schema_reader, table, columns)
+        return self.schemas[key]
+
+    def run_dispatcher(self):
+        while True:
+            job = self.pending.get()
+            if job is _STOP:
+                break
+            try:
+                self.start_job(job)
+            except Exception as e:
+                job.fail('{}: {}'.format(e.__class__.__name__, e))
+                self.log_job(job)
+
+        # Let the jobs already in the pool finish
+        for job in self.list_jobs():
+            job.wait()
+
+    def start_job(self, job):
+        sa_table = self.get_table_schema(job.table, job.columns)
+        s3_config = self.get_s3_config(job.s3_path)
+        converter_kwargs = dict(self.converter_kwargs, timestamp_unit=job.timestamp_unit)
+        converter = CsvConverter(sa_table, s3_config, **converter_kwargs)
+        entries = converter.get_manifest()['entries']
+        job.start(entries)
+        if job.finished.is_set():
+            self.log_job(job)
+            return
+
+        callback = functools.partial(self.on_file_done, job)
+        for entry in entries:
+            self.pool.apply_async(
+                _service_worker, ((entry['url'], sa_table, s3_config, converter_kwargs),), callback=callback)
+
+    def on_file_done(self, job, result):
+        job.file_done(result)
+        if job.finished.is_set():
+            self.log_job(job)
+
+    def log_job(self, job):
+        metrics = job.to_dict()
+        if metrics['state'] == FAILED:
+            self.log('Job [%s]: failed: %s' % (job.job_id, metrics['error']))
+            return
+        self.log('Job [%s]: converted %d files, %d rows, %d bytes in %.1fs (%.1fs queued)' % (
+            job.job_id, metrics['files_done'], metrics['rows'], metrics['output_bytes'],
+            metrics['wall_seconds'], metrics['queue_seconds']))
+
+
+class ManifestWatcher(object):
+    """Submits a job for every export which appears under prefix, at
+    <prefix>/<name>/csv/manifest (the layout of SimpleS3Config).  A manifest
+    is converted again if it is overwritten.  Exports which are already there
+    when the watcher starts are skipped, unless include_existing is set.
+    """
+
+    def __init__(self, service, table, prefix, interval=SPECTRIFY_WATCH_SECONDS, columns=None,
+                 timestamp_unit=SPECTRIFY_TIMESTAMP_UNIT, include_existing=False):
+        self.service = service
+        self.table = table
+        self.prefix = prefix.rstrip('/')
+        self.interval = interval
+        self.columns = columns
+        self.timestamp_unit = timestamp_unit
+        self.seen = set() if include_existing else set(self.list_manifests())
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def list_manifests(self):
+        """Returns (path, version) pairs for the manifests under the prefix"""
+        fs = self.service.get_s3_config(self.prefix).get_fs()
+        # s3fs keeps listings until told otherwise, and get_fs returns the
+        # same instance each time, so we'd keep seeing the first listing
+        fs.invalidate_cache(self.prefix)
+        found = fs.glob(self.prefix + '/*/csv/manifest', detail=True)
+        manifests = []
+        for manifest_path, info in found.items():
+            version = info.get('ETag') or info.get('LastModified') or info.get('mtime')
+            manifests.append((manifest_path, str(version)))
+        return manifests
+
+    def get_s3_path(self, manifest_path):
+        base_path = manifest_path[:-len('/csv/manifest')]
+        if '://' in self.prefix and '://' not in base_path:
+            base_path = self.prefix.split('://', 1)[0] + '://' + base_path
+        return base_path
+
+    def poll(self):
+        """Submits jobs for new manifests.  Returns the jobs submitted"""
+        jobs = []
+        for manifest in sorted(self.list_manifests()):
+            if manifest in self.seen:
+                continue
+            self.seen.add(manifest)
+            jobs.append(self.service.submit(
+                self.table, self.get_s3_path(manifest[0]), self.columns, self.timestamp_unit))
+        return jobs
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.poll()
+            except Exception as e:
+                self.service.log('Failed to list [%s]: %s' % (self.prefix, e))
+            self.stopped.wait(self.interval)
+
+
+def get_columns(request):
+    """Returns the columns of a job request as a tuple of names, or the
+    comma separated string given
+    """
+    columns = request.get('columns')
+    if not columns:
+        return None
+    # JSON strings are unicode on Python 2 too
+    text_type = type('')
+    if isinstance(columns, text_type):
+        return columns
+    if isinstance(columns, list) and all(isinstance(name, text_type) for name in columns):
+        return tuple(columns)
+    raise TypeError('columns must be a list of names or a comma separated string')
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    """The HTTP API of a ConversionService (see the module docstring)"""
+
+    def do_GET(self):
+        service = self.server.service
+        parts = self.path.strip('/').split('/')
+        if parts == ['status']:
+            self.send_json(200, service.status())
+        elif parts == ['jobs']:
+            self.send_json(200, [job.to_dict() for job in service.list_jobs()])
+        elif len(parts) == 2 and parts[0] == 'jobs':
+            job = service.get_job(parts[1])
+            if job is None:
+                self.send_json(404, {'error': 'No job {}'.format(parts[1])})
+            else:
+                self.send_json(200, job.to_dict())
+        else:
+            self.send_json(404, {'error': 'Not found'})
+
+    def do_POST(self):
+        if self.path.strip('/') != 'jobs':
+            self.send_json(404, {'error': 'Not found'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length).decode('utf-8'))
+            table = request['table']
+            s3_path = request['s3_path']
+            columns = get_columns(request)
+        except (ValueError, KeyError, TypeError) as e:
+            self.send_json(400, {'error': 'Expected a JSON object with table and s3_path ({})'.format(e)})
+            return
+        job = self.server.service.submit(
+            table, s3_path, columns, request.get('timestamp_unit') or SPECTRIFY_TIMESTAMP_UNIT)
+        self.send_json(202, job.to_dict())
+
+    def send_json(self, code, obj):
+        body = json.dumps(obj).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        self.server.service.log('%s - %s' % (self.address_string(), format % args))
+
+
+def make_server(service, host=SPECTRIFY_SERVICE_HOST, port=SPECTRIFY_SERVICE_PORT):
+    server = HTTPServer((host, port), ServiceRequestHandler)
+    server.service = service
+    return server
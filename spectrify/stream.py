@@ -0,0 +1,203 @@
+"""Streams a table straight from Redshift into Parquet files in the spectrum
+location, without going through UNLOAD and CSV files on S3.
+
+For small and medium tables, the fixed costs of UNLOAD (and of downloading and
+parsing the CSVs) outweigh the cost of moving the data itself.  Rows are read
+with a server-side cursor in batches, and each batch is written as a row group
+by the same Writer the CSV converters use.
+
+The files are written under hidden names, and only once the stream is done
+are the data files of an earlier transform removed and the new files moved
+into place, so that Spectrum never sees rows of both.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+from os import environ, path
+
+import click
+import sqlalchemy as sa
+
+from spectrify.utils.parquet import SPECTRIFY_TIMESTAMP_UNIT, Writer, is_data_file, new_columns
+from spectrify.utils.schema import split_table_name
+
+# Tables up to this size (in MB of row data, estimated from the number of rows
+# selected and the declared widths of the columns selected) are streamed by
+# `spectrify transform` unless told otherwise.  Set to 0 to always UNLOAD.
+SPECTRIFY_STREAM_MAX_MB = int(environ.get('SPECTRIFY_STREAM_MAX_MB') or 256)
+
+# Rows fetched from the cursor (and written as one row group) at a time
+SPECTRIFY_STREAM_BATCH_SIZE = int(environ.get('SPECTRIFY_STREAM_BATCH_SIZE') or 250000)
+
+# A new Parquet file is started after this many rows, so that Spectrum can
+# scan a streamed table in parallel
+SPECTRIFY_STREAM_ROWS_PER_FILE = int(environ.get('SPECTRIFY_STREAM_ROWS_PER_FILE') or 10000000)
+
+# svv_table_info reports size in 1 MB blocks
+TABLE_SIZE_QUERY = sa.text("""
+select size from svv_table_info
+where "schema" = :schema_name and "table" = :table_name
+""")
+
+COUNT_QUERY = 'select count(*) from {table_name}'
+
+STREAM_PREFIX = 'stream_'
+
+# Redshift's width for VARCHAR columns declared without a length
+DEFAULT_STRING_WIDTH = 256
+
+
+def get_table_size_mb(engine, table_name):
+    """Returns the size of a Redshift table in MB, or None if it is unknown
+    (e.g. the table is empty, or the database isn't Redshift).  This is the
+    compressed size on disk, of all columns and rows.
+    """
+    schema_name, bare_name = split_table_name(table_name)
+    try:
+        with engine.connect() as cursor:
+            row = cursor.execute(TABLE_SIZE_QUERY, {
+                'schema_name': schema_name or 'public',
+                'table_name': bare_name,
+            }).first()
+    except sa.exc.DBAPIError:
+        return None
+    return row[0] if row else None
+
+
+def get_column_width(sa_type):
+    """Returns the width in bytes of a value of sa_type, at most"""
+    if isinstance(sa_type, sa.String):
+        return sa_type.length or DEFAULT_STRING_WIDTH
+    if isinstance(sa_type, sa.Boolean):
+        return 1
+    if isinstance(sa_type, sa.SmallInteger):
+        return 2
+    if isinstance(sa_type, sa.BigInteger):
+        return 8
+    if isinstance(sa_type, (sa.Integer, sa.Date)):
+        return 4
+    if isinstance(sa_type, sa.Float):
+        return 8
+    if isinstance(sa_type, sa.Numeric):
+        return 16 if (sa_type.precision or 0) > 18 else 8
+    return 8
+
+
+def get_row_width(sa_table):
+    return sum(get_column_width(column.type) for column in sa_table.columns)
+
+
+def count_selected_rows(engine, table_name, where=None):
+    """Returns the number of rows the where predicate selects, or None if
+    they can't be counted
+    """
+    query = COUNT_QUERY.format(table_name=table_name)
+    if where:
+        query += ' where ' + where
+    try:
+        with engine.connect() as cursor:
+            return cursor.execute(sa.text(query)).scalar()
+    except sa.exc.DBAPIError:
+        return None
+
+
+def estimate_size_mb(engine, table_name, sa_table, where=None):
+    """Returns the estimated size in MB of the rows and columns to be
+    streamed (sa_table is the projected table), or None if it is unknown
+    """
+    num_rows = count_selected_rows(engine, table_name, where)
+    if num_rows is None:
+        return None
+    return num_rows * get_row_width(sa_table) / (1024 * 1024)
+
+
+def should_stream(engine, table_name, sa_table, where=None, max_mb=SPECTRIFY_STREAM_MAX_MB):
+    size = estimate_size_mb(engine, table_name, sa_table, where)
+    return size is not None and size <= max_mb
+
+
+class RedshiftStreamer(object):
+    """Writes the rows of sa_table (optionally filtered by a where predicate)
+    to Parquet files in the spectrum location.
+    """
+
+    def __init__(self, engine, sa_table, s3_config, where=None, batch_size=SPECTRIFY_STREAM_BATCH_SIZE,
+                 rows_per_file=SPECTRIFY_STREAM_ROWS_PER_FILE, dictionary_columns=None,
+                 timestamp_unit=SPECTRIFY_TIMESTAMP_UNIT):
+        self.engine = engine
+        self.sa_table = sa_table
+        self.s3_config = s3_config
+        self.where = where
+        self.batch_size = batch_size
+        self.rows_per_file = rows_per_file
+        self.dictionary_columns = dictionary_columns
+        self.timestamp_unit = timestamp_unit
+
+    def log(self, msg):
+        """By default, we log to console with click"""
+        click.echo(msg)
+
+    def get_query(self):
+        query = self.sa_table.select()
+        if self.where:
+            query = query.where(sa.text(self.where))
+        return query
+
+    def get_output_path(self, file_number):
+        return path.join(self.s3_config.get_spectrum_dir(), '{}{:04d}.parq'.format(STREAM_PREFIX, file_number))
+
+    def get_temp_path(self, file_number):
+        # Hidden from Spectrum until the stream is done
+        return path.join(self.s3_config.get_spectrum_dir(), '_' + path.basename(self.get_output_path(file_number)))
+
+    def get_writer(self, py_fd):
+        return Writer(
+            py_fd, self.sa_table, dictionary_columns=self.dictionary_columns, timestamp_unit=self.timestamp_unit)
+
+    def stream(self):
+        """Returns the number of rows written"""
+        num_rows = 0
+        with self.engine.connect() as cursor:
+            result = cursor.execution_options(stream_results=True).execute(self.get_query())
+            batches = self.columnar_batches(result)
+
+            file_number = 0
+            batch = next(batches, None)
+            # Always write at least one file, so that an empty table has a schema
+            while file_number == 0 or batch is not None:
+                self.log('Streaming table [%s] to [%s]' % (self.sa_table.name, self.get_output_path(file_number)))
+                file_rows = 0
+                with self.s3_config.fs_open(self.get_temp_path(file_number), 'wb') as s3_file:
+                    with self.get_writer(s3_file) as writer:
+                        if batch is None:
+                            writer.write_row_group([[] for _ in self.sa_table.columns])
+                        while batch is not None and file_rows < self.rows_per_file:
+                            writer.write_row_group(batch)
+                            file_rows += len(batch[0])
+                            batch = next(batches, None)
+                num_rows += file_rows
+                file_number += 1
+
+        self.replace_data_files(file_number)
+        self.log('Done streaming %d rows of table [%s]' % (num_rows, self.sa_table.name))
+        return num_rows
+
+    def replace_data_files(self, num_files):
+        """Removes the data files of an earlier transform (UNLOAD or stream),
+        then moves the streamed files into place
+        """
+        spectrum_dir = self.s3_config.get_spectrum_dir()
+        for name in sorted(self.s3_config.fs_listdir(spectrum_dir)):
+            if is_data_file(name):
+                self.s3_config.fs_remove(path.join(spectrum_dir, name))
+        for file_number in range(num_files):
+            self.s3_config.fs_move(self.get_temp_path(file_number), self.get_output_path(file_number))
+
+    def columnar_batches(self, result):
+        """Yields batches of up to batch_size rows in columnar format"""
+        while True:
+            rows = result.fetchmany(self.batch_size)
+            if not rows:
+                return
+            columns = new_columns(self.sa_table, self.dictionary_columns)
+            for column, values in zip(columns, zip(*rows)):
+                column.extend(values)
+            yield columns
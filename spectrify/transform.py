@@ -1,40 +1,136 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
+from multiprocessing import cpu_count
+from os import path
 
 from spectrify.convert import ConcurrentManifestConverter
 from spectrify.create import SpectrumTableCreator
-from spectrify.export import RedshiftDataExporter
-from spectrify.utils.schema import SqlAlchemySchemaReader
+from spectrify.export import (
+    SPECTRIFY_UNLOAD_SHARDS, RedshiftDataExporter, ShardedRedshiftDataExporter, get_unload_layout
+)
+from spectrify.stream import RedshiftStreamer, should_stream
+from spectrify.utils.parquet import SPECTRIFY_TIMESTAMP_UNIT, count_rows, is_data_file
+from spectrify.utils.s3 import SHARD_PREFIX
+from spectrify.utils.schema import CachedSchemaReader, project_table
 
 
 class TableTransformer:
-    def __init__(self, engine, table_name, s3_config, spectrum_schema, spectrum_name):
+    def __init__(self, engine, table_name, s3_config, spectrum_schema, spectrum_name, columns=None, where=None,
+                 stream=None, timestamp_unit=SPECTRIFY_TIMESTAMP_UNIT, shard_column=None,
+                 num_shards=SPECTRIFY_UNLOAD_SHARDS, dictionary_columns=None):
         self.engine = engine
         self.table_name = table_name
         self.s3_config = s3_config
         self.spectrum_schema = spectrum_schema
         self.spectrum_name = spectrum_name
-        self.sa_table = SqlAlchemySchemaReader(engine).get_table_schema(table_name)
+        self.where = where
+        # Stream rows straight into Parquet instead of going through UNLOAD.
+        # None decides by the size of the rows selected (see SPECTRIFY_STREAM_MAX_MB)
+        self.stream = stream
+        self.timestamp_unit = timestamp_unit
+        # Export ranges of shard_column with separate UNLOADs, converting each
+        # as soon as it is exported (see ShardedRedshiftDataExporter)
+        self.shard_column = shard_column
+        self.num_shards = num_shards
+        # Maps string columns to True/False to force dictionary encoding on or off
+        self.dictionary_columns = dictionary_columns
+        # The whole table, which the UNLOAD layout is sized from
+        self.source_table = self.get_schema_reader().get_table_schema(table_name)
+        self.sa_table = self.source_table
+        if columns:
+            self.sa_table = project_table(self.source_table, columns)
+        self.columns = columns
+
+    def get_schema_reader(self):
+        return CachedSchemaReader(self.engine)
 
     def transform(self):
-        self.export_redshift_table()
-        self.convert_csv_data()
+        if self.should_stream():
+            self.stream_redshift_table()
+        elif self.shard_column:
+            self.export_and_convert_shards()
+        else:
+            self.export_redshift_table()
+            self.remove_stale_files(self.s3_config)
+            self.convert_csv_data()
         self.create_spectrum_table()
 
+    def should_stream(self):
+        if self.stream is None:
+            # Asking for a sharded export implies UNLOAD
+            return not self.shard_column and should_stream(self.engine, self.table_name, self.sa_table, self.where)
+        return self.stream
+
+    def stream_redshift_table(self):
+        streamer = RedshiftStreamer(
+            self.engine, self.sa_table, self.s3_config, where=self.where, dictionary_columns=self.dictionary_columns,
+            timestamp_unit=self.timestamp_unit)
+        streamer.stream()
+
+    def get_unload_layout(self, num_shards=1):
+        # Sized for the conversion, which uses a process per CPU
+        return get_unload_layout(
+            self.engine, self.table_name, cpu_count(), num_shards=num_shards, sa_table=self.source_table,
+            columns=self.columns, where=self.where)
+
     def export_redshift_table(self):
-        exporter = RedshiftDataExporter(self.engine, self.s3_config)
+        layout = self.get_unload_layout()
+        exporter = RedshiftDataExporter(
+            self.engine, self.s3_config, columns=self.columns, where=self.where, layout=layout)
         exporter.export_to_csv(self.table_name)
 
-    def convert_csv_data(self):
-        converter = ConcurrentManifestConverter(self.sa_table, self.s3_config)
-        converter.convert_manifest()
+    def get_sharded_exporter(self):
+        layout = self.get_unload_layout(self.num_shards)
+        return ShardedRedshiftDataExporter(
+            self.engine, self.s3_config, self.shard_column, num_shards=self.num_shards, columns=self.columns,
+            where=self.where, layout=layout)
+
+    def export_and_convert_shards(self):
+        exporter = self.get_sharded_exporter()
+        exporter.export_to_csv(self.table_name, on_shard_exported=self.convert_shard)
+        # The merged manifest lists every shard's files, so this only removes
+        # those of shards an earlier run had and this one didn't
+        self.remove_stale_files(self.s3_config)
+
+    def convert_shard(self, shard_config):
+        # The other shards' files may still be converting
+        shard_prefix = path.basename(shard_config.get_csv_dir())
+        self.remove_stale_files(
+            shard_config, lambda name: name.startswith(shard_prefix) or not name.startswith(SHARD_PREFIX))
+        self.convert_csv_data(shard_config)
+
+    def remove_stale_files(self, s3_config, is_candidate=lambda name: True):
+        """Removes the data files in the spectrum directory which converting
+        the manifest at s3_config won't overwrite.  Files of an earlier
+        transform which was streamed, sharded differently or unloaded to more
+        files would otherwise duplicate rows.
+        """
+        spectrum_dir = self.s3_config.get_spectrum_dir()
+        if not self.s3_config.fs_exists(spectrum_dir):
+            return
+        converter = self.get_converter(s3_config)
+        output_names = set(
+            path.basename(converter.get_output_path(entry['url'])) for entry in converter.get_manifest()['entries'])
+        for name in self.s3_config.fs_listdir(spectrum_dir):
+            if is_data_file(name) and is_candidate(name) and name not in output_names:
+                self.s3_config.fs_remove(path.join(spectrum_dir, name))
+
+    def get_converter(self, s3_config):
+        return ConcurrentManifestConverter(
+            self.sa_table, s3_config, dictionary_columns=self.dictionary_columns, timestamp_unit=self.timestamp_unit)
+
+    def convert_csv_data(self, s3_config=None):
+        self.get_converter(s3_config or self.s3_config).convert_manifest()
 
     def create_spectrum_table(self):
+        # Exact row count for the planner, from the footers of the files written
+        num_rows, _ = count_rows(self.s3_config, self.s3_config.get_spectrum_dir())
         table_creator = SpectrumTableCreator(
             self.engine,
             self.spectrum_schema,
             self.spectrum_name,
             self.sa_table,
-            self.s3_config
+            self.s3_config,
+            num_rows=num_rows
         )
         table_creator.log_query()
         table_creator.confirm()
@@ -0,0 +1,14 @@
+"""Python 2 compatibility helpers"""
+import sys
+
+PY2 = sys.version_info[0] < 3
+
+
+def install_aliases():
+    """Installs the `future` package's standard library aliases (urllib.parse,
+    http.server, etc.).  These are only needed on Python 2, and importing
+    `future` is not free, so on Python 3 this does nothing.
+    """
+    if PY2:
+        from future.standard_library import install_aliases as future_install_aliases
+        future_install_aliases()
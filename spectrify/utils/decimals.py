@@ -0,0 +1,94 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import struct
+from decimal import Decimal
+
+import pyarrow as pa
+
+# Arrow stores decimal128 values as 16 byte little-endian two's complement
+# integers: the low 64 bits (unsigned) followed by the high 64 bits (signed)
+_int128 = struct.Struct('<Qq')
+_UINT64_MASK = 2**64 - 1
+
+
+def parse_scaled_decimal(value, precision, scale):
+    """Parses a decimal string into an integer scaled by 10**scale
+
+        Arguments:
+        value: decimal string (or bytes) as exported by Redshift (e.g. "-123.45")
+        precision: total number of digits allowed by the column
+        scale: number of digits after the decimal point
+
+        Return Values:
+        int representing value * 10**scale (e.g. -12345 for a scale of 2)
+    """
+    if isinstance(value, bytes):
+        value = value.decode('ascii')
+    point = value.find('.')
+    try:
+        if point == -1:
+            scaled = int(value) * 10**scale
+        elif len(value) - point - 1 == scale:
+            # Redshift always writes out every digit of the scale
+            scaled = int(value.replace('.', '', 1))
+        else:
+            raise ValueError()
+    except ValueError:
+        # Unusual formatting (exponents, missing or extra digits); take the slow path
+        scaled_decimal = Decimal(value).scaleb(scale)
+        scaled = int(scaled_decimal)
+        if scaled != scaled_decimal:
+            raise ValueError('Decimal value {} has more than {} digits after the point'.format(value, scale))
+
+    if abs(scaled) >= 10**precision:
+        raise ValueError('Decimal value {} does not fit in DECIMAL({}, {})'.format(value, precision, scale))
+    return scaled
+
+
+def scaled_ints_to_decimal128_array(values, arrow_type):
+    """Builds an Arrow decimal128 array directly from scaled integers (see
+    parse_scaled_decimal) without creating Python Decimal objects.
+    None values are written as nulls.
+    """
+    num_values = len(values)
+    data = bytearray(16 * num_values)
+    validity = bytearray((num_values + 7) // 8)
+    null_count = 0
+    pack_into = _int128.pack_into
+
+    for i, value in enumerate(values):
+        if value is None:
+            null_count += 1
+            continue
+        pack_into(data, 16 * i, value & _UINT64_MASK, value >> 64)
+        validity[i >> 3] |= 1 << (i & 7)
+
+    validity_buffer = pa.py_buffer(validity) if null_count else None
+    return pa.Array.from_buffers(arrow_type, num_values, [validity_buffer, pa.py_buffer(data)], null_count)
+
+
+def strings_to_decimal128_array(values, arrow_type):
+    """Builds an Arrow decimal128 array from decimal strings (or None)
+
+        Arrow parses the strings straight into scaled 128-bit integers, checking
+        that each value fits the precision and scale of arrow_type.  Versions of
+        Arrow which can't cast strings to decimals fall back to parsing in
+        Python, which still avoids creating Decimal objects.
+    """
+    try:
+        return pa.array(values, pa.string()).cast(arrow_type)
+    except pa.ArrowNotImplementedError:
+        scaled = [
+            None if value is None else parse_scaled_decimal(value, arrow_type.precision, arrow_type.scale)
+            for value in values
+        ]
+        return scaled_ints_to_decimal128_array(scaled, arrow_type)
+
+
+def to_decimal128_array(values, arrow_type):
+    """Builds an Arrow decimal128 array from either decimal strings or
+    Decimal objects.
+    """
+    first_value = next((value for value in values if value is not None), None)
+    if isinstance(first_value, Decimal):
+        return pa.array(values, arrow_type)
+    return strings_to_decimal128_array(values, arrow_type)
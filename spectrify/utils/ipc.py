@@ -0,0 +1,57 @@
+"""Hands Arrow record batches from one process to another through memory
+mapped files, without serializing them.
+
+The producer writes a batch in the Arrow IPC format to a file in a RAM-backed
+directory, and passes only the file's path to the consumer (e.g. through a
+multiprocessing queue).  The consumer maps the file and reads the batch in
+place: its buffers point straight into the mapping, so nothing is copied or
+deserialized.  Compare this to pickling Python column lists, where both sides
+pay for every value (see benchmarks/ipc.py).
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import os
+import tempfile
+from os import environ, path
+
+import pyarrow as pa
+
+# Batches are written here.  /dev/shm keeps them in memory on Linux.
+SPECTRIFY_IPC_DIR = environ.get('SPECTRIFY_IPC_DIR') or (
+    '/dev/shm' if path.isdir('/dev/shm') else tempfile.gettempdir()
+)
+
+
+def put_batch(batch, ipc_dir=SPECTRIFY_IPC_DIR):
+    """Writes a record batch to a new file in ipc_dir.  Returns its path, which
+    the consumer passes to take_batch.
+    """
+    fd, batch_path = tempfile.mkstemp(prefix='spectrify-', suffix='.arrow', dir=ipc_dir)
+    os.close(fd)
+    try:
+        with pa.OSFile(batch_path, 'wb') as sink:
+            writer = pa.ipc.new_file(sink, batch.schema)
+            writer.write_batch(batch)
+            writer.close()
+    except Exception:
+        discard_batch(batch_path)
+        raise
+    return batch_path
+
+
+def take_batch(batch_path):
+    """Maps a batch written by put_batch.  The file is removed right away; the
+    mapping (and so the batch) stays valid until the batch is garbage collected.
+    """
+    try:
+        source = pa.memory_map(batch_path, 'r')
+        return pa.ipc.open_file(source).get_batch(0)
+    finally:
+        discard_batch(batch_path)
+
+
+def discard_batch(batch_path):
+    """Removes a batch which won't be taken (e.g. after an error)"""
+    try:
+        os.remove(batch_path)
+    except OSError:
+        pass
@@ -0,0 +1,81 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from os import environ
+
+# Maximum number of distinct values cached per column
+SPECTRIFY_MEMOIZE_SIZE = int(environ.get('SPECTRIFY_MEMOIZE_SIZE') or 4096)
+
+# Number of lookups after which memoization of a column is given up if the
+# hit rate is below SPECTRIFY_MEMOIZE_MIN_HIT_RATE
+SPECTRIFY_MEMOIZE_PROBE_SIZE = int(environ.get('SPECTRIFY_MEMOIZE_PROBE_SIZE') or 10000)
+SPECTRIFY_MEMOIZE_MIN_HIT_RATE = float(environ.get('SPECTRIFY_MEMOIZE_MIN_HIT_RATE') or 0.5)
+
+
+def _identity(value):
+    return value
+
+
+class MemoizedConverter(object):
+    """Wraps a conversion function with a bounded cache of converted values
+
+        Columns which repeat a small set of values (dates, status strings, etc.)
+        only pay for converting each distinct value once.  When the cache is
+        full, the oldest entry is evicted.  If the hit rate after the first
+        probe_size lookups is below min_hit_rate, the column is considered high
+        cardinality and memoization switches itself off.
+
+        Memoizing the identity function (func=None) doesn't save any conversion
+        work, but makes repeated strings share a single object.
+    """
+
+    def __init__(self, func=None, max_size=SPECTRIFY_MEMOIZE_SIZE, probe_size=SPECTRIFY_MEMOIZE_PROBE_SIZE,
+                 min_hit_rate=SPECTRIFY_MEMOIZE_MIN_HIT_RATE):
+        self.func = func or _identity
+        self.max_size = max_size
+        self.probe_size = probe_size
+        self.min_hit_rate = min_hit_rate
+        self.cache = {}
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __call__(self, value):
+        if not self.enabled:
+            return self.func(value)
+
+        try:
+            result = self.cache[value]
+            self.hits += 1
+            return result
+        except KeyError:
+            pass
+
+        result = self.func(value)
+        self.misses += 1
+        if len(self.cache) >= self.max_size:
+            del self.cache[next(iter(self.cache))]
+            self.evictions += 1
+        self.cache[value] = result
+
+        if self.misses + self.hits == self.probe_size and self.hit_rate < self.min_hit_rate:
+            self.enabled = False
+            self.cache = {}
+        return result
+
+    @property
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def clear(self):
+        """Empties the cache, keeping the statistics"""
+        self.cache = {}
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hit_rate,
+            'enabled': self.enabled,
+        }
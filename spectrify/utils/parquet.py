@@ -1,9 +1,79 @@
 import functools
+import os
+import tempfile
+from multiprocessing.pool import ThreadPool
+from os import environ, path
+
 import pyarrow as pa
 import pyarrow.parquet as pq
 import sqlalchemy as sa
 from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION, TIMESTAMP
 
+from spectrify.utils.decimals import to_decimal128_array
+
+# String columns whose first row group has at most this ratio of distinct
+# values to rows are written as Arrow dictionary arrays (see DictionaryColumn).
+# Set to 0 to disable.
+SPECTRIFY_DICTIONARY_RATIO = float(environ.get('SPECTRIFY_DICTIONARY_RATIO') or 0.1)
+
+# Number of values after which a string column with too many distinct values
+# stops being accumulated as dictionary indices
+SPECTRIFY_DICTIONARY_PROBE_SIZE = int(environ.get('SPECTRIFY_DICTIONARY_PROBE_SIZE') or 10000)
+
+# Parquet compression codec ('gzip', 'snappy', 'zstd', ...)
+SPECTRIFY_COMPRESSION = environ.get('SPECTRIFY_COMPRESSION') or 'gzip'
+
+# How timestamps are stored.  'int96' is the legacy 12 byte representation;
+# 'us' and 'ms' store 8 byte integers (micro or milliseconds since epoch) with
+# the TIMESTAMP logical type, which Spectrum also reads, and which get Parquet's
+# min/max statistics and integer encodings.
+SPECTRIFY_TIMESTAMP_UNIT = environ.get('SPECTRIFY_TIMESTAMP_UNIT') or 'int96'
+
+# Threads building the Arrow arrays of a row group's columns.  Casting decimal
+# strings and dictionary encoding release the GIL, so wide tables convert
+# faster with more threads.  With 1, columns are converted in turn.
+SPECTRIFY_WRITER_THREADS = int(environ.get('SPECTRIFY_WRITER_THREADS') or 1)
+
+# Footers are read with small ranged reads rather than whole blocks
+SPECTRIFY_FOOTER_BLOCKSIZE = int(environ.get('SPECTRIFY_FOOTER_BLOCKSIZE') or 2**16)
+
+# Number of footers read concurrently
+SPECTRIFY_FOOTER_THREADS = int(environ.get('SPECTRIFY_FOOTER_THREADS') or 16)
+
+# Row groups accumulated by a SpillingWriter are buffered here, on disk
+SPECTRIFY_SPILL_DIR = environ.get('SPECTRIFY_SPILL_DIR') or tempfile.gettempdir()
+
+PARQUET_EXTENSIONS = ('.parq', '.parquet')
+
+
+def parse_dictionary_columns(value):
+    """Parses a comma separated list of string columns to always dictionary
+    encode.  Columns prefixed with '-' are never dictionary encoded.  Returns
+    a mapping of column names to True/False, or None.
+    """
+    if not value:
+        return None
+    dictionary_columns = {}
+    for name in value.split(','):
+        name = name.strip()
+        if name.startswith('-'):
+            dictionary_columns[name[1:].strip()] = False
+        elif name:
+            dictionary_columns[name] = True
+    return dictionary_columns
+
+
+# Columns to force dictionary encoding on or off for (see
+# parse_dictionary_columns), e.g. 'status,country,-comment'
+SPECTRIFY_DICTIONARY_COLUMNS = parse_dictionary_columns(environ.get('SPECTRIFY_DICTIONARY_COLUMNS'))
+
+# Arrow timestamp unit for each storage mode
+TIMESTAMP_UNITS = {
+    'int96': 'ns',
+    'us': 'us',
+    'ms': 'ms',
+}
+
 
 def _pa_timestamp_ns():
     """Wrapper function around Arrow's timestamp type function, which is the
@@ -12,6 +82,157 @@ def _pa_timestamp_ns():
     return pa.timestamp('ns')
 
 
+def is_data_file(name):
+    # Spectrum skips hidden files, and so do we
+    return name.endswith(PARQUET_EXTENSIONS) and not name.startswith(('_', '.'))
+
+
+def is_partition_dir(name):
+    # Spectrum partitions are laid out Hive-style (e.g. dt=2020-01-01)
+    return '=' in name and not name.startswith(('_', '.'))
+
+
+def find_partition_dirs(s3_config, dir_path):
+    """Returns dir_path and the partition directories below it, recursively.
+    Listings are refreshed, since files may have been written since the
+    directory was last listed (e.g. by pool processes).
+    """
+    dirs = [dir_path]
+    for name in s3_config.fs_listdir(dir_path, refresh=True):
+        if is_partition_dir(name):
+            dirs.extend(find_partition_dirs(s3_config, path.join(dir_path, name)))
+    return dirs
+
+
+def read_footer(s3_config, file_path):
+    """Returns the FileMetaData of a Parquet file, without reading its data"""
+    with s3_config.fs_open(file_path, 'rb', block_size=SPECTRIFY_FOOTER_BLOCKSIZE) as parquet_file:
+        return pq.ParquetFile(parquet_file).metadata
+
+
+def count_rows(s3_config, dir_path, num_threads=SPECTRIFY_FOOTER_THREADS):
+    """Counts the rows of the Parquet files in dir_path and its partitions from
+    their footers.  Returns the total, and a dict of partition (the path
+    relative to dir_path, e.g. "dt=2020-01-01") to row count.
+    """
+    file_paths = []
+    for partition_dir in find_partition_dirs(s3_config, dir_path):
+        # Refreshed by find_partition_dirs, with the sizes footers are read at
+        file_paths.extend(
+            path.join(partition_dir, name) for name in s3_config.fs_listdir(partition_dir) if is_data_file(name))
+
+    pool = ThreadPool(num_threads)
+    try:
+        counts = pool.map(lambda file_path: read_footer(s3_config, file_path).num_rows, file_paths)
+    finally:
+        pool.close()
+        pool.join()
+
+    partition_counts = {}
+    for file_path, num_rows in zip(file_paths, counts):
+        partition = path.relpath(path.dirname(file_path), dir_path)
+        if partition != '.':
+            partition_counts[partition] = partition_counts.get(partition, 0) + num_rows
+    return sum(counts), partition_counts
+
+
+class DictionaryColumn(object):
+    """A string column accumulated as dictionary indices
+
+    Each value appended is looked up in a dict of the distinct values seen so
+    far, and only its index is kept, so repeated values aren't held again and
+    the Writer builds a DictionaryArray without hashing the column a second
+    time.  Unless encode is True, a column with more than ratio distinct
+    values per row after probe_size values stops looking values up, and holds
+    them plainly from then on.
+    """
+
+    def __init__(self, encode=None, ratio=SPECTRIFY_DICTIONARY_RATIO, probe_size=SPECTRIFY_DICTIONARY_PROBE_SIZE):
+        self.encode = encode
+        self.ratio = ratio
+        self.probe_size = probe_size
+        self.clear()
+
+    def __len__(self):
+        return len(self.indices) if self.plain is None else len(self.plain)
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def empty(self):
+        """Returns a new, empty column with the same settings"""
+        return DictionaryColumn(self.encode, self.ratio, self.probe_size)
+
+    def clear(self):
+        self.indices = []
+        self.values = []
+        self.lookup = {}
+        self.plain = None
+
+    def append(self, value):
+        if self.plain is not None:
+            self.plain.append(value)
+            return
+        if value is None:
+            self.indices.append(None)
+            return
+        index = self.lookup.get(value)
+        if index is None:
+            index = len(self.values)
+            if not self.encode and len(self.indices) >= self.probe_size and index > self.ratio * len(self.indices):
+                self.plain = self.to_list()
+                self.plain.append(value)
+                self.indices = self.values = None
+                self.lookup = {}
+                return
+            self.lookup[value] = index
+            self.values.append(value)
+        self.indices.append(index)
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def to_list(self):
+        if self.plain is not None:
+            return list(self.plain)
+        values = self.values
+        return [None if index is None else values[index] for index in self.indices]
+
+    def is_low_cardinality(self):
+        if self.plain is not None or not self.indices:
+            return False
+        return len(self.values) <= self.ratio * len(self.indices)
+
+    def to_arrow(self, arrow_type, encode):
+        """Returns a DictionaryArray if encode, else a plain array"""
+        if self.plain is not None:
+            arr = pa.array(self.plain, arrow_type)
+            return arr.dictionary_encode() if encode else arr
+        dictionary = pa.array(self.values, arrow_type)
+        indices = pa.array(self.indices, pa.int32())
+        if encode:
+            return pa.DictionaryArray.from_arrays(indices, dictionary)
+        return dictionary.take(indices)
+
+
+def new_columns(sa_table, dictionary_columns=None):
+    """Returns empty columns to accumulate rows of sa_table in: a
+    DictionaryColumn for string columns which may be dictionary encoded (see
+    Writer), and a list for the others.
+    """
+    if dictionary_columns is None:
+        dictionary_columns = SPECTRIFY_DICTIONARY_COLUMNS or {}
+    columns = []
+    for col in sa_table.columns:
+        encode = dictionary_columns.get(col.description)
+        if isinstance(col.type, sa.types.String) and (encode or (encode is None and SPECTRIFY_DICTIONARY_RATIO > 0)):
+            columns.append(DictionaryColumn(encode))
+        else:
+            columns.append(list())
+    return columns
+
+
 class Writer:
     """Writes a Parquet file using Apache Arrow"""
 
@@ -39,17 +260,45 @@ class Writer:
     }
     supported_sa_types = set(pyarrow_type_map.keys()).union({sa.types.DECIMAL, sa.types.NUMERIC})
 
-    def __init__(self, py_fd, sa_table):
+    def __init__(self, py_fd, sa_table, dictionary_columns=None, timestamp_unit=SPECTRIFY_TIMESTAMP_UNIT,
+                 compression=SPECTRIFY_COMPRESSION, num_threads=SPECTRIFY_WRITER_THREADS):
+        """dictionary_columns optionally maps column names to True/False, to
+        force dictionary encoding of a string column on or off (defaults to
+        SPECTRIFY_DICTIONARY_COLUMNS).  Other string columns are dictionary
+        encoded if they were accumulated in a DictionaryColumn (see
+        new_columns) which is low-cardinality.
+
+        timestamp_unit is one of TIMESTAMP_UNITS.  Timestamp columns are
+        expected to hold datetimes, or integers in the matching Arrow unit.
+
+        num_threads columns are converted to Arrow arrays at a time.  The
+        arrays keep the column order, so the file is the same either way.
+        """
+        if timestamp_unit not in TIMESTAMP_UNITS:
+            raise ValueError('Unknown timestamp unit {}, expected one of {}'.format(
+                timestamp_unit, ', '.join(sorted(TIMESTAMP_UNITS))))
         cols = sa_table.columns
         self.py_fd = py_fd
+        self.timestamp_unit = timestamp_unit
+        self.compression = compression
         self.col_types = self.determine_pyarrow_types(cols)
         self.col_names = [col.description for col in cols]
+        if dictionary_columns is None:
+            dictionary_columns = SPECTRIFY_DICTIONARY_COLUMNS
+        self.dictionary_columns = dictionary_columns or {}
+        self.dictionary_encoded = None
+        self.num_threads = num_threads
+        self.pool = None
         self.writer = None
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
         if self.writer:
             self.writer.close()
 
@@ -59,21 +308,39 @@ class Writer:
             sa_class = col.type.__class__
             if isinstance(col.type, (sa.types.NUMERIC, sa.types.DECIMAL)):
                 pa_type = functools.partial(pa.decimal128, col.type.precision, col.type.scale)
+            elif self.pyarrow_type_map[sa_class] is _pa_timestamp_ns:
+                pa_type = functools.partial(pa.timestamp, TIMESTAMP_UNITS[self.timestamp_unit])
             else:
                 pa_type = self.pyarrow_type_map[sa_class]
             pa_types.append(pa_type)
         return pa_types
 
+    def get_arrow_schema(self):
+        """The schema of the files written, before any dictionary encoding"""
+        return pa.schema([pa.field(name, type_func()) for name, type_func in zip(self.col_names, self.col_types)])
+
     def write_row_group(self, cols):
         """ Write rows (stored in columnar lists) to Parquet file"""
-        arrays = self._to_arrow_arrays(cols)
-        table = pa.Table.from_arrays(arrays, self.col_names)
+        self.write_batch(self.to_record_batch(cols))
 
+    def to_record_batch(self, cols):
+        """Converts rows (stored in columnar lists) to an Arrow record batch,
+        which can be written by write_batch (possibly of another Writer, e.g.
+        in another process, see spectrify.utils.ipc)
+        """
+        return pa.RecordBatch.from_arrays(self._to_arrow_arrays(cols), self.col_names)
+
+    def write_batch(self, batch):
+        """Write a record batch from to_record_batch as a row group"""
+        self.write_table(pa.Table.from_batches([batch]))
+
+    def write_table(self, table):
+        """Write an Arrow table as a single row group"""
         # Writer has to be created here because we need a table
         # Assumes that data passed in will always have the same columns for
         # calls to a single Writer instance
         writer = self._get_writer(table)
-        writer.write_table(table)
+        writer.write_table(table, row_group_size=max(table.num_rows, 1))
 
     def _to_arrow_arrays(self, cols):
         """Create arrow arrays from intermediary Python columnar data"""
@@ -82,20 +349,123 @@ class Writer:
         # Sanity check that the first and last columns are the same length
         assert len(cols[0]) == len(cols[-1])
 
-        for i in range(len(self.col_types)):
-            arrow_type_func = self.col_types[i]
-            arrow_type = arrow_type_func()
-            arr = pa.array(cols[i], arrow_type)
-            arrays.append(arr)
+        # The schema is fixed by the first row group, so the columns to
+        # dictionary encode are decided once
+        if self.dictionary_encoded is None:
+            self.dictionary_encoded = self.determine_dictionary_columns(cols)
+
+        col_indices = range(len(self.col_types))
+        if self.num_threads > 1 and len(col_indices) > 1:
+            if self.pool is None:
+                self.pool = ThreadPool(self.num_threads)
+            # map returns the arrays in column order
+            return self.pool.map(lambda i: self._to_arrow_array(i, cols[i]), col_indices)
+
+        for i in col_indices:
+            arrays.append(self._to_arrow_array(i, cols[i]))
 
         return arrays
 
+    def _to_arrow_array(self, i, values):
+        arrow_type_func = self.col_types[i]
+        arrow_type = arrow_type_func()
+        if isinstance(values, DictionaryColumn):
+            return values.to_arrow(arrow_type, i in self.dictionary_encoded)
+        if pa.types.is_decimal(arrow_type):
+            arr = to_decimal128_array(values, arrow_type)
+        else:
+            arr = pa.array(values, arrow_type)
+        if i in self.dictionary_encoded:
+            arr = arr.dictionary_encode()
+        return arr
+
+    def determine_dictionary_columns(self, cols):
+        """Returns the indices of the string columns to dictionary encode"""
+        encoded = set()
+        for i, col_name in enumerate(self.col_names):
+            if not pa.types.is_string(self.col_types[i]()):
+                continue
+            if col_name in self.dictionary_columns:
+                if self.dictionary_columns[col_name]:
+                    encoded.add(i)
+            elif isinstance(cols[i], DictionaryColumn) and cols[i].is_low_cardinality():
+                encoded.add(i)
+        return encoded
+
     def _get_writer(self, table):
         if self.writer is None:
             self.writer = pq.ParquetWriter(
                 self.py_fd,
                 table.schema,
-                compression='gzip',
-                use_deprecated_int96_timestamps=True
+                compression=self.compression,
+                use_deprecated_int96_timestamps=self.timestamp_unit == 'int96'
             )
         return self.writer
+
+
+class SpillingWriter(Writer):
+    """A Writer whose row groups are larger than the batches written to it
+
+    Batches are appended to a temporary Arrow IPC stream on disk until
+    rows_per_group rows have been written.  The stream is then memory mapped
+    and written to Parquet as one row group: its buffers are read in place,
+    column by column, so memory use is bounded by the batch size rather than
+    the row group size.  This keeps row groups (and so compression and scan
+    efficiency) large for very wide tables.
+    """
+
+    def __init__(self, py_fd, sa_table, rows_per_group, spill_dir=SPECTRIFY_SPILL_DIR, **kwargs):
+        Writer.__init__(self, py_fd, sa_table, **kwargs)
+        self.rows_per_group = rows_per_group
+        self.spill_dir = spill_dir
+        self.spill_path = None
+        self.spill_sink = None
+        self.spill_writer = None
+        self.spilled_rows = 0
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self.discard_spill()
+            Writer.__exit__(self, exc_type, exc_val, exc_tb)
+
+    def write_batch(self, batch):
+        if self.spill_writer is None:
+            fd, self.spill_path = tempfile.mkstemp(prefix='spectrify-spill-', suffix='.arrow', dir=self.spill_dir)
+            os.close(fd)
+            self.spill_sink = pa.OSFile(self.spill_path, 'wb')
+            # The stream format allows each batch its own dictionaries
+            self.spill_writer = pa.ipc.new_stream(self.spill_sink, batch.schema)
+        self.spill_writer.write_batch(batch)
+        self.spilled_rows += batch.num_rows
+        if self.spilled_rows >= self.rows_per_group:
+            self.flush()
+
+    def flush(self):
+        """Writes the spilled batches as a row group"""
+        if self.spill_writer is None:
+            return
+        self.spill_writer.close()
+        self.spill_sink.close()
+        self.spill_writer = self.spill_sink = None
+        source = pa.memory_map(self.spill_path, 'r')
+        try:
+            self.write_table(pa.ipc.open_stream(source).read_all())
+        finally:
+            source.close()
+            self.discard_spill()
+
+    def discard_spill(self):
+        if self.spill_writer is not None:
+            self.spill_writer.close()
+            self.spill_sink.close()
+            self.spill_writer = self.spill_sink = None
+        if self.spill_path is not None:
+            try:
+                os.remove(self.spill_path)
+            except OSError:
+                pass
+            self.spill_path = None
+        self.spilled_rows = 0
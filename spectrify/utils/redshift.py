@@ -1,6 +1,3 @@
-import sqlalchemy as sa
-
-
 class ConnectionParameters(object):
     def __init__(self, **kwargs):
         required = ['host', 'port', 'user', 'password', 'db']
@@ -15,6 +12,7 @@ class ConnectionParameters(object):
 
 
 def get_sa_engine(ctx):
+    import sqlalchemy as sa
     parms = ctx.obj
     url = 'redshift+psycopg2://{user}:{passwd}@{host}:{port}/{database}'.format(
         user=parms.user,
@@ -1,19 +1,44 @@
 from __future__ import absolute_import, division, print_function
-from future.standard_library import install_aliases
+from spectrify.utils.compat import install_aliases
 install_aliases()  # noqa
 
 import csv
+import re
 import sys
+import threading
+import time
 from gzip import GzipFile
-from io import TextIOWrapper
+from io import RawIOBase
+from multiprocessing.pool import ThreadPool
+from os import environ
+from queue import Full, Queue
 from urllib.parse import urlparse
 
-import unicodecsv
-
-import s3fs
+from spectrify.utils.slice_cache import get_default_slice_cache
 
 SPECTRIFY_BLOCKSIZE = 50 * 2**20  # 50MB
 
+# Size of the reads used when scanning for record boundaries in uncompressed
+# data files.  Records are usually much smaller than this.
+SPECTRIFY_SCAN_BLOCKSIZE = 2**16  # 64KB
+
+# While a file is being converted, the first block of this many upcoming
+# files is fetched in the background, so that they don't start with a cold read.
+SPECTRIFY_PREFETCH_FILES = int(environ.get('SPECTRIFY_PREFETCH_FILES') or 2)
+
+# Upper bound on the amount of prefetched data held in memory by each worker.
+SPECTRIFY_PREFETCH_BYTES = int(environ.get('SPECTRIFY_PREFETCH_BYTES') or 2 * SPECTRIFY_BLOCKSIZE)
+
+# Starts the names of the files of every shard of a sharded export (see ShardS3Config)
+SHARD_PREFIX = 'shard_'
+
+# Decompressed data is read ahead of the CSV parser in blocks of this size
+# (see ReadAheadFile)
+SPECTRIFY_READ_AHEAD_BLOCKSIZE = int(environ.get('SPECTRIFY_READ_AHEAD_BLOCKSIZE') or 2**20)  # 1MB
+
+# Decompressed data is split into records in blocks of this size
+SPECTRIFY_PARSE_BLOCKSIZE = int(environ.get('SPECTRIFY_PARSE_BLOCKSIZE') or 2**18)  # 256KB
+
 # https://bugs.python.org/issue12591
 if sys.version_info[0] < 3:
     class HackedGzipFile(GzipFile):
@@ -32,12 +57,44 @@ def _strip_schema(url):
 class S3Config:
     """Describes the paths/filenames of the pertinent datafiles"""
 
-    def fs_open(self, *args, **kwargs):
-        return self.get_fs().open(*args, **kwargs)
+    def fs_open(self, path, mode='rb', cache=False, **kwargs):
+        """Opens a file.  With cache, a file which will be read whole (an
+        UNLOAD slice) is read from the local slice cache, if there is one.
+        """
+        if cache and mode == 'rb' and not kwargs:
+            slice_cache = self.get_slice_cache()
+            if slice_cache is not None:
+                return slice_cache.open(self.get_fs(), path)
+        return self.get_fs().open(path, mode, **kwargs)
+
+    def get_slice_cache(self):
+        """Returns the local disk cache for files read from S3, or None"""
+        return get_default_slice_cache()
 
     def get_fs(self):
+        import s3fs
         return s3fs.S3FileSystem(anon=False, default_block_size=SPECTRIFY_BLOCKSIZE)
 
+    def fs_size(self, path):
+        return self.get_fs().size(path)
+
+    def fs_listdir(self, path, refresh=False):
+        """Returns the names of the files in a directory.  s3fs caches
+        listings (and the file sizes in them) for the life of the filesystem
+        instance, which get_fs shares; refresh lists the directory again.
+        """
+        names = self.get_fs().ls(path, detail=False, refresh=refresh)
+        return [name.rstrip('/').rsplit('/', 1)[-1] for name in names]
+
+    def fs_move(self, src, dst):
+        self.get_fs().mv(src, dst)
+
+    def fs_remove(self, path):
+        self.get_fs().rm(path)
+
+    def fs_exists(self, path):
+        return self.get_fs().exists(path)
+
     def get_manifest_path(self):
         return NotImplementedError('Must be implemented by subclass')
 
@@ -78,19 +135,255 @@ class SimpleS3Config(S3Config):
         return self.region
 
 
+class ShardS3Config(object):
+    """Wraps an S3Config for one shard of a sharded export (see
+        ShardedRedshiftDataExporter).  The shard's CSVs and manifest go to their
+        own prefix in the CSV directory, e.g. csv/shard_003_0000_part_00.gz and
+        csv/shard_003_manifest.  The spectrum directory is shared; the Parquet
+        file names keep the prefix, so shards don't overwrite each other.
+    """
+    def __init__(self, s3_config, shard):
+        self.s3_config = s3_config
+        self.shard = shard
+
+    def __getattr__(self, name):
+        if name == 's3_config':
+            raise AttributeError(name)
+        return getattr(self.s3_config, name)
+
+    def get_csv_dir(self):
+        return self.s3_config.get_csv_dir() + '{}{:03d}_'.format(SHARD_PREFIX, self.shard)
+
+    def get_manifest_path(self):
+        return self.get_csv_dir() + 'manifest'
+
+
+class MergeS3Config(object):
+    """Wraps an S3Config for the changed rows of an incremental merge (see
+        IncrementalMerger).  Their CSVs and manifest go to csv/merge/, and are
+        converted to csv/merge/parquet/, outside the spectrum directory.
+    """
+    def __init__(self, s3_config):
+        self.s3_config = s3_config
+
+    def __getattr__(self, name):
+        if name == 's3_config':
+            raise AttributeError(name)
+        return getattr(self.s3_config, name)
+
+    def get_csv_dir(self):
+        return self.s3_config.get_csv_dir() + 'merge/'
+
+    def get_manifest_path(self):
+        return self.get_csv_dir() + 'manifest'
+
+    def get_spectrum_dir(self):
+        return self.get_csv_dir() + 'parquet/'
+
+
+class PrefetchingS3Config(object):
+    """Wraps an S3Config, fetching the first block of upcoming files in
+        background threads.  Files which were prefetched are served from memory
+        by fs_open until the prefetched block is exhausted, then read from S3 as
+        usual.  Everything else is delegated to the wrapped S3Config.
+    """
+    def __init__(self, s3_config, max_bytes=SPECTRIFY_PREFETCH_BYTES, block_size=SPECTRIFY_BLOCKSIZE,
+                 num_threads=2):
+        self.s3_config = s3_config
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.pool = ThreadPool(num_threads)
+        self.pending = {}
+        self.reserved_bytes = 0
+        self.lock = threading.Lock()
+
+    def __getattr__(self, name):
+        if name == 's3_config':
+            raise AttributeError(name)
+        return getattr(self.s3_config, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def prefetch(self, s3_paths):
+        """Starts fetching the given files, as long as the memory budget allows"""
+        for s3_path in s3_paths:
+            path = _strip_schema(s3_path)
+            with self.lock:
+                if path in self.pending or self.reserved_bytes + self.block_size > self.max_bytes:
+                    continue
+                self.reserved_bytes += self.block_size
+                self.pending[path] = self.pool.apply_async(self._fetch_head, (path,))
+
+    def fs_open(self, path, mode='rb', **kwargs):
+        with self.lock:
+            result = self.pending.pop(path, None)
+        if result is None:
+            return self.s3_config.fs_open(path, mode, **kwargs)
+
+        try:
+            fileobj, head = result.get()
+        except Exception:
+            # Prefetching is only an optimization; retry the usual way
+            return self.s3_config.fs_open(path, mode, **kwargs)
+        finally:
+            with self.lock:
+                self.reserved_bytes -= self.block_size
+
+        if mode != 'rb' or [name for name in kwargs if name != 'cache']:
+            fileobj.close()
+            return self.s3_config.fs_open(path, mode, **kwargs)
+        return PrefetchedFile(fileobj, head)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        for result in self.pending.values():
+            if result.successful():
+                fileobj, head = result.get()
+                fileobj.close()
+        self.pending = {}
+
+    def _fetch_head(self, path):
+        fileobj = self.s3_config.fs_open(path)
+        head = fileobj.read(self.block_size)
+        return fileobj, head
+
+
+class PrefetchedFile(object):
+    """A read-only file object which returns a prefetched head before continuing
+        to read from the underlying file
+    """
+    def __init__(self, fileobj, head):
+        self.fileobj = fileobj
+        self.head = head
+        self.offset = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if self.offset >= len(self.head):
+            return self.fileobj.read(size)
+
+        if size is None or size < 0:
+            data = self.head[self.offset:] + self.fileobj.read()
+        else:
+            data = self.head[self.offset:self.offset + size]
+            if len(data) < size:
+                data += self.fileobj.read(size - len(data))
+        self.offset += len(data)
+        if self.offset >= len(self.head):
+            # Release the prefetched block as soon as it is consumed
+            self.head = b''
+            self.offset = 0
+        return data
+
+    def close(self):
+        self.head = b''
+        self.fileobj.close()
+
+
+class ReadAheadFile(RawIOBase):
+    """Reads a file in a background thread, up to max_blocks blocks ahead of
+        the consumer.  Network reads and zlib decompression release the GIL, so
+        they overlap with the consumer parsing the data it already has.
+    """
+    def __init__(self, fileobj, block_size=SPECTRIFY_READ_AHEAD_BLOCKSIZE, max_blocks=4):
+        RawIOBase.__init__(self)
+        self.fileobj = fileobj
+        self.block_size = block_size
+        self.blocks = Queue(max_blocks)
+        self.block = b''
+        self.offset = 0
+        self.eof = False
+        self.error = None
+        # Time the consumer spent waiting for data
+        self.wait_seconds = 0.0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        try:
+            while not self.stopped.is_set():
+                block = self.fileobj.read(self.block_size)
+                self._put(block)
+                if not block:
+                    return
+        except Exception as e:
+            self.error = e
+            self._put(b'')
+
+    def _put(self, block):
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(block, timeout=0.1)
+                return
+            except Full:
+                pass
+
+    def readable(self):
+        return True
+
+    def readinto(self, buf):
+        if self.offset >= len(self.block):
+            if self.eof:
+                return 0
+            wait_start = time.time()
+            self.block = self.blocks.get()
+            self.wait_seconds += time.time() - wait_start
+            self.offset = 0
+            if not self.block:
+                self.eof = True
+                if self.error is not None:
+                    raise self.error
+                return 0
+
+        size = min(len(buf), len(self.block) - self.offset)
+        buf[:size] = self.block[self.offset:self.offset + size]
+        self.offset += size
+        return size
+
+    def close(self):
+        if not self.closed:
+            self.stopped.set()
+            self.thread.join()
+            self.fileobj.close()
+        RawIOBase.close(self)
+
+
 class S3GZipCSVReader:
     """Reads a Gzipped CSV file from S3
         Downloads and decompresses on-the-fly, so the entire file doesn't have
-        to be loaded into memory
+        to be loaded into memory.  With read_ahead, downloading and
+        decompressing happen in a background thread (see ReadAheadFile).
+        Rows are parsed as described in get_csv_reader.  unicode_csv is
+        deprecated and ignored.
     """
-    def __init__(self, s3_config, s3_path, unicode_csv, **kwargs):
-        self.s3file = s3_config.fs_open(_strip_schema(s3_path))
-        self.gzfile = TextIOWrapper(
-            GzipFile(fileobj=self.s3file, mode='rb'),
-            encoding='utf-8',
-            newline='',
-        )
-        self.reader = get_csv_reader(self.gzfile, unicode_csv, **kwargs)
+    def __init__(self, s3_config, s3_path, unicode_csv=None, read_ahead=False, **kwargs):
+        self.s3file = s3_config.fs_open(_strip_schema(s3_path), cache=True)
+        self.stream = GzipFile(fileobj=self.s3file, mode='rb')
+        self.read_ahead = None
+        if read_ahead:
+            self.read_ahead = ReadAheadFile(self.stream)
+            self.stream = self.read_ahead
+        self.reader = get_csv_reader(_iter_blocks(self.stream), **kwargs)
+
+    @property
+    def read_wait_seconds(self):
+        """Time spent waiting for the background thread to read ahead"""
+        return self.read_ahead.wait_seconds if self.read_ahead else 0.0
 
     def __enter__(self):
         return self
@@ -105,18 +398,233 @@ class S3GZipCSVReader:
         return self.reader.next()
 
     def close(self):
-        self.gzfile.close()
+        self.stream.close()
         self.s3file.close()
 
 
-def get_csv_reader(iterable, unicode_csv, **kwargs):
-    # The csv module works fine with unicode on Python 3, we will use `unicodecsv` only for Python2.
-    if unicode_csv and sys.version_info.major == 2:
-        return unicodecsv.reader(_encode_rows_to_utf8(iterable), **kwargs)
+def get_csv_reader(blocks, **kwargs):
+    """Returns a reader of the CSV rows in blocks, an iterable of byte strings
+    which may end anywhere (even inside a UTF-8 sequence).
+
+    Redshift's UNLOAD ... ESCAPE format (no quoting, with an escape
+    character) is parsed at byte level by ByteCSVReader, and its values are
+    bytes.  Other dialects are parsed by the csv module, and their values are
+    text.
+    """
+    if kwargs.get('quoting') == csv.QUOTE_NONE and kwargs.get('escapechar'):
+        return ByteCSVReader(blocks, kwargs.get('delimiter', ','), kwargs['escapechar'])
+    lines = _iter_split_lines(blocks)
+    if sys.version_info[0] >= 3:
+        lines = (line.decode('utf-8') for line in lines)
+    return csv.reader(lines, **kwargs)
+
+
+class ByteCSVReader(object):
+    """Parses CSV rows in Redshift's UNLOAD ... ESCAPE format without decoding them
+
+        Records end at newlines, and fields at delimiters, unless escaped by the
+        escape character.  Values are returned as byte strings, which numbers,
+        dates and timestamps are parsed from without creating text first.
+        String columns are decoded from UTF-8 in bulk by Arrow (see Writer).
+
+        Blocks are split into lines and lines into fields with bytes.split;
+        only lines containing the escape character take the slower path of
+        unescaping.
+    """
+
+    def __init__(self, blocks, delimiter='|', escapechar='\\'):
+        self.blocks = blocks
+        self.delimiter = _to_bytes(delimiter)
+        self.escapechar = _to_bytes(escapechar)
+        self.escape_pattern = re.compile(
+            re.escape(self.escapechar) + b'(.)|' + re.escape(self.delimiter), re.DOTALL)
+
+    def __iter__(self):
+        delimiter = self.delimiter
+        escapechar = self.escapechar
+        remainder = b''
+        # The lines so far of a record containing escaped newlines
+        continued = None
+        for block in self.blocks:
+            lines = (remainder + block).split(b'\n')
+            remainder = lines.pop()
+            for line in lines:
+                if continued is not None:
+                    line = continued + b'\n' + line
+                    continued = None
+                if escapechar not in line:
+                    yield line.split(delimiter)
+                elif (len(line) - len(line.rstrip(escapechar))) % 2:
+                    # The newline is escaped; the record goes on
+                    continued = line
+                else:
+                    yield self.split_escaped(line)
+
+        if continued is not None:
+            yield self.split_escaped(continued + b'\n' + remainder)
+        elif remainder:
+            yield self.split_escaped(remainder) if escapechar in remainder else remainder.split(delimiter)
+
+    def split_escaped(self, line):
+        fields = []
+        parts = []
+        pos = 0
+        for match in self.escape_pattern.finditer(line):
+            parts.append(line[pos:match.start()])
+            escaped = match.group(1)
+            if escaped is not None:
+                parts.append(escaped)
+            else:
+                fields.append(b''.join(parts))
+                parts = []
+            pos = match.end()
+        parts.append(line[pos:])
+        fields.append(b''.join(parts))
+        return fields
+
+
+def _to_bytes(value):
+    return value if isinstance(value, bytes) else value.encode('utf-8')
+
+
+def _iter_blocks(fileobj, block_size=SPECTRIFY_PARSE_BLOCKSIZE):
+    while True:
+        block = fileobj.read(block_size)
+        if not block:
+            return
+        yield block
+
+
+def _iter_split_lines(blocks):
+    """Splits byte blocks into newline-terminated lines"""
+    remainder = b''
+    for block in blocks:
+        lines = (remainder + block).split(b'\n')
+        remainder = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+    if remainder:
+        yield remainder
+
+
+class S3RangeCSVReader:
+    """Reads a byte range of an uncompressed CSV file from S3
+
+        Only the records which *start* inside [start, end) are returned, so a
+        file can be split into adjacent ranges and each range parsed
+        independently without losing or duplicating records.  Records are
+        terminated by newlines which are not escaped, following the rules
+        Redshift uses for UNLOAD ... ESCAPE.  unicode_csv is deprecated and
+        ignored.
+    """
+    def __init__(self, s3_config, s3_path, start, end, unicode_csv=None, **kwargs):
+        self.s3file = s3_config.fs_open(_strip_schema(s3_path), cache=True)
+        escapechar = kwargs.get('escapechar') or '\\'
+        self.escapechar = escapechar.encode('utf-8')
+        self.start = find_record_start(self.s3file, start, self.escapechar)
+        self.end = end
+        self.reader = get_csv_reader(self._iter_lines(), **kwargs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __iter__(self):
+        return self.reader.__iter__()
+
+    def next(self):
+        return self.reader.next()
 
-    return csv.reader(iterable, **kwargs)
+    def close(self):
+        self.s3file.close()
 
+    def _iter_lines(self):
+        """Yields lines until the first record starting at or after
+        the end of the range.  A line ending in an escaped newline is part of
+        the same record as the line that follows it.
+        """
+        pos = self.start
+        record_start = True
+        for line in _iter_raw_lines(self.s3file, self.start):
+            if record_start and pos >= self.end:
+                return
+            pos += len(line)
+            record_start = not _ends_with_escaped_newline(line, self.escapechar)
+            yield line
+
+
+def plan_byte_ranges(size, split_size):
+    """Splits a file of the given size into (start, end) byte ranges of at
+    most split_size bytes.  Always returns at least one range.
+    """
+    split_size = max(int(split_size), 1)
+    ranges = [(start, min(start + split_size, size)) for start in range(0, size, split_size)]
+    return ranges or [(0, size)]
+
+
+def find_record_start(fileobj, offset, escapechar=b'\\'):
+    """Returns the position of the first record which starts at or after offset.
 
-def _encode_rows_to_utf8(iterable):
-    for row in iterable:
-        yield row.encode("utf-8")
+        A record starts at the beginning of the file, or right after a newline
+        which is not escaped.  A newline is escaped when it is preceded by an
+        odd number of escape characters.  If no record starts after offset,
+        the position of the end of the file is returned.
+    """
+    if offset <= 0:
+        return 0
+
+    # A record starting exactly at offset is preceded by a newline at offset - 1
+    base = offset - 1
+    fileobj.seek(base)
+    while True:
+        block = fileobj.read(SPECTRIFY_SCAN_BLOCKSIZE)
+        if not block:
+            return base
+        idx = block.find(b'\n')
+        while idx != -1:
+            num_escapes = _count_escapes_before(fileobj, block, base, idx, escapechar)
+            if num_escapes % 2 == 0:
+                fileobj.seek(base + idx + 1)
+                return base + idx + 1
+            idx = block.find(b'\n', idx + 1)
+        base += len(block)
+
+
+def _count_escapes_before(fileobj, block, base, idx, escapechar):
+    """Counts the run of escape characters immediately preceding block[idx].
+    Reads backwards from the file if the run extends past the start of block.
+    """
+    prefix = block[:idx]
+    count = len(prefix) - len(prefix.rstrip(escapechar))
+    if count < idx:
+        return count
+
+    # The run of escape characters reaches the start of the block
+    resume = fileobj.tell()
+    pos = base
+    while pos > 0:
+        read_start = max(0, pos - SPECTRIFY_SCAN_BLOCKSIZE)
+        fileobj.seek(read_start)
+        chunk = fileobj.read(pos - read_start)
+        run = len(chunk) - len(chunk.rstrip(escapechar))
+        count += run
+        if run < len(chunk):
+            break
+        pos = read_start
+    fileobj.seek(resume)
+    return count
+
+
+def _ends_with_escaped_newline(line, escapechar):
+    if not line.endswith(b'\n'):
+        return False
+    body = line[:-1]
+    return (len(body) - len(body.rstrip(escapechar))) % 2 == 1
+
+
+def _iter_raw_lines(fileobj, start):
+    """Yields newline-terminated byte strings from fileobj, starting at start"""
+    fileobj.seek(start)
+    return _iter_split_lines(_iter_blocks(fileobj, SPECTRIFY_SCAN_BLOCKSIZE))
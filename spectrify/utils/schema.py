@@ -1,7 +1,33 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
 
+import hashlib
+import importlib
+import inspect
+import json
+import os
+from os import environ, path
+
 import sqlalchemy as sa
-from spectrify.utils.parquet import Writer
+
+# Reflected table schemas are cached here, so that repeated invocations don't
+# each have to reflect the table from Redshift's (slow) catalog
+SPECTRIFY_SCHEMA_CACHE_DIR = (
+    environ.get('SPECTRIFY_SCHEMA_CACHE_DIR') or path.join(path.expanduser('~'), '.spectrify', 'schema_cache')
+)
+
+# Cached schemas are checked against this cheap catalog query, which lists the
+# columns of each table.  Tables whose columns changed are reflected again.
+FINGERPRINT_QUERY = """
+select c.relname, a.attnum, a.attname, a.atttypid, a.atttypmod
+from pg_catalog.pg_attribute a
+join pg_catalog.pg_class c on c.oid = a.attrelid
+join pg_catalog.pg_namespace n on n.oid = c.relnamespace
+where a.attnum > 0
+  and not a.attisdropped
+  and n.nspname = %(schema_name)s
+  and c.relname in %(table_names)s
+order by c.relname, a.attnum
+"""
 
 
 class SchemaReader:
@@ -21,12 +47,8 @@ class SqlAlchemySchemaReader(SchemaReader):
         self.metadata = sa.MetaData(self.engine)
 
     def get_table_schema(self, table_name):
-        schema_name = None
-
         # Handle table name prepended with schema
-        parts = table_name.split('.')
-        if len(parts) == 2:
-            schema_name, table_name = parts
+        schema_name, table_name = split_table_name(table_name)
 
         table = sa.Table(
             table_name,
@@ -35,6 +57,10 @@ class SqlAlchemySchemaReader(SchemaReader):
             postgresql_ignore_search_path=True,
             schema=schema_name
         )
+        self.validate_table(table)
+        return table
+
+    def validate_table(self, table):
         for col in table.columns:
             if col.type.__class__ not in self.get_supported_sa_types():
                 raise ValueError(
@@ -43,8 +69,202 @@ class SqlAlchemySchemaReader(SchemaReader):
                     )
                 )
 
-        return table
-
     def get_supported_sa_types(self):
         """Override this if you need to implement your own types"""
+        from spectrify.utils.parquet import Writer
         return Writer.supported_sa_types
+
+
+class CachedSchemaReader(SqlAlchemySchemaReader):
+    """Caches reflected table schemas on disk, keyed by cluster, schema and table
+
+    Before a cached schema is used, it is validated against a fingerprint of
+    the table's columns from a cheap catalog query.  get_table_schemas reflects
+    many tables at once, with a single fingerprint query per schema.
+    """
+
+    def __init__(self, engine, cache_dir=SPECTRIFY_SCHEMA_CACHE_DIR):
+        SqlAlchemySchemaReader.__init__(self, engine)
+        self.cache = SchemaCache(cache_dir)
+
+    def get_table_schema(self, table_name):
+        return self.get_table_schemas([table_name])[table_name]
+
+    def get_table_schemas(self, table_names):
+        """Returns a dict of table name to SqlAlchemy schema"""
+        names_by_schema = {}
+        for table_name in table_names:
+            schema_name, bare_name = split_table_name(table_name)
+            names_by_schema.setdefault(schema_name, {})[bare_name] = table_name
+
+        cluster = self.get_cluster_key()
+        tables = {}
+        for schema_name, names in names_by_schema.items():
+            fingerprints = self.get_fingerprints(schema_name, list(names))
+            missing = []
+            for bare_name, table_name in names.items():
+                fingerprint = fingerprints.get(bare_name)
+                table = None
+                if fingerprint is not None:
+                    table = self.cache.load(cluster, schema_name, bare_name, fingerprint, self.metadata)
+                if table is None:
+                    missing.append(bare_name)
+                else:
+                    tables[table_name] = table
+
+            for bare_name, table in self.reflect_tables(schema_name, missing).items():
+                self.validate_table(table)
+                fingerprint = fingerprints.get(bare_name)
+                if fingerprint is not None:
+                    self.cache.store(cluster, schema_name, bare_name, fingerprint, table)
+                tables[names[bare_name]] = table
+
+        return tables
+
+    def get_cluster_key(self):
+        url = self.engine.url
+        return '{}:{}/{}'.format(url.host, url.port, url.database)
+
+    def get_fingerprints(self, schema_name, table_names):
+        """Returns a dict of table name to a hash of its columns"""
+        with self.engine.connect() as cursor:
+            rows = cursor.execute(FINGERPRINT_QUERY, {
+                'schema_name': schema_name or 'public',
+                'table_names': tuple(table_names),
+            })
+            columns_by_table = {}
+            for row in rows:
+                columns_by_table.setdefault(row[0], []).append(tuple(row[1:]))
+
+        return {
+            table_name: hashlib.sha1(repr(columns).encode('utf-8')).hexdigest()
+            for table_name, columns in columns_by_table.items()
+        }
+
+    def reflect_tables(self, schema_name, table_names):
+        """Reflects several tables of a schema at once.  The dialect fetches the
+        column info for all of them in the same catalog query.
+        """
+        if not table_names:
+            return {}
+        self.metadata.reflect(
+            only=table_names,
+            schema=schema_name,
+            postgresql_ignore_search_path=True,
+        )
+        prefix = schema_name + '.' if schema_name else ''
+        return {table_name: self.metadata.tables[prefix + table_name] for table_name in table_names}
+
+
+class SchemaCache:
+    """Stores SqlAlchemy table schemas as JSON files, along with a fingerprint
+    used to check whether they are still current.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+
+    def get_path(self, cluster, schema_name, table_name):
+        key = '\x00'.join([cluster, schema_name or '', table_name])
+        return path.join(self.cache_dir, hashlib.sha1(key.encode('utf-8')).hexdigest() + '.json')
+
+    def load(self, cluster, schema_name, table_name, fingerprint, metadata):
+        """Returns the cached table, or None if it isn't cached or is stale"""
+        try:
+            with open(self.get_path(cluster, schema_name, table_name)) as cache_file:
+                entry = json.load(cache_file)
+        except (IOError, OSError, ValueError):
+            return None
+
+        if entry.get('fingerprint') != fingerprint:
+            return None
+        return dict_to_table(entry['table'], metadata)
+
+    def store(self, cluster, schema_name, table_name, fingerprint, sa_table):
+        if not path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        cache_path = self.get_path(cluster, schema_name, table_name)
+        tmp_path = '{}.{}.tmp'.format(cache_path, os.getpid())
+        with open(tmp_path, 'w') as cache_file:
+            json.dump({'fingerprint': fingerprint, 'table': table_to_dict(sa_table)}, cache_file)
+        os.rename(tmp_path, cache_path)
+
+
+def split_table_name(table_name):
+    """Splits a table name prepended with schema into (schema, table)"""
+    parts = table_name.split('.')
+    if len(parts) == 2:
+        return parts[0], parts[1]
+    return None, table_name
+
+
+def _type_init_args(type_cls):
+    try:
+        params = inspect.signature(type_cls.__init__).parameters
+        return [name for name, param in params.items()
+                if name != 'self' and param.kind == param.POSITIONAL_OR_KEYWORD]
+    except AttributeError:
+        # Python 2
+        return inspect.getargspec(type_cls.__init__).args[1:]
+
+
+def table_to_dict(sa_table):
+    """Serializes the column names and types of a table to a JSON-compatible dict"""
+    columns = []
+    for col in sa_table.columns:
+        type_cls = col.type.__class__
+        type_args = {}
+        for arg in _type_init_args(type_cls):
+            value = getattr(col.type, arg, None)
+            if isinstance(value, (bool, int, float, type(''))):
+                type_args[arg] = value
+        columns.append({
+            'name': col.name,
+            'type': '{}.{}'.format(type_cls.__module__, type_cls.__name__),
+            'type_args': type_args,
+        })
+    return {'name': sa_table.name, 'schema': sa_table.schema, 'columns': columns}
+
+
+def dict_to_table(data, metadata):
+    """Inverse of table_to_dict"""
+    columns = []
+    for col in data['columns']:
+        module_name, _, cls_name = col['type'].rpartition('.')
+        type_cls = getattr(importlib.import_module(module_name), cls_name)
+        columns.append(sa.Column(col['name'], type_cls(**col['type_args'])))
+    return sa.Table(data['name'], metadata, *columns, schema=data['schema'], extend_existing=True)
+
+
+def project_table(sa_table, column_names):
+    """Returns a copy of sa_table reduced to column_names, in that order.
+    The copy is used for the UNLOAD column list, conversion and the Spectrum
+    DDL alike, so that they all agree on the columns.
+    """
+    missing = [name for name in column_names if name not in sa_table.columns]
+    if missing:
+        raise ValueError('Table {} has no column(s): {}'.format(sa_table.name, ', '.join(missing)))
+    columns = [sa.Column(name, sa_table.columns[name].type) for name in column_names]
+    return sa.Table(sa_table.name, sa.MetaData(), *columns, schema=sa_table.schema)
+
+
+def parse_column_list(value):
+    """Parses a comma separated list of column names (from the command line),
+    or takes a list of them as is
+    """
+    if not value:
+        return None
+    if not isinstance(value, (list, tuple)):
+        value = value.split(',')
+    return [name.strip() for name in value if name.strip()] or None
+
+
+def get_projected_schema(schema_reader, table_name, columns=None):
+    """Reads the schema of table_name, reduced to columns (a list, or a comma
+    separated string) if given
+    """
+    sa_table = schema_reader.get_table_schema(table_name)
+    column_names = parse_column_list(columns)
+    if column_names:
+        sa_table = project_table(sa_table, column_names)
+    return sa_table
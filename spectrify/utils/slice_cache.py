@@ -0,0 +1,145 @@
+"""A local disk cache of files downloaded from S3 (usually UNLOAD slices)
+
+Reconverting an export (after a failure, or with different settings) reads
+the cached copies through memory maps instead of downloading them again.
+Entries are keyed by URL and ETag, so a file which changed on S3 is fetched
+again.  The total size is capped; the least recently used entries are evicted
+first.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import hashlib
+import mmap
+import os
+import shutil
+import tempfile
+from io import RawIOBase
+from os import environ, path
+
+# The cache is disabled unless a directory is given.  Put it on fast local
+# disk (e.g. NVMe instance storage).
+SPECTRIFY_SLICE_CACHE_DIR = environ.get('SPECTRIFY_SLICE_CACHE_DIR')
+
+SPECTRIFY_SLICE_CACHE_SIZE = int(environ.get('SPECTRIFY_SLICE_CACHE_SIZE') or 50 * 2**30)  # 50GB
+
+_COPY_BLOCKSIZE = 8 * 2**20
+
+
+class MappedFile(RawIOBase):
+    """A read-only, seekable file object over a memory mapped local file"""
+
+    def __init__(self, file_path):
+        RawIOBase.__init__(self)
+        with open(file_path, 'rb') as local_file:
+            self.map = mmap.mmap(local_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = len(self.map) - self.map.tell()
+        return self.map.read(size)
+
+    def readinto(self, buffer):
+        data = self.map.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=0):
+        self.map.seek(offset, whence)
+        return self.map.tell()
+
+    def tell(self):
+        return self.map.tell()
+
+    def close(self):
+        if not self.closed:
+            self.map.close()
+        RawIOBase.close(self)
+
+
+class LocalSliceCache(object):
+    def __init__(self, cache_dir, max_bytes=SPECTRIFY_SLICE_CACHE_SIZE):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        if not path.isdir(cache_dir):
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                # Another worker created it first
+                pass
+
+    def get_path(self, url, etag):
+        key = hashlib.sha1('{}\0{}'.format(url, etag).encode('utf-8')).hexdigest()
+        return path.join(self.cache_dir, key)
+
+    def open(self, fs, url):
+        """Opens url for reading from the cache, downloading it with fs first if
+        it isn't cached.  Files without an ETag aren't cached.
+        """
+        info = fs.info(url)
+        etag = info.get('ETag') or info.get('etag')
+        if not etag:
+            return fs.open(url, 'rb')
+
+        cache_path = self.get_path(url, etag)
+        if path.exists(cache_path):
+            # The modification time orders entries for eviction
+            os.utime(cache_path, None)
+        else:
+            self.download(fs, url, cache_path)
+            self.evict(keep=cache_path)
+
+        if os.path.getsize(cache_path) == 0:
+            # Empty files can't be mapped
+            return open(cache_path, 'rb')
+        return MappedFile(cache_path)
+
+    def download(self, fs, url, cache_path):
+        # Concurrent downloads of the same file each write their own temporary
+        # file; renaming is atomic, so readers only ever see complete files
+        fd, temp_path = tempfile.mkstemp(prefix='.download-', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as local_file:
+                with fs.open(url, 'rb') as remote_file:
+                    shutil.copyfileobj(remote_file, local_file, _COPY_BLOCKSIZE)
+            os.rename(temp_path, cache_path)
+        except Exception:
+            os.remove(temp_path)
+            raise
+
+    def evict(self, keep=None):
+        """Removes the least recently used entries until the cache fits its size cap"""
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.startswith('.'):
+                continue
+            entry_path = path.join(self.cache_dir, name)
+            try:
+                stat = os.stat(entry_path)
+            except OSError:
+                # Evicted by another worker
+                continue
+            entries.append((stat.st_mtime, stat.st_size, entry_path))
+
+        total_bytes = sum(size for _, size, _ in entries)
+        for _, size, entry_path in sorted(entries):
+            if total_bytes <= self.max_bytes:
+                break
+            if entry_path == keep:
+                continue
+            try:
+                # Files still mapped by a reader stay readable until unmapped
+                os.remove(entry_path)
+            except OSError:
+                pass
+            total_bytes -= size
+
+
+def get_default_slice_cache():
+    if not SPECTRIFY_SLICE_CACHE_DIR:
+        return None
+    return LocalSliceCache(SPECTRIFY_SLICE_CACHE_DIR)
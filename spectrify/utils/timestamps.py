@@ -19,6 +19,18 @@ def unix_time_nanos(dt):
     return timedelta_to_nanos(dt - epoch)
 
 
+def unix_time_micros(dt):
+    """Returns microseconds since epoch for a given datetime object"""
+    return timedelta_to_micros(dt - epoch)
+
+
+def _to_text(date_str):
+    # UNLOAD files are parsed to bytes, which ciso8601 doesn't accept
+    if isinstance(date_str, bytes):
+        return date_str.decode('ascii')
+    return date_str
+
+
 def iso8601_to_nanos(date_str):
     """ Returns a nanoseconds since epoch for a given ISO-8601 date string
 
@@ -28,10 +40,22 @@ def iso8601_to_nanos(date_str):
         Return Values:
         int representing # of nanoseconds since "1970-01-01" for date
     """
-    dt = ciso8601.parse_datetime(date_str)
+    dt = ciso8601.parse_datetime(_to_text(date_str))
     return unix_time_nanos(dt)
 
 
+def iso8601_to_micros(date_str):
+    """Returns microseconds since epoch for a given ISO-8601 date string"""
+    return unix_time_micros(ciso8601.parse_datetime(_to_text(date_str)))
+
+
+def iso8601_to_millis(date_str):
+    """Returns milliseconds since epoch for a given ISO-8601 date string.
+    Sub-millisecond digits are truncated (towards the past).
+    """
+    return unix_time_micros(ciso8601.parse_datetime(_to_text(date_str))) // 1000
+
+
 def iso8601_to_days_since_epoch(date_str):
-    dt = ciso8601.parse_datetime(date_str)
+    dt = ciso8601.parse_datetime(_to_text(date_str))
     return (dt - epoch).days
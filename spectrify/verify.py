@@ -0,0 +1,219 @@
+"""Checks converted Parquet files against the UNLOAD manifest by reading only
+their footers.
+
+Every manifest entry must have produced a readable Parquet file (or a set of
+numbered part files, see SplittingManifestConverter) with the Arrow schema the
+Writer produces for the table.  If the manifest was written with
+MANIFEST VERBOSE, the row counts in the footers must also add up to the
+manifest's record_count.
+
+Files merged by compaction are matched to entries through the directory's
+lineage (see spectrify.compact), which records the rows each original file
+contributed.  Files of new rows written by an incremental merge don't come
+from the manifest, and are left out.  If other files match no entry (e.g.
+the table was streamed rather than unloaded), the entries without files are
+checked together, by comparing their total row count with that of those
+files.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import re
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+from os import path
+
+import click
+import pyarrow as pa
+
+from spectrify.compact import read_lineage
+from spectrify.convert import CsvConverter
+from spectrify.merge import INSERT_PREFIX
+from spectrify.utils.parquet import (
+    SPECTRIFY_FOOTER_THREADS, SPECTRIFY_TIMESTAMP_UNIT, Writer, is_data_file, read_footer
+)
+
+FooterInfo = namedtuple('FooterInfo', ['path', 'num_rows', 'schema', 'error'])
+
+# Strips the extension, and the part number of a file split into byte ranges
+PART_PATTERN = re.compile(r'(\.\d{4})?\.parq$')
+
+# Stands in for the URL of the entries checked by their total row count
+UNMATCHED_ENTRIES = '(entries matching no file)'
+
+
+class EntryCheck(namedtuple('EntryCheck', ['url', 'parquet_paths', 'expected_rows', 'actual_rows', 'problems'])):
+    """The outcome of verifying one manifest entry"""
+
+    @property
+    def ok(self):
+        return not self.problems
+
+
+def _value_type(arrow_type):
+    # Dictionary encoding is decided per file, so it doesn't count as a difference
+    if pa.types.is_dictionary(arrow_type):
+        return arrow_type.value_type
+    return arrow_type
+
+
+def schema_differences(expected, actual):
+    """Returns a list of descriptions of how the actual schema differs from the expected one"""
+    expected_fields = [(field.name, _value_type(field.type)) for field in expected]
+    actual_fields = [(field.name, _value_type(field.type)) for field in actual]
+    if [name for name, _ in expected_fields] != [name for name, _ in actual_fields]:
+        return ['columns {} != expected {}'.format(
+            [name for name, _ in actual_fields], [name for name, _ in expected_fields])]
+    return [
+        'column {} is {}, expected {}'.format(name, actual_type, expected_type)
+        for (name, expected_type), (_, actual_type) in zip(expected_fields, actual_fields)
+        if not actual_type.equals(expected_type)
+    ]
+
+
+class ManifestVerifier(object):
+    def __init__(self, sa_table, s3_config, num_threads=SPECTRIFY_FOOTER_THREADS,
+                 timestamp_unit=SPECTRIFY_TIMESTAMP_UNIT):
+        self.sa_table = sa_table
+        self.s3_config = s3_config
+        self.num_threads = num_threads
+        self.timestamp_unit = timestamp_unit
+        # The converter knows where the Parquet file(s) for each entry go
+        self.converter = CsvConverter(sa_table, s3_config)
+
+    def log(self, msg):
+        """By default, we log to console with click"""
+        click.echo(msg)
+
+    def verify(self):
+        """Returns an EntryCheck for every entry of the manifest matched to
+        files, and one for all entries matched to none if there are files
+        matching no entry (see UNMATCHED_ENTRIES)
+        """
+        manifest = self.converter.get_manifest()
+        spectrum_dir = self.s3_config.get_spectrum_dir()
+        file_names = [name for name in self.s3_config.fs_listdir(spectrum_dir) if is_data_file(name)]
+        lineage = dict(
+            (name, sources) for name, sources in read_lineage(self.s3_config, spectrum_dir).items()
+            if name in file_names)
+
+        names_by_url = dict(
+            (entry['url'], self.find_output_files(entry['url'], file_names)) for entry in manifest['entries'])
+        # url -> [(merged file name, rows of the entry in it)]
+        merged_by_url = dict((entry['url'], []) for entry in manifest['entries'])
+        urls_by_stem = dict((self.get_output_stem(entry['url']), entry['url']) for entry in manifest['entries'])
+        for merged_name, sources in sorted(lineage.items()):
+            rows_by_url = {}
+            for name, num_rows in sources.items():
+                url = urls_by_stem.get(PART_PATTERN.sub('', name))
+                if url is not None:
+                    rows_by_url[url] = rows_by_url.get(url, 0) + num_rows
+            for url, num_rows in rows_by_url.items():
+                merged_by_url[url].append((merged_name, num_rows))
+
+        matched = set(name for names in names_by_url.values() for name in names)
+        matched.update(lineage)
+        unmatched = sorted(
+            name for name in file_names if name not in matched and not name.startswith(INSERT_PREFIX))
+
+        all_names = sorted(matched.union(unmatched))
+        pool = ThreadPool(self.num_threads)
+        try:
+            footers = dict(zip(all_names, pool.map(
+                lambda name: self.read_footer(path.join(spectrum_dir, name)), all_names)))
+        finally:
+            pool.close()
+            pool.join()
+
+        expected_schema = Writer(None, self.sa_table, timestamp_unit=self.timestamp_unit).get_arrow_schema()
+        checks = []
+        missing = []
+        for entry in manifest['entries']:
+            url = entry['url']
+            if unmatched and not names_by_url[url] and not merged_by_url[url]:
+                missing.append(entry)
+                continue
+            checks.append(self.check_entry(
+                entry, [footers[name] for name in names_by_url[url]], expected_schema,
+                [(footers[name], num_rows) for name, num_rows in merged_by_url[url]]))
+        if unmatched:
+            self.log('%d files match no manifest entry (was the table streamed?); comparing their total row count '
+                     'with that of the %d entries matching no file' % (len(unmatched), len(missing)))
+            checks.append(self.check_unmatched(missing, [footers[name] for name in unmatched], expected_schema))
+        return checks
+
+    def get_output_stem(self, url):
+        return path.basename(self.converter.get_output_path(url))[:-len('.parq')]
+
+    def find_output_files(self, url, file_names):
+        """Returns the names of the Parquet files converted from a manifest entry:
+        either a single file, or numbered parts of a file split into byte ranges
+        """
+        stem = self.get_output_stem(url)
+        whole_name = stem + '.parq'
+        part_pattern = re.compile(re.escape(stem) + r'\.\d{4}\.parq$')
+        return sorted(name for name in file_names if name == whole_name or part_pattern.match(name))
+
+    def read_footer(self, file_path):
+        try:
+            metadata = read_footer(self.s3_config, file_path)
+            return FooterInfo(file_path, metadata.num_rows, metadata.schema.to_arrow_schema(), None)
+        except Exception as e:
+            return FooterInfo(file_path, None, None, str(e) or e.__class__.__name__)
+
+    def check_entry(self, entry, footers, expected_schema, merged_footers=()):
+        """merged_footers are (footer, num_rows) pairs of the files compaction
+        merged files of this entry into, with the entry's rows in each
+        """
+        expected_rows = entry.get('meta', {}).get('record_count')
+        if not footers and not merged_footers:
+            return EntryCheck(entry['url'], [], expected_rows, 0, ['missing'])
+        problems, actual_rows = self.check_footers(footers, expected_schema)
+        for footer, num_rows in merged_footers:
+            problems.extend(self.check_footers([footer], expected_schema)[0])
+            if footer.error is not None:
+                actual_rows = None
+            elif actual_rows is not None:
+                actual_rows += num_rows
+
+        if expected_rows is not None and actual_rows is not None and actual_rows != expected_rows:
+            problems.append('has {} rows, expected {}'.format(actual_rows, expected_rows))
+
+        paths = [footer.path for footer in footers] + [footer.path for footer, _ in merged_footers]
+        return EntryCheck(entry['url'], paths, expected_rows, actual_rows, problems)
+
+    def check_unmatched(self, entries, footers, expected_schema):
+        """Checks entries matching no file against files matching no entry,
+        by their total row count
+        """
+        problems, actual_rows = self.check_footers(footers, expected_schema)
+        counts = [entry.get('meta', {}).get('record_count') for entry in entries]
+        expected_rows = None if None in counts else sum(counts)
+        if expected_rows is not None and actual_rows is not None and actual_rows != expected_rows:
+            problems.append('has {} rows in total, expected {}'.format(actual_rows, expected_rows))
+        return EntryCheck(UNMATCHED_ENTRIES, [footer.path for footer in footers], expected_rows, actual_rows, problems)
+
+    def check_footers(self, footers, expected_schema):
+        """Returns the problems found in footers, and their total row count
+        (None if any is unreadable)
+        """
+        problems = []
+        actual_rows = 0
+        for footer in footers:
+            name = path.basename(footer.path)
+            if footer.error is not None:
+                problems.append('{} is unreadable (truncated?): {}'.format(name, footer.error))
+                actual_rows = None
+                continue
+            problems.extend('{}: {}'.format(name, diff) for diff in schema_differences(expected_schema, footer.schema))
+            if actual_rows is not None:
+                actual_rows += footer.num_rows
+        return problems, actual_rows
+
+    def log_results(self, checks):
+        """Logs the problems found.  Returns the number of entries with problems"""
+        failed = [check for check in checks if not check.ok]
+        for check in failed:
+            for problem in check.problems:
+                self.log('[%s] %s' % (check.url, problem))
+        self.log('Verified %d manifest entries: %d ok, %d with problems' % (
+            len(checks), len(checks) - len(failed), len(failed)))
+        return len(failed)
@@ -0,0 +1,356 @@
+"""Distributed conversion of a manifest through a shared, lease-based work queue.
+
+Any number of workers, on any number of hosts, claim manifest entries from the
+queue.  A claimed entry is leased to its worker for a limited time, and the
+worker renews the lease with heartbeats while it converts the file.  If a
+worker dies, its lease expires and the entry is handed to another worker.
+Leases are timed by the database's clock, so the clocks of the workers' hosts
+don't need to agree.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+import os
+import socket
+import threading
+import time
+from collections import namedtuple
+from multiprocessing import cpu_count
+
+import click
+import sqlalchemy as sa
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import FunctionElement
+
+from spectrify.convert import CsvConverter, _PoolManager
+
+# How long a claimed entry belongs to a worker without a heartbeat
+SPECTRIFY_LEASE_SECONDS = int(os.environ.get('SPECTRIFY_LEASE_SECONDS') or 300)
+
+# How long an idle worker waits before checking for expired leases again
+SPECTRIFY_POLL_SECONDS = int(os.environ.get('SPECTRIFY_POLL_SECONDS') or 10)
+
+# Times a statement is retried while the database is locked by another
+# worker (SQLite allows one writer at a time), backing off up to a second
+SPECTRIFY_QUEUE_LOCK_RETRIES = int(os.environ.get('SPECTRIFY_QUEUE_LOCK_RETRIES') or 20)
+
+PENDING = 'pending'
+LEASED = 'leased'
+DONE = 'done'
+FAILED = 'failed'
+
+Task = namedtuple('Task', ['job_id', 'url', 'owner', 'attempts'])
+
+
+class db_epoch(FunctionElement):
+    """The database's clock, in seconds since the epoch"""
+    type = sa.Float()
+    name = 'db_epoch'
+    inherit_cache = True
+
+
+@compiles(db_epoch)
+def _compile_db_epoch(element, compiler, **kwargs):
+    return 'extract(epoch from current_timestamp)'
+
+
+@compiles(db_epoch, 'sqlite')
+def _compile_db_epoch_sqlite(element, compiler, **kwargs):
+    return "((julianday('now') - 2440587.5) * 86400.0)"
+
+
+@compiles(db_epoch, 'mysql')
+def _compile_db_epoch_mysql(element, compiler, **kwargs):
+    return 'unix_timestamp(now(6))'
+
+
+def is_locked_error(error):
+    return 'database is locked' in str(error)
+
+
+def get_worker_id():
+    return '{}:{}'.format(socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    """A queue of manifest entries shared by conversion workers.  Entries are
+    grouped into jobs (usually one per manifest).
+    """
+
+    def enqueue(self, job_id, urls):
+        raise NotImplementedError('Must be implemented by subclass')
+
+    def claim(self, job_id, worker_id, lease_seconds=SPECTRIFY_LEASE_SECONDS):
+        """Leases an entry to worker_id.  Returns a Task, or None if no entry is
+        available right now.
+        """
+        raise NotImplementedError('Must be implemented by subclass')
+
+    def heartbeat(self, task, lease_seconds=SPECTRIFY_LEASE_SECONDS):
+        """Extends the lease of a task.  Returns False if the lease was lost"""
+        raise NotImplementedError('Must be implemented by subclass')
+
+    def complete(self, task):
+        """Marks a task done.  Returns False if the lease was lost"""
+        raise NotImplementedError('Must be implemented by subclass')
+
+    def fail(self, task, error):
+        """Gives up a task, so it can be retried (up to a maximum number of attempts)"""
+        raise NotImplementedError('Must be implemented by subclass')
+
+    def status(self, job_id):
+        """Returns a dict of state to number of entries"""
+        raise NotImplementedError('Must be implemented by subclass')
+
+    def is_finished(self, job_id):
+        status = self.status(job_id)
+        return not status.get(PENDING) and not status.get(LEASED)
+
+
+class SqlWorkQueue(WorkQueue):
+    """A WorkQueue stored in a table of any database supported by SqlAlchemy.
+    Use a SQLite file (sqlite:////path/to/queue.db) for a single host or for
+    testing, and e.g. PostgreSQL for workers on many hosts.
+
+    Claims are made with a compare-and-swap UPDATE on the number of attempts,
+    so no locking or transaction isolation beyond single statements is needed.
+    """
+
+    def __init__(self, engine, table_name='spectrify_work_queue', max_attempts=3,
+                 lock_retries=SPECTRIFY_QUEUE_LOCK_RETRIES):
+        self.engine = engine
+        self.max_attempts = max_attempts
+        self.lock_retries = lock_retries
+        metadata = sa.MetaData()
+        self.table = sa.Table(
+            table_name,
+            metadata,
+            sa.Column('job_id', sa.String(1024), primary_key=True),
+            sa.Column('url', sa.String(1024), primary_key=True),
+            sa.Column('state', sa.String(16), nullable=False, index=True),
+            sa.Column('owner', sa.String(256)),
+            sa.Column('lease_expires', sa.Float),
+            sa.Column('attempts', sa.Integer, nullable=False),
+            sa.Column('error', sa.Text),
+        )
+        metadata.create_all(self.engine, checkfirst=True)
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        return cls(sa.create_engine(url), **kwargs)
+
+    def enqueue(self, job_id, urls):
+        """Adds entries to a job.  Entries which are already queued are left alone"""
+        table = self.table
+
+        def insert_new(conn):
+            existing = set(
+                row.url for row in conn.execute(table.select().where(table.c.job_id == job_id))
+            )
+            new_rows = [
+                {'job_id': job_id, 'url': url, 'state': PENDING, 'attempts': 0}
+                for url in urls if url not in existing
+            ]
+            if new_rows:
+                conn.execute(table.insert(), new_rows)
+            return len(new_rows)
+        return self._run(insert_new)
+
+    def claim(self, job_id, worker_id, lease_seconds=SPECTRIFY_LEASE_SECONDS):
+        table = self.table
+        claimable = sa.or_(
+            table.c.state == PENDING,
+            sa.and_(table.c.state == LEASED, table.c.lease_expires < db_epoch()),
+        )
+        query = table.select().where(sa.and_(table.c.job_id == job_id, claimable)).limit(16)
+        candidates = self._run(lambda conn: conn.execute(query).fetchall())
+
+        for row in candidates:
+            if row.attempts >= self.max_attempts:
+                self._update_row(row, state=FAILED, owner=None, error='Lease expired too many times')
+                continue
+
+            task = Task(job_id, row.url, worker_id, row.attempts + 1)
+            if self._update_row(row, state=LEASED, owner=worker_id, lease_expires=db_epoch() + lease_seconds,
+                                attempts=task.attempts):
+                return task
+
+        return None
+
+    def heartbeat(self, task, lease_seconds=SPECTRIFY_LEASE_SECONDS):
+        return self._update_task(task, lease_expires=db_epoch() + lease_seconds)
+
+    def complete(self, task):
+        return self._update_task(task, state=DONE, error=None)
+
+    def fail(self, task, error):
+        state = PENDING if task.attempts < self.max_attempts else FAILED
+        return self._update_task(task, state=state, owner=None, error=error)
+
+    def status(self, job_id):
+        table = self.table
+        query = table.select().where(table.c.job_id == job_id)
+        counts = {}
+        for row in self._run(lambda conn: conn.execute(query).fetchall()):
+            counts[row.state] = counts.get(row.state, 0) + 1
+        return counts
+
+    def _run(self, func):
+        """Returns func(conn), run in a transaction, which is retried while
+        the database is locked
+        """
+        delay = 0.05
+        for attempt in range(self.lock_retries + 1):
+            try:
+                with self.engine.begin() as conn:
+                    return func(conn)
+            except sa.exc.OperationalError as e:
+                if not is_locked_error(e) or attempt == self.lock_retries:
+                    raise
+            time.sleep(delay)
+            delay = min(delay * 2, 1.0)
+
+    def _update_row(self, row, **values):
+        """Updates a row only if nobody else has claimed it since it was read,
+        nor renewed the lease it had
+        """
+        table = self.table
+        conditions = [
+            table.c.job_id == row.job_id,
+            table.c.url == row.url,
+            table.c.state == row.state,
+            table.c.attempts == row.attempts,
+        ]
+        if row.state == LEASED:
+            conditions.append(table.c.lease_expires < db_epoch())
+        query = table.update().where(sa.and_(*conditions)).values(**values)
+        return self._run(lambda conn: conn.execute(query).rowcount == 1)
+
+    def _update_task(self, task, **values):
+        """Updates a leased task only if the lease still belongs to its owner"""
+        table = self.table
+        query = table.update().where(sa.and_(
+            table.c.job_id == task.job_id,
+            table.c.url == task.url,
+            table.c.state == LEASED,
+            table.c.owner == task.owner,
+            table.c.attempts == task.attempts,
+        )).values(**values)
+        return self._run(lambda conn: conn.execute(query).rowcount == 1)
+
+
+class LeaseHeartbeat(object):
+    """Renews the lease on a task in a background thread while it is being worked on"""
+
+    def __init__(self, queue, task, lease_seconds=SPECTRIFY_LEASE_SECONDS):
+        self.queue = queue
+        self.task = task
+        self.lease_seconds = lease_seconds
+        self.lost = False
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        # Renew well before the lease runs out
+        while not self.stopped.wait(self.lease_seconds / 3.0):
+            if not self.queue.heartbeat(self.task, self.lease_seconds):
+                self.lost = True
+                return
+
+
+class QueueWorker(object):
+    """Converts the entries of a job claimed from a WorkQueue until the job is finished"""
+
+    def __init__(self, queue, converter, worker_id=None, lease_seconds=SPECTRIFY_LEASE_SECONDS,
+                 poll_seconds=SPECTRIFY_POLL_SECONDS):
+        self.queue = queue
+        self.converter = converter
+        self.worker_id = worker_id or get_worker_id()
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+
+    def log(self, msg):
+        """By default, we log to console with click"""
+        click.echo(msg)
+
+    def run(self, job_id):
+        """Returns the number of entries converted by this worker"""
+        num_converted = 0
+        while True:
+            task = self.queue.claim(job_id, self.worker_id, self.lease_seconds)
+            if task is None:
+                if self.queue.is_finished(job_id):
+                    return num_converted
+                # Other workers hold the remaining leases; wait in case one expires
+                time.sleep(self.poll_seconds)
+                continue
+
+            if self.process(task):
+                num_converted += 1
+
+    def process(self, task):
+        try:
+            with LeaseHeartbeat(self.queue, task, self.lease_seconds) as heartbeat:
+                self.converter.convert_csv(task.url)
+        except Exception as e:
+            self.log('Failed converting [%s]: %s' % (task.url, e))
+            self.queue.fail(task, str(e))
+            return False
+
+        if heartbeat.lost or not self.queue.complete(task):
+            # Another worker took over; its output will overwrite ours
+            self.log('Lost lease on [%s]' % task.url)
+            return False
+        return True
+
+
+def _queue_worker_wrapper(arg_tuple):
+    (queue_url, job_id, sa_table, s3_config, delimiter, escapechar, quoting,
+     converter_kwargs) = arg_tuple
+    queue = SqlWorkQueue.from_url(queue_url)
+    converter = CsvConverter(sa_table, s3_config, delimiter, escapechar, quoting, **converter_kwargs)
+    return QueueWorker(queue, converter).run(job_id)
+
+
+class QueueManifestConverter(CsvConverter):
+    """Converts a manifest in cooperation with workers on other hosts, by
+    sharing its entries through a SqlWorkQueue.
+    """
+
+    def __init__(self, sa_table, s3_config, queue_url, **kwargs):
+        CsvConverter.__init__(self, sa_table, s3_config, **kwargs)
+        self.queue_url = queue_url
+
+    def get_job_id(self):
+        return self.kwargs.get('job_id') or self.s3_config.get_manifest_path()
+
+    def enqueue_manifest(self):
+        """Adds the manifest entries to the queue.  Returns the job id"""
+        manifest = self.get_manifest()
+        job_id = self.get_job_id()
+        num_added = SqlWorkQueue.from_url(self.queue_url).enqueue(
+            job_id, [entry['url'] for entry in manifest['entries']])
+        self.log('Queued %d entries for job [%s]' % (num_added, job_id))
+        return job_id
+
+    def convert_manifest(self):
+        """Runs workers on this host until the job is finished.  Returns the
+        number of entries converted on this host.
+        """
+        num_workers = self.kwargs.get('num_workers') or cpu_count()
+        convert_args = [
+            (
+                self.queue_url, self.get_job_id(), self.sa_table, self.s3_config, self.delimiter,
+                self.escapechar, self.quoting, self.get_worker_kwargs()
+            )
+        ] * num_workers
+
+        with _PoolManager(num_workers) as pool:
+            return sum(pool.map(_queue_worker_wrapper, convert_args, chunksize=1))
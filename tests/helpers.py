@@ -0,0 +1,46 @@
+"""Fixtures shared by the test modules"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+
+import fsspec
+from fsspec.implementations.local import LocalFileSystem
+
+from spectrify.utils.s3 import SimpleS3Config
+
+
+def local_path(file_path):
+    """Maps s3://tmp/... URLs, and tmp/... paths with the bucket's slash
+    stripped, to /tmp/...
+    """
+    if file_path.startswith('s3://'):
+        file_path = file_path[len('s3://'):]
+    return '/' + file_path.lstrip('/')
+
+
+class LocalS3Config(SimpleS3Config):
+    """Reads s3://tmp/... URLs from /tmp/..."""
+
+    def get_fs(self):
+        return fsspec.filesystem('file')
+
+    def fs_open(self, file_path, mode='rb', **kwargs):
+        return SimpleS3Config.fs_open(self, local_path(file_path), mode, **kwargs)
+
+    def fs_size(self, file_path):
+        return SimpleS3Config.fs_size(self, local_path(file_path))
+
+
+class CachingFileSystem(LocalFileSystem):
+    """Keeps listings until invalidated or refreshed, like s3fs"""
+
+    def __init__(self, *args, **kwargs):
+        super(CachingFileSystem, self).__init__(*args, **kwargs)
+        self.listings = {}
+
+    def ls(self, path, detail=False, refresh=False, **kwargs):
+        key = (path.rstrip('/'), detail)
+        if refresh or key not in self.listings:
+            self.listings[key] = super(CachingFileSystem, self).ls(path, detail=detail, **kwargs)
+        return self.listings[key]
+
+    def invalidate_cache(self, path=None):
+        self.listings.clear()
@@ -0,0 +1,115 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import json
+import shutil
+import tempfile
+from os import listdir, makedirs, path
+from unittest import main, TestCase
+
+import pyarrow.parquet as pq
+import sqlalchemy as sa
+
+from spectrify.compact import JOURNAL_NAME, ParquetCompactor, read_lineage
+from spectrify.utils.parquet import Writer
+from tests.helpers import LocalS3Config
+
+
+class TestParquetCompactor(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.s3_config = LocalS3Config.from_base_path(self.tmp_dir)
+        self.spectrum_dir = self.s3_config.get_spectrum_dir()
+        self.partition_dir = path.join(self.spectrum_dir, 'dt=2020-01-01')
+        makedirs(self.partition_dir)
+        self.table = sa.Table(
+            'unit_test_table',
+            sa.MetaData(),
+            sa.Column('int_col', sa.INTEGER),
+            sa.Column('str_col', sa.VARCHAR(64)),
+        )
+        self.compactor = ParquetCompactor(self.s3_config, target_size=2**20, rows_per_group=25)
+        self.compactor.log = lambda msg: None
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_parquet(self, dir_path, name, values):
+        with open(path.join(dir_path, name), 'wb') as parquet_file:
+            with Writer(parquet_file, self.table) as writer:
+                # The repeated strings are dictionary encoded in some files only
+                writer.write_row_group([values, ['same'] * len(values) if values[0] % 2 else
+                                        ['value {}'.format(v) for v in values]])
+
+    def read_dir(self, dir_path):
+        names = sorted(name for name in listdir(dir_path) if name.endswith('.parq'))
+        rows = []
+        for name in names:
+            rows.extend(pq.read_table(path.join(dir_path, name)).column('int_col').to_pylist())
+        return names, sorted(rows)
+
+    def test_compact(self):
+        for i in range(4):
+            self.write_parquet(self.spectrum_dir, '{:04d}_part_00.parq'.format(i), list(range(i * 10, i * 10 + 10)))
+        for i in range(3):
+            self.write_parquet(self.partition_dir, '{:04d}_part_00.parq'.format(i), list(range(i * 7, i * 7 + 7)))
+
+        self.assertEqual(7, self.compactor.compact())
+
+        names, rows = self.read_dir(self.spectrum_dir)
+        self.assertEqual(1, len(names))
+        self.assertTrue(names[0].startswith('compacted_'))
+        self.assertEqual(list(range(40)), rows)
+        # Full row groups of 25 rows, then the remainder
+        metadata = pq.ParquetFile(path.join(self.spectrum_dir, names[0])).metadata
+        self.assertEqual([25, 15], [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)])
+
+        names, rows = self.read_dir(self.partition_dir)
+        self.assertEqual(1, len(names))
+        self.assertEqual(list(range(21)), rows)
+
+        # Nothing left to do
+        self.assertEqual(0, self.compactor.compact())
+
+    def test_compact_partition(self):
+        for i in range(2):
+            self.write_parquet(self.spectrum_dir, '{:04d}_part_00.parq'.format(i), [i])
+            self.write_parquet(self.partition_dir, '{:04d}_part_00.parq'.format(i), [i])
+
+        self.assertEqual(2, self.compactor.compact(['dt=2020-01-01']))
+        self.assertEqual(2, len(self.read_dir(self.spectrum_dir)[0]))
+        self.assertEqual(1, len(self.read_dir(self.partition_dir)[0]))
+
+    def test_recover_interrupted_merge(self):
+        for i in range(2):
+            self.write_parquet(self.partition_dir, '{:04d}_part_00.parq'.format(i), [i])
+        # Merged file made visible, but the replaced files weren't deleted yet
+        shutil.copy(
+            path.join(self.partition_dir, '0000_part_00.parq'), path.join(self.partition_dir, 'compacted_x.parq'))
+        with open(path.join(self.partition_dir, JOURNAL_NAME), 'w') as journal_file:
+            json.dump({
+                'temp_path': path.join(self.partition_dir, '_spectrify_compact_x.parq'),
+                'new_path': path.join(self.partition_dir, 'compacted_x.parq'),
+                'replaced_paths': [path.join(self.partition_dir, '0000_part_00.parq')],
+            }, journal_file)
+
+        self.compactor.recover(self.partition_dir)
+        self.assertEqual(['0001_part_00.parq', 'compacted_x.parq'], sorted(listdir(self.partition_dir)))
+
+    def test_lineage(self):
+        for i in range(3):
+            self.write_parquet(self.spectrum_dir, '{:04d}_part_00.parq'.format(i), list(range(i * 10, i * 10 + i + 1)))
+        self.compactor.compact()
+        first_name = self.read_dir(self.spectrum_dir)[0][0]
+        self.assertEqual({first_name: {'0000_part_00.parq': 1, '0001_part_00.parq': 2, '0002_part_00.parq': 3}},
+                         read_lineage(self.s3_config, self.spectrum_dir))
+
+        # Files merged again keep their original files
+        self.write_parquet(self.spectrum_dir, '0003_part_00.parq', [30])
+        self.compactor.compact()
+        second_name = self.read_dir(self.spectrum_dir)[0][0]
+        self.assertEqual({second_name: {
+            '0000_part_00.parq': 1, '0001_part_00.parq': 2, '0002_part_00.parq': 3, '0003_part_00.parq': 1,
+        }}, read_lineage(self.s3_config, self.spectrum_dir))
+
+
+if __name__ == "__main__":
+    main()
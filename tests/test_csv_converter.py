@@ -3,11 +3,15 @@ from unittest import main, TestCase
 import copy
 import csv
 import gzip
+import math
+import multiprocessing
 import sys
 
+import pyarrow.parquet as pq
 import sqlalchemy
 
-from spectrify.convert import CsvConverter
+from spectrify import convert
+from spectrify.convert import CsvConverter, HybridManifestConverter, PipelinedCsvConverter
 from spectrify.utils.s3 import SimpleS3Config
 
 
@@ -31,7 +35,8 @@ class FakeSimpleS3Config(SimpleS3Config):
         SimpleS3Config.__init__(self, *args, **kwargs)
         self._gzip_csv = BytesIO()
         with get_stream(gzip.GzipFile(fileobj=self._gzip_csv, mode='wb')) as gz:
-            writer = csv.writer(gz, delimiter=delimiter, escapechar=escapechar, quoting=quoting)
+            # Lines end with newlines, as in UNLOAD files
+            writer = csv.writer(gz, delimiter=delimiter, escapechar=escapechar, quoting=quoting, lineterminator='\n')
             for row in csv_rows:
                 writer.writerow(row)
 
@@ -40,6 +45,16 @@ class FakeSimpleS3Config(SimpleS3Config):
         return self._gzip_csv
 
 
+class OutputCapturingS3Config(FakeSimpleS3Config):
+    """Reads the CSV like FakeSimpleS3Config, and keeps what is written"""
+    def fs_open(self, path, mode='rb', **kwargs):
+        if mode == 'wb':
+            self.output = BytesIO()
+            self.output.close = lambda: None
+            return self.output
+        return FakeSimpleS3Config.fs_open(self, path, mode, **kwargs)
+
+
 class TestCsvConverter(TestCase):
     def test_columnar_data_chunks(self):
         delimiter = ","
@@ -87,6 +102,120 @@ class TestCsvConverter(TestCase):
             columnar_data_chunks
         )
 
+    def test_memoized_columnar_data_chunks(self):
+        sa_meta = sqlalchemy.MetaData()
+        data = [
+            ['1', 'active', '2020-01-01'],
+            ['2', 'active', '2020-01-01'],
+            ['3', '', '2020-01-02'],
+            ['4', 'active', ''],
+        ]
+        sa_table = sqlalchemy.Table(
+            'unit_test_table',
+            sa_meta,
+            sqlalchemy.Column('int_col', sqlalchemy.INTEGER),
+            sqlalchemy.Column('str_col', sqlalchemy.VARCHAR),
+            sqlalchemy.Column('date_col', sqlalchemy.DATE),
+        )
+        s3_config = FakeSimpleS3Config(data, csv_dir="", spectrum_dir="", region="")
+        csv_converter = CsvConverter(sa_table, s3_config, memoize=True)
+        csv_converter.log = lambda msg: None
+        chunks = [
+            [list(col) for col in chunk]
+            for chunk in csv_converter.columnar_data_chunks(data_path="", sa_table=sa_table, chunk_size=2)
+        ]
+        self.assertEqual(
+            [
+                [[1, 2], [b'active', b'active'], [18262, 18262]],
+                [[3, 4], [None, b'active'], [18263, None]],
+            ],
+            chunks
+        )
+
+    def test_timestamp_units(self):
+        data = [['1', '2020-01-01 00:00:01.234567'], ['2', '1969-12-31 23:59:59.9995'], ['3', '']]
+        sa_table = sqlalchemy.Table(
+            'unit_test_table',
+            sqlalchemy.MetaData(),
+            sqlalchemy.Column('int_col', sqlalchemy.INTEGER),
+            sqlalchemy.Column('timestamp_col', sqlalchemy.TIMESTAMP),
+        )
+        expected = {
+            'int96': [1577836801234567000, -500000, None],
+            'us': [1577836801234567, -500, None],
+            'ms': [1577836801234, -1, None],
+        }
+        for timestamp_unit, expected_values in expected.items():
+            s3_config = FakeSimpleS3Config(data, csv_dir="", spectrum_dir="", region="")
+            csv_converter = CsvConverter(sa_table, s3_config, timestamp_unit=timestamp_unit)
+            chunks = [
+                copy.deepcopy(chunk)
+                for chunk in csv_converter.columnar_data_chunks(data_path="", sa_table=sa_table, chunk_size=3)
+            ]
+            self.assertEqual([[1, 2, 3], expected_values], chunks[0])
+
+    def test_pipelined_convert_csv(self):
+        data = [[str(i), 'value {}'.format(i % 3)] for i in range(100)]
+        sa_table = sqlalchemy.Table(
+            'unit_test_table',
+            sqlalchemy.MetaData(),
+            sqlalchemy.Column('int_col', sqlalchemy.INTEGER),
+            sqlalchemy.Column('str_col', sqlalchemy.VARCHAR),
+        )
+        s3_config = OutputCapturingS3Config(data, csv_dir="", spectrum_dir="", region="")
+        csv_converter = PipelinedCsvConverter(sa_table, s3_config)
+        csv_converter.log = lambda msg: None
+        csv_converter.convert_csv('0000_part_00.gz')
+
+        table = pq.read_table(BytesIO(s3_config.output.getvalue()))
+        self.assertEqual(list(range(100)), table.column('int_col').to_pylist())
+        self.assertEqual([row[1] for row in data], table.column('str_col').to_pylist())
+        self.assertTrue(0 <= csv_converter.python_fraction <= 1)
+
+    def test_spilled_row_groups(self):
+        data = [[str(i), 'value {}'.format(i)] for i in range(25)]
+        sa_table = sqlalchemy.Table(
+            'unit_test_table',
+            sqlalchemy.MetaData(),
+            sqlalchemy.Column('int_col', sqlalchemy.INTEGER),
+            sqlalchemy.Column('str_col', sqlalchemy.VARCHAR),
+        )
+        s3_config = OutputCapturingS3Config(data, csv_dir="", spectrum_dir="", region="")
+        csv_converter = CsvConverter(sa_table, s3_config, spill_rows=4)
+        csv_converter.log = lambda msg: None
+        rows_per_group = convert.SPECTRIFY_ROWS_PER_GROUP
+        convert.SPECTRIFY_ROWS_PER_GROUP = 10
+        try:
+            csv_converter.convert_csv('0000_part_00.gz')
+        finally:
+            convert.SPECTRIFY_ROWS_PER_GROUP = rows_per_group
+
+        parq_file = pq.ParquetFile(BytesIO(s3_config.output.getvalue()))
+        metadata = parq_file.metadata
+        self.assertEqual([12, 12, 1], [metadata.row_group(i).num_rows for i in range(metadata.num_row_groups)])
+        self.assertEqual([row[1] for row in data], parq_file.read().column('str_col').to_pylist())
+
+    def test_positional_unicode_csv(self):
+        # The deprecated unicode_csv argument keeps its position
+        csv_converter = CsvConverter(None, None, '|', '\\', csv.QUOTE_NONE, True)
+        self.assertFalse(csv_converter.memoize)
+
+    def test_hybrid_num_workers(self):
+        converter = HybridManifestConverter(None, None)
+        num_cpus = multiprocessing.cpu_count()
+        self.assertEqual(num_cpus, converter.get_num_workers(1.0))
+        self.assertEqual(1, converter.get_num_workers(0.0))
+        self.assertEqual(int(math.ceil(num_cpus * 0.3)), converter.get_num_workers(0.3))
+
+    def test_batches(self):
+        urls = ['{:04d}_part_00.gz'.format(i) for i in range(100)]
+        batches = convert.get_batches(urls, 4, 2)
+        # A file and the two files prefetched while it's converted
+        self.assertEqual([3], sorted(set(len(batch) for batch in batches[:-1])))
+        self.assertEqual(urls, [url for batch in batches for url in batch])
+        # With fewer files than workers, each file is a batch of its own
+        self.assertEqual([urls[:1], urls[1:2], urls[2:3]], convert.get_batches(urls[:3], 4, 2))
+
 
 if __name__ == "__main__":
     main()
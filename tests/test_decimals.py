@@ -0,0 +1,70 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from decimal import Decimal
+from unittest import main, TestCase
+
+import pyarrow as pa
+
+from spectrify.utils.decimals import (
+    parse_scaled_decimal, scaled_ints_to_decimal128_array, strings_to_decimal128_array, to_decimal128_array
+)
+
+
+class TestParseScaledDecimal(TestCase):
+    def test_parse(self):
+        self.assertEqual(12345, parse_scaled_decimal('123.45', 10, 2))
+        self.assertEqual(-12345, parse_scaled_decimal('-123.45', 10, 2))
+        self.assertEqual(12300, parse_scaled_decimal('123', 10, 2))
+        self.assertEqual(-5, parse_scaled_decimal('-0.05', 10, 2))
+        self.assertEqual(50, parse_scaled_decimal('.5', 10, 2))
+        self.assertEqual(123, parse_scaled_decimal('123', 3, 0))
+        self.assertEqual(12340, parse_scaled_decimal('1.2340', 10, 4))
+
+    def test_unusual_formatting(self):
+        self.assertEqual(12300, parse_scaled_decimal('1.23E+2', 10, 2))
+        self.assertEqual(12345, parse_scaled_decimal('123.4500', 10, 2))
+        self.assertEqual(12340, parse_scaled_decimal('123.4', 10, 2))
+        with self.assertRaises(ValueError):
+            parse_scaled_decimal('123.456', 10, 2)
+
+    def test_overflow(self):
+        self.assertEqual(99999, parse_scaled_decimal('999.99', 5, 2))
+        with self.assertRaises(ValueError):
+            parse_scaled_decimal('1000.00', 5, 2)
+        with self.assertRaises(ValueError):
+            parse_scaled_decimal('-1000', 5, 2)
+
+
+class TestDecimal128Array(TestCase):
+    def test_matches_arrow_conversion(self):
+        arrow_type = pa.decimal128(38, 4)
+        strings = ['0', '-1.5', None, '12345678901234567890123456789012.3456',
+                   '-99999999999999999999999999999999.9999', '0.0001', None, None, '-0.0001']
+        scaled = [None if s is None else parse_scaled_decimal(s, 38, 4) for s in strings]
+        expected = pa.array([None if s is None else Decimal(s) for s in strings], arrow_type)
+
+        arr = scaled_ints_to_decimal128_array(scaled, arrow_type)
+        arr.validate(full=True)
+        self.assertEqual(expected.null_count, arr.null_count)
+        self.assertEqual(expected.to_pylist(), arr.to_pylist())
+
+    def test_no_nulls(self):
+        arrow_type = pa.decimal128(5, 2)
+        arr = scaled_ints_to_decimal128_array([1, -2, 3], arrow_type)
+        self.assertEqual(0, arr.null_count)
+        self.assertEqual([Decimal('0.01'), Decimal('-0.02'), Decimal('0.03')], arr.to_pylist())
+
+    def test_strings(self):
+        arrow_type = pa.decimal128(5, 2)
+        arr = to_decimal128_array(['1.25', None, '-999.99'], arrow_type)
+        self.assertEqual([Decimal('1.25'), None, Decimal('-999.99')], arr.to_pylist())
+        with self.assertRaises(pa.ArrowInvalid):
+            strings_to_decimal128_array(['1000.00'], arrow_type)
+
+    def test_decimal_objects(self):
+        arrow_type = pa.decimal128(5, 2)
+        arr = to_decimal128_array([Decimal('1.25'), None], arrow_type)
+        self.assertEqual([Decimal('1.25'), None], arr.to_pylist())
+
+
+if __name__ == "__main__":
+    main()
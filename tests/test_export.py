@@ -0,0 +1,217 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import json
+import pickle
+import shutil
+import tempfile
+import threading
+from datetime import date, datetime
+from os import mkdir, path
+from unittest import main, TestCase
+
+import sqlalchemy as sa
+
+from spectrify.export import (
+    DEFAULT_LAYOUT, RedshiftDataExporter, ShardedRedshiftDataExporter, UnloadLayout, estimate_export_size_mb,
+    get_shard_bounds, get_shard_predicates, get_unload_layout, plan_unload_layout
+)
+from spectrify.utils.s3 import ShardS3Config, SimpleS3Config
+from tests.helpers import LocalS3Config
+
+
+class TestRedshiftDataExporter(TestCase):
+    def setUp(self):
+        self.s3_config = SimpleS3Config.from_base_path('s3://some_bucket/prefix')
+
+    def test_select_all(self):
+        exporter = RedshiftDataExporter(None, self.s3_config)
+        self.assertEqual('select * from my_schema.my_table', exporter.get_select_query('my_schema.my_table'))
+        self.assertIn("UNLOAD ('select * from my_schema.my_table')", exporter.get_query('my_schema.my_table'))
+        self.assertIn('PARALLEL ON\n    MAXFILESIZE 256 mb;', exporter.get_query('my_schema.my_table'))
+
+    def test_layout(self):
+        exporter = RedshiftDataExporter(None, self.s3_config, layout=UnloadLayout(False, 64))
+        self.assertIn('PARALLEL OFF\n    MAXFILESIZE 64 mb;', exporter.get_query('my_table'))
+
+    def test_columns_and_where(self):
+        exporter = RedshiftDataExporter(
+            None, self.s3_config, columns=['id', 'name'], where="name like 'a%' and id > 10")
+        self.assertEqual(
+            'select "id", "name" from my_table where name like \'\'a%%\'\' and id > 10',
+            exporter.get_select_query('my_table'),
+        )
+
+
+class TestUnloadLayout(TestCase):
+    def test_large_table(self):
+        # 64 files wanted from 16 slices: 4 files per slice
+        self.assertEqual(UnloadLayout(True, 1000), plan_unload_layout(64000, 16, 32))
+        # Files are capped at max_file_mb
+        self.assertEqual(UnloadLayout(True, 1024), plan_unload_layout(640000, 16, 32))
+
+    def test_few_workers(self):
+        # Every slice writes a file anyway
+        self.assertEqual(UnloadLayout(True, 100), plan_unload_layout(1600, 16, 2))
+
+    def test_small_table_on_many_slices(self):
+        # 128 slices would write 128 tiny files; unload serially instead
+        self.assertEqual(UnloadLayout(False, 25), plan_unload_layout(200, 128, 4))
+        # Files aren't made smaller than min_file_mb
+        self.assertEqual(UnloadLayout(False, 16), plan_unload_layout(20, 128, 4))
+
+    def test_get_unload_layout(self):
+        engine = FakeLayoutEngine(num_slices=16)
+        self.assertEqual(UnloadLayout(True, 1000), get_unload_layout(engine, 'my_table', 32, table_size_mb=64000))
+        # Each shard is planned on its own
+        self.assertEqual(
+            UnloadLayout(True, 250), get_unload_layout(engine, 'my_table', 32, table_size_mb=64000, num_shards=4))
+        self.assertEqual(DEFAULT_LAYOUT, get_unload_layout(FakeLayoutEngine(None), 'my_table', 32, table_size_mb=1))
+
+    def test_estimate_export_size(self):
+        # SQLite stands in for Redshift, with a svv_table_info of its own
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        engine = sa.create_engine('sqlite:///' + path.join(tmp_dir, 'redshift.db'))
+        table = sa.Table(
+            'my_table', sa.MetaData(), sa.Column('id', sa.INTEGER), sa.Column('name', sa.VARCHAR(60)))
+        table.metadata.create_all(engine)
+        with engine.begin() as conn:
+            conn.execute(sa.text('create table svv_table_info ("schema" text, "table" text, size integer)'))
+            conn.execute(sa.text("insert into svv_table_info values ('public', 'my_table', 1280)"))
+            conn.execute(table.insert(), [{'id': i, 'name': 'row {}'.format(i)} for i in range(10)])
+
+        self.assertEqual(1280, estimate_export_size_mb(engine, 'my_table'))
+        # id is 4 of the 64 bytes of a row, and the predicate selects half of the rows
+        self.assertEqual(80, estimate_export_size_mb(engine, 'my_table', table, columns=['id']))
+        self.assertEqual(40, estimate_export_size_mb(engine, 'my_table', table, columns=['id'], where='id < 5'))
+        self.assertIsNone(estimate_export_size_mb(engine, 'other_table'))
+
+
+class FakeLayoutEngine(object):
+    def __init__(self, num_slices):
+        self.num_slices = num_slices
+
+    def connect(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def execute(self, query, params=None):
+        return self
+
+    def scalar(self):
+        return self.num_slices
+
+
+class TestShards(TestCase):
+    def test_bounds(self):
+        self.assertEqual([0, 25, 50, 75], get_shard_bounds(0, 100, 4))
+        # Duplicate bounds of a narrow range are dropped
+        self.assertEqual([1, 2], get_shard_bounds(1, 3, 4))
+        self.assertEqual([0.0, 0.5], get_shard_bounds(0.0, 1.0, 2))
+        self.assertEqual(
+            [date(2020, 1, 1), date(2020, 1, 16)], get_shard_bounds(date(2020, 1, 1), date(2020, 1, 31), 2))
+
+    def test_predicates(self):
+        self.assertEqual([None], get_shard_predicates('id', [5]))
+        self.assertEqual([
+            '"id" < 10 or "id" is null',
+            '"id" >= 10 and "id" < 20',
+            '"id" >= 20',
+        ], get_shard_predicates('id', [0, 10, 20]))
+        self.assertEqual([
+            '"ts" < \'2020-01-02 12:00:00\' or "ts" is null',
+            '"ts" >= \'2020-01-02 12:00:00\'',
+        ], get_shard_predicates('ts', [datetime(2020, 1, 1), datetime(2020, 1, 2, 12)]))
+
+    def test_shard_s3_config(self):
+        s3_config = SimpleS3Config.from_base_path('s3://some_bucket/prefix')
+        shard_config = ShardS3Config(s3_config, 3)
+        self.assertEqual('s3://some_bucket/prefix/csv/shard_003_', shard_config.get_csv_dir())
+        self.assertEqual('s3://some_bucket/prefix/csv/shard_003_manifest', shard_config.get_manifest_path())
+        self.assertEqual('s3://some_bucket/prefix/spectrum/', shard_config.get_spectrum_dir())
+        # Shard configs are handed to conversion processes
+        self.assertEqual(shard_config.get_csv_dir(), pickle.loads(pickle.dumps(shard_config)).get_csv_dir())
+
+
+class FakeResult(object):
+    def __init__(self, row):
+        self.row = row
+
+    def first(self):
+        return self.row
+
+
+class FakeEngine(object):
+    """Answers the range query, and 'unloads' a manifest with one entry"""
+
+    def __init__(self, low, high):
+        self.low = low
+        self.high = high
+        self.unloads = []
+        self.lock = threading.Lock()
+
+    def connect(self):
+        return self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+    def execute(self, query, params=None):
+        if params is None:
+            return FakeResult((self.low, self.high))
+        with self.lock:
+            self.unloads.append(query)
+        with open(params['s3_path'] + 'manifest', 'w') as manifest_file:
+            json.dump({'entries': [{'url': params['s3_path'] + '0000_part_00.gz'}]}, manifest_file)
+
+
+class TestShardedRedshiftDataExporter(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.s3_config = LocalS3Config.from_base_path(self.tmp_dir)
+        mkdir(self.s3_config.get_csv_dir())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_export(self):
+        engine = FakeEngine(0, 100)
+        exporter = ShardedRedshiftDataExporter(
+            engine, self.s3_config, 'id', num_shards=4, concurrency=2, where='active', credentials='creds')
+        exported = []
+        shard_configs = exporter.export_to_csv('my_table', on_shard_exported=exported.append)
+
+        self.assertEqual(4, len(shard_configs))
+        self.assertEqual(sorted(config.shard for config in shard_configs), sorted(config.shard for config in exported))
+        self.assertEqual(4, len(engine.unloads))
+        self.assertTrue(any(
+            'where (active) and ("id" >= 25 and "id" < 50)' in unload for unload in engine.unloads))
+
+        with open(self.s3_config.get_manifest_path()) as manifest_file:
+            manifest = json.load(manifest_file)
+        self.assertEqual(
+            [config.get_csv_dir() + '0000_part_00.gz' for config in shard_configs],
+            [entry['url'] for entry in manifest['entries']],
+        )
+
+    def test_empty_table(self):
+        engine = FakeEngine(None, None)
+        exporter = ShardedRedshiftDataExporter(engine, self.s3_config, 'id', credentials='creds')
+        self.assertEqual(1, len(exporter.export_to_csv('my_table')))
+        self.assertNotIn('where', engine.unloads[0].split('UNLOAD')[1].split(')')[0])
+
+    def test_unsupported_column(self):
+        exporter = ShardedRedshiftDataExporter(FakeEngine('a', 'z'), self.s3_config, 'name', credentials='creds')
+        with self.assertRaises(ValueError):
+            exporter.export_to_csv('my_table')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,43 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import shutil
+import tempfile
+from datetime import datetime
+from os import listdir
+from unittest import main, TestCase
+
+import sqlalchemy as sa
+
+from spectrify.utils.ipc import put_batch, take_batch
+from spectrify.utils.parquet import Writer
+
+
+class TestIpc(TestCase):
+    def setUp(self):
+        self.ipc_dir = tempfile.mkdtemp()
+        self.table = sa.Table(
+            'unit_test_table',
+            sa.MetaData(),
+            sa.Column('int_col', sa.INTEGER),
+            sa.Column('str_col', sa.VARCHAR),
+            sa.Column('timestamp_col', sa.TIMESTAMP),
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.ipc_dir)
+
+    def test_round_trip(self):
+        cols = [[1, 2, None], ['a', None, 'c'], [datetime(2020, 1, 1), None, datetime(2020, 1, 2, 3, 4, 5)]]
+        batch = Writer(None, self.table).to_record_batch(cols)
+
+        batch_path = put_batch(batch, ipc_dir=self.ipc_dir)
+        self.assertEqual(1, len(listdir(self.ipc_dir)))
+
+        taken = take_batch(batch_path)
+        self.assertTrue(taken.equals(batch))
+        self.assertEqual(cols, [col.to_pylist() for col in taken.columns])
+        # The file is gone once taken, but the batch is still readable
+        self.assertEqual([], listdir(self.ipc_dir))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from unittest import main, TestCase
+
+from spectrify.utils.memoize import MemoizedConverter
+
+
+class CountingFunc(object):
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, value):
+        self.calls += 1
+        return int(value)
+
+
+class TestMemoizedConverter(TestCase):
+    def test_repeated_values_convert_once(self):
+        func = CountingFunc()
+        memoizer = MemoizedConverter(func, max_size=10, probe_size=100)
+        values = ['1', '2', '1', '1', '2', '3']
+        self.assertEqual([1, 2, 1, 1, 2, 3], [memoizer(v) for v in values])
+        self.assertEqual(3, func.calls)
+        self.assertEqual(3, memoizer.hits)
+        self.assertEqual(3, memoizer.misses)
+        self.assertAlmostEqual(0.5, memoizer.hit_rate)
+
+    def test_eviction(self):
+        func = CountingFunc()
+        memoizer = MemoizedConverter(func, max_size=2, probe_size=100)
+        for value in ['1', '2', '3', '3']:
+            memoizer(value)
+        self.assertEqual(1, memoizer.evictions)
+        self.assertEqual(2, len(memoizer.cache))
+        self.assertNotIn('1', memoizer.cache)
+        self.assertEqual(1, memoizer.hits)
+
+    def test_disables_for_high_cardinality(self):
+        func = CountingFunc()
+        memoizer = MemoizedConverter(func, max_size=100, probe_size=10, min_hit_rate=0.5)
+        for value in range(20):
+            memoizer(str(value))
+        self.assertFalse(memoizer.enabled)
+        self.assertEqual({}, memoizer.cache)
+        self.assertEqual(20, func.calls)
+
+    def test_clear_keeps_stats(self):
+        memoizer = MemoizedConverter(None, probe_size=100)
+        memoizer('a')
+        memoizer('a')
+        memoizer.clear()
+        self.assertEqual({}, memoizer.cache)
+        self.assertEqual('a', memoizer('a'))
+        self.assertEqual(1, memoizer.hits)
+        self.assertEqual(2, memoizer.misses)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from os import makedirs, path
+from unittest import main, TestCase
+
+import pyarrow.parquet as pq
+import sqlalchemy as sa
+
+from spectrify.merge import INDEX_NAME, STATE_NAME, IncrementalMerger
+from spectrify.utils.parquet import Writer
+from tests.helpers import LocalS3Config
+
+
+class LocalMerger(IncrementalMerger):
+    """Exports changed rows from a list instead of with UNLOAD"""
+
+    def __init__(self, rows, *args, **kwargs):
+        IncrementalMerger.__init__(self, *args, **kwargs)
+        self.rows = rows
+
+    def log(self, msg):
+        pass
+
+    def export_changes(self, watermark, upper):
+        csv_dir = self.merge_config.get_csv_dir()
+        file_path = path.join(csv_dir, '0000_part_00.gz')
+        with gzip.open(file_path, 'wb') as csv_file:
+            for row in self.rows:
+                if watermark < row[2] <= upper:
+                    csv_file.write('|'.join(str(value) for value in row).encode('utf-8') + b'\n')
+        with open(self.merge_config.get_manifest_path(), 'w') as manifest_file:
+            json.dump({'entries': [{'url': 's3:/' + file_path}]}, manifest_file)
+
+
+class TestIncrementalMerger(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.s3_config = LocalS3Config.from_base_path(self.tmp_dir)
+        self.spectrum_dir = self.s3_config.get_spectrum_dir()
+        makedirs(self.spectrum_dir)
+        makedirs(path.join(self.s3_config.get_csv_dir(), 'merge', 'parquet'))
+        self.sa_table = sa.Table(
+            'unit_test_table',
+            sa.MetaData(),
+            sa.Column('id', sa.INTEGER),
+            sa.Column('name', sa.VARCHAR),
+            sa.Column('updated_at', sa.VARCHAR),
+        )
+        self.rows = [[i, 'row {}'.format(i), '2020-01-01 00:00:00'] for i in range(1, 7)]
+        self.write_file('0000_part_00.parq', self.rows[:3])
+        self.write_file('0001_part_00.parq', self.rows[3:])
+
+        self.engine = sa.create_engine('sqlite://')
+        self.db_table = sa.Table(
+            'unit_test_table',
+            sa.MetaData(),
+            sa.Column('id', sa.INTEGER),
+            sa.Column('name', sa.VARCHAR),
+            sa.Column('updated_at', sa.VARCHAR),
+        )
+        self.db_table.create(self.engine)
+        self.update_rows(self.rows)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_file(self, name, rows):
+        with open(path.join(self.spectrum_dir, name), 'wb') as parquet_file:
+            with Writer(parquet_file, self.sa_table) as writer:
+                writer.write_row_group([list(col) for col in zip(*rows)])
+
+    def update_rows(self, rows):
+        with self.engine.begin() as connection:
+            for row in rows:
+                connection.execute(self.db_table.delete().where(self.db_table.c.id == row[0]))
+                connection.execute(self.db_table.insert().values(id=row[0], name=row[1], updated_at=row[2]))
+        by_id = dict((row[0], row) for row in self.rows)
+        by_id.update((row[0], row) for row in rows)
+        self.rows = [by_id[key] for key in sorted(by_id)]
+
+    def merge(self, since=None):
+        merger = LocalMerger(self.rows, self.engine, 'unit_test_table', self.sa_table, self.s3_config, 'id',
+                             'updated_at')
+        return merger.merge(since=since)
+
+    def read_rows(self):
+        table = pq.read_table(self.spectrum_dir)
+        return sorted(zip(*[table.column(name).to_pylist() for name in ['id', 'name', 'updated_at']]))
+
+    def test_merge(self):
+        with self.assertRaises(ValueError):
+            self.merge()
+
+        self.update_rows([[2, 'row 2 v2', '2020-01-02 00:00:00'], [7, 'row 7', '2020-01-02 00:00:00']])
+        untouched_path = path.join(self.spectrum_dir, '0001_part_00.parq')
+        untouched_mtime = os.stat(untouched_path).st_mtime
+        counts = self.merge(since='2020-01-01 00:00:00')
+        self.assertEqual({'changed_rows': 2, 'updated_files': 1, 'inserted_rows': 1}, counts)
+        self.assertEqual([tuple(row) for row in self.rows], self.read_rows())
+        self.assertEqual(untouched_mtime, os.stat(untouched_path).st_mtime)
+
+        with open(path.join(self.spectrum_dir, STATE_NAME)) as state_file:
+            self.assertEqual('2020-01-02 00:00:00', json.load(state_file)['watermark'])
+        index = pq.read_table(path.join(self.spectrum_dir, INDEX_NAME))
+        self.assertEqual(list(range(1, 8)), sorted(index.column('key').to_pylist()))
+
+        self.assertEqual({'changed_rows': 0, 'updated_files': 0, 'inserted_rows': 0}, self.merge())
+
+        # The inserted row is found through the index
+        self.update_rows([[7, 'row 7 v2', '2020-01-03 00:00:00']])
+        self.assertEqual({'changed_rows': 1, 'updated_files': 1, 'inserted_rows': 0}, self.merge())
+        self.assertEqual([tuple(row) for row in self.rows], self.read_rows())
+
+    def test_rebuilt_index(self):
+        self.update_rows([[1, 'row 1 v2', '2020-01-02 00:00:00']])
+        self.merge(since='2020-01-01 00:00:00')
+
+        # Files written by something other than a merge aren't in the index
+        os.remove(path.join(self.spectrum_dir, '0001_part_00.parq'))
+        self.write_file('0002_part_00.parq', [[4, 'row 4', '2020-01-01 00:00:00']])
+        self.rows = [row for row in self.rows if row[0] not in (5, 6)]
+        self.update_rows([[4, 'row 4 v2', '2020-01-03 00:00:00']])
+        self.assertEqual({'changed_rows': 1, 'updated_files': 1, 'inserted_rows': 0}, self.merge())
+        self.assertEqual([tuple(row) for row in self.rows], self.read_rows())
+
+
+if __name__ == "__main__":
+    main()
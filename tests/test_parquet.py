@@ -1,4 +1,7 @@
 from __future__ import absolute_import, division, print_function, unicode_literals
+import os
+import shutil
+import tempfile
 from datetime import datetime
 from io import BytesIO
 from unittest import TestCase
@@ -7,7 +10,10 @@ import pyarrow as pa
 import pyarrow.parquet as pq
 import sqlalchemy as sa
 
-from spectrify.utils.parquet import Writer
+from spectrify.utils.parquet import (
+    DictionaryColumn, SpillingWriter, Writer, count_rows, new_columns, parse_dictionary_columns
+)
+from tests.helpers import CachingFileSystem, LocalS3Config
 
 
 class UncloseableBytesIO(BytesIO):
@@ -96,3 +102,176 @@ class TestParquetWriter(TestCase):
             # the timestamp type is 'ns'
             ts_col = parq_table.schema.field_by_name('timestamp_col')
             self.assertEqual(ts_col.type.unit, 'ns')
+
+    def test_dictionary_encoding(self):
+        table = sa.Table(
+            'dictionary_test_table',
+            self.sa_meta,
+            sa.Column('status_col', sa.VARCHAR),
+            sa.Column('forced_plain_col', sa.VARCHAR),
+            sa.Column('forced_dict_col', sa.TEXT),
+        )
+        statuses = ['active', 'inactive', None, 'active'] * 25
+        unique = ['value %d' % i for i in range(100)]
+
+        with UncloseableBytesIO() as write_buffer:
+            dictionary_columns = {'forced_plain_col': False, 'forced_dict_col': True}
+            with Writer(write_buffer, table, dictionary_columns=dictionary_columns) as writer:
+                for _ in range(2):
+                    data = new_columns(table, dictionary_columns)
+                    for column, values in zip(data, [statuses, statuses, unique]):
+                        column.extend(values)
+                    writer.write_row_group(data)
+            file_bytes = write_buffer.getvalue()
+
+        parq_table = pq.read_table(BytesIO(file_bytes))
+        self.assertEqual(200, parq_table.num_rows)
+        self.assertTrue(pa.types.is_dictionary(parq_table.schema.field('status_col').type))
+        self.assertTrue(pa.types.is_string(parq_table.schema.field('forced_plain_col').type))
+        self.assertTrue(pa.types.is_dictionary(parq_table.schema.field('forced_dict_col').type))
+        self.assertEqual(statuses * 2, parq_table.column('status_col').to_pylist())
+        self.assertEqual(unique * 2, parq_table.column('forced_dict_col').to_pylist())
+
+    def test_dictionary_column(self):
+        column = DictionaryColumn(probe_size=10)
+        column.extend(['a', None, 'b', 'a'] * 5)
+        self.assertEqual([0, None, 1, 0], column.indices[:4])
+        self.assertEqual(['a', 'b'], column.values)
+        self.assertTrue(column.is_low_cardinality())
+        self.assertEqual(['a', None, 'b', 'a'] * 5, column.to_arrow(pa.string(), True).to_pylist())
+        self.assertEqual(['a', None, 'b', 'a'] * 5, column.to_arrow(pa.string(), False).to_pylist())
+
+        # Too many distinct values after the probe: the values are kept plainly
+        unique = ['value %d' % i for i in range(20)]
+        column.extend(unique)
+        self.assertIsNone(column.indices)
+        self.assertFalse(column.is_low_cardinality())
+        self.assertEqual(['a', None, 'b', 'a'] * 5 + unique, list(column))
+        self.assertEqual(40, len(column))
+
+        forced = DictionaryColumn(encode=True, probe_size=10)
+        forced.extend(unique)
+        self.assertEqual(20, len(forced.values))
+
+    def test_parse_dictionary_columns(self):
+        self.assertIsNone(parse_dictionary_columns(''))
+        self.assertEqual({'status': True, 'comment': False}, parse_dictionary_columns('status, -comment'))
+
+    def test_threads(self):
+        file_bytes = []
+        for num_threads in (1, 4):
+            with UncloseableBytesIO() as write_buffer:
+                with Writer(write_buffer, self.table, num_threads=num_threads) as writer:
+                    writer.write_row_group(self.data)
+                    writer.write_row_group(self.data)
+                file_bytes.append(write_buffer.getvalue())
+        self.assertEqual(file_bytes[0], file_bytes[1])
+
+    def test_timestamp_units(self):
+        table = sa.Table('timestamp_test_table', self.sa_meta, sa.Column('timestamp_col', sa.TIMESTAMP))
+        timestamps = [datetime(2006, 1, 13, 12, 34, 56, 432000), None]
+        physical_types = {'int96': 'INT96', 'us': 'INT64', 'ms': 'INT64'}
+
+        for timestamp_unit, physical_type in physical_types.items():
+            with UncloseableBytesIO() as write_buffer:
+                with Writer(write_buffer, table, timestamp_unit=timestamp_unit) as writer:
+                    writer.write_row_group([timestamps])
+                file_bytes = write_buffer.getvalue()
+
+            parq_file = pq.ParquetFile(BytesIO(file_bytes))
+            self.assertEqual(physical_type, parq_file.schema.column(0).physical_type)
+            self.assertEqual(timestamps, parq_file.read().column('timestamp_col').to_pylist())
+
+        with self.assertRaises(ValueError):
+            Writer(None, table, timestamp_unit='s')
+
+
+class TestSpillingWriter(TestCase):
+    def setUp(self):
+        self.spill_dir = tempfile.mkdtemp()
+        self.table = sa.Table(
+            'spill_test_table',
+            sa.MetaData(),
+            sa.Column('int_col', sa.INTEGER),
+            sa.Column('status_col', sa.VARCHAR),
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.spill_dir)
+
+    def test_row_groups(self):
+        # Each batch has its own dictionary
+        batches = [[list(range(i * 4, i * 4 + 4)), ['status %d' % i] * 4] for i in range(5)]
+        with UncloseableBytesIO() as write_buffer:
+            with SpillingWriter(write_buffer, self.table, 8, spill_dir=self.spill_dir,
+                                dictionary_columns={'status_col': True}) as writer:
+                for batch in batches:
+                    writer.write_row_group(batch)
+                self.assertEqual(1, len(os.listdir(self.spill_dir)))
+            file_bytes = write_buffer.getvalue()
+
+        self.assertEqual([], os.listdir(self.spill_dir))
+        parq_file = pq.ParquetFile(BytesIO(file_bytes))
+        row_groups = [parq_file.metadata.row_group(i).num_rows for i in range(parq_file.metadata.num_row_groups)]
+        self.assertEqual([8, 8, 4], row_groups)
+        parq_table = parq_file.read()
+        self.assertTrue(pa.types.is_dictionary(parq_table.schema.field('status_col').type))
+        self.assertEqual(list(range(20)), parq_table.column('int_col').to_pylist())
+        self.assertEqual(
+            [status for batch in batches for status in batch[1]], parq_table.column('status_col').to_pylist())
+
+    def test_error(self):
+        with self.assertRaises(ValueError):
+            with UncloseableBytesIO() as write_buffer:
+                with SpillingWriter(write_buffer, self.table, 8, spill_dir=self.spill_dir) as writer:
+                    writer.write_row_group([[1], ['a']])
+                    raise ValueError()
+        self.assertEqual([], os.listdir(self.spill_dir))
+
+
+class TestCountRows(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.s3_config = LocalS3Config.from_base_path(self.tmp_dir)
+        self.table = sa.Table('count_test_table', sa.MetaData(), sa.Column('int_col', sa.INTEGER))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_parquet(self, partition, name, num_rows):
+        dir_path = os.path.join(self.s3_config.get_spectrum_dir(), partition)
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+        with open(os.path.join(dir_path, name), 'wb') as parquet_file:
+            with Writer(parquet_file, self.table) as writer:
+                writer.write_row_group([list(range(num_rows))])
+
+    def test_count_rows(self):
+        self.write_parquet('', '0000_part_00.parq', 5)
+        self.write_parquet('dt=2020-01-01', '0000_part_00.parq', 3)
+        self.write_parquet('dt=2020-01-01', '0001_part_00.parq', 4)
+        self.write_parquet('dt=2020-01-02/region=us', '0000_part_00.parq', 2)
+        # Hidden files (e.g. in-progress compactions) don't count
+        self.write_parquet('dt=2020-01-02', '_spectrify_compact_x.parq', 100)
+
+        num_rows, partition_rows = count_rows(self.s3_config, self.s3_config.get_spectrum_dir())
+        self.assertEqual(14, num_rows)
+        self.assertEqual({'dt=2020-01-01': 7, 'dt=2020-01-02/region=us': 2}, partition_rows)
+
+    def test_count_rows_lists_again(self):
+        fs = CachingFileSystem(skip_instance_cache=True)
+
+        class CachingS3Config(LocalS3Config):
+            def get_fs(self):
+                return fs
+
+        s3_config = CachingS3Config.from_base_path(self.tmp_dir)
+        self.write_parquet('dt=2020-01-01', '0000_part_00.parq', 3)
+        self.assertEqual(3, count_rows(s3_config, s3_config.get_spectrum_dir())[0])
+
+        # Written since the directories were listed (e.g. by another process)
+        self.write_parquet('dt=2020-01-01', '0001_part_00.parq', 4)
+        self.write_parquet('dt=2020-01-02', '0000_part_00.parq', 2)
+        num_rows, partition_rows = count_rows(s3_config, s3_config.get_spectrum_dir())
+        self.assertEqual(9, num_rows)
+        self.assertEqual({'dt=2020-01-01': 7, 'dt=2020-01-02': 2}, partition_rows)
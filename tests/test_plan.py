@@ -0,0 +1,105 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import gzip
+import json
+import shutil
+import tempfile
+from os import mkdir, path
+from unittest import main, TestCase
+
+import sqlalchemy as sa
+
+from spectrify.plan import ConversionPlanner, format_plan
+from tests.helpers import LocalS3Config
+
+
+class TestConversionPlanner(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.s3_config = LocalS3Config.from_base_path(self.tmp_dir)
+        mkdir(self.s3_config.get_csv_dir())
+        self.table = sa.Table(
+            'unit_test_table',
+            sa.MetaData(),
+            sa.Column('int_col', sa.INTEGER),
+            sa.Column('varchar_col', sa.VARCHAR(64)),
+            sa.Column('timestamp_col', sa.TIMESTAMP),
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_csvs(self, num_files, num_rows, compressed=True, verbose=False):
+        entries = []
+        for i in range(num_files):
+            name = '{:04d}_part_00{}'.format(i, '.gz' if compressed else '')
+            file_path = path.join(self.s3_config.get_csv_dir(), name)
+            opener = gzip.open if compressed else open
+            with opener(file_path, 'wb') as csv_file:
+                for row in range(num_rows):
+                    line = '{:05d}|row {:05d}|2020-01-01 00:00:{:02d}\n'.format(row, row, row % 60)
+                    csv_file.write(line.encode('utf-8'))
+            entry = {'url': 's3:/' + file_path}
+            if verbose:
+                entry['meta'] = {'record_count': num_rows}
+            entries.append(entry)
+        with open(self.s3_config.get_manifest_path(), 'w') as manifest_file:
+            json.dump({'entries': entries}, manifest_file)
+
+    def plan(self, **kwargs):
+        planner = ConversionPlanner(
+            self.table, self.s3_config, codecs=['snappy'], compression='gzip', worker_counts=[1, 2], **kwargs)
+        planner.log = lambda msg: None
+        return planner.plan()
+
+    def test_whole_files(self):
+        self.write_csvs(4, 100)
+        plan = self.plan(sample_files=2)
+        self.assertEqual(4, plan['files'])
+        self.assertEqual(2, plan['sample']['files'])
+        self.assertEqual(200, plan['sample']['rows'])
+        self.assertEqual(400, plan['estimated_rows'])
+        self.assertEqual(['gzip', 'snappy'], sorted(plan['output_bytes']))
+        self.assertEqual([1, 2], [estimate['workers'] for estimate in plan['workers']])
+        self.assertGreater(plan['peak_rss_per_worker'], 0)
+        self.assertEqual(2 * plan['peak_rss_per_worker'], plan['workers'][1]['peak_rss'])
+        self.assertTrue(format_plan(plan))
+
+    def test_compressed_sample(self):
+        self.write_csvs(1, 20000, verbose=True)
+        plan = self.plan(sample_bytes=4096)
+        self.assertLess(plan['sample']['rows'], 20000)
+        self.assertLess(plan['sample']['bytes'], plan['input_bytes'])
+        # The manifest's record counts are used where present
+        self.assertEqual(20000, plan['estimated_rows'])
+
+    def test_uncompressed_sample(self):
+        self.write_csvs(2, 2000, compressed=False)
+        plan = self.plan(sample_bytes=4096)
+        self.assertEqual(8192, plan['sample']['bytes'])
+        self.assertLess(plan['sample']['rows'], 4000)
+        # Extrapolated from the sampled rows per byte
+        self.assertAlmostEqual(4000, plan['estimated_rows'], delta=200)
+
+    def test_split_rows(self):
+        planner = ConversionPlanner(self.table, self.s3_config, split_size=4000)
+        self.assertEqual([100], planner.split_rows({'url': 's3://bucket/0000_part_00.gz'}, 10000, 100))
+        # Uncompressed files are converted in byte ranges
+        self.assertEqual([40, 40, 20], planner.split_rows({'url': 's3://bucket/0000_part_00'}, 10000, 100))
+
+    def test_samples_skip_slice_cache(self):
+        self.write_csvs(2, 100)
+        opened = []
+
+        class RecordingS3Config(LocalS3Config):
+            def fs_open(self, file_path, mode='rb', cache=False, **kwargs):
+                opened.append(cache)
+                return LocalS3Config.fs_open(self, file_path, mode, **kwargs)
+
+        self.s3_config = RecordingS3Config.from_base_path(self.tmp_dir)
+        self.plan()
+        self.assertTrue(opened)
+        self.assertFalse(any(opened))
+
+
+if __name__ == "__main__":
+    main()
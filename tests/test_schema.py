@@ -0,0 +1,76 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import shutil
+import tempfile
+from unittest import main, TestCase
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.postgresql import DOUBLE_PRECISION, TIMESTAMP
+
+from spectrify.utils.schema import (
+    SchemaCache, dict_to_table, parse_column_list, project_table, split_table_name, table_to_dict
+)
+
+
+class TestSchemaCache(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.cache = SchemaCache(self.cache_dir)
+        self.table = sa.Table(
+            'unit_test_table',
+            sa.MetaData(),
+            sa.Column('varchar_col', sa.VARCHAR(256)),
+            sa.Column('numeric_col', sa.NUMERIC(18, 2)),
+            sa.Column('double_col', DOUBLE_PRECISION),
+            sa.Column('timestamp_col', TIMESTAMP),
+            sa.Column('timestamptz_col', sa.TIMESTAMP(timezone=True)),
+            sa.Column('date_col', sa.DATE),
+            schema='my_schema',
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def assertSameTable(self, expected, actual):
+        self.assertEqual(expected.name, actual.name)
+        self.assertEqual(expected.schema, actual.schema)
+        self.assertEqual(
+            [(col.name, col.type.__class__, repr(col.type)) for col in expected.columns],
+            [(col.name, col.type.__class__, repr(col.type)) for col in actual.columns],
+        )
+
+    def test_serialization(self):
+        self.assertSameTable(self.table, dict_to_table(table_to_dict(self.table), sa.MetaData()))
+
+    def test_load_and_store(self):
+        cluster = 'example-cluster:5439/db'
+        self.assertIsNone(self.cache.load(cluster, 'my_schema', 'unit_test_table', 'abc', sa.MetaData()))
+
+        self.cache.store(cluster, 'my_schema', 'unit_test_table', 'abc', self.table)
+        loaded = self.cache.load(cluster, 'my_schema', 'unit_test_table', 'abc', sa.MetaData())
+        self.assertSameTable(self.table, loaded)
+
+        # Stale fingerprint, or different cluster
+        self.assertIsNone(self.cache.load(cluster, 'my_schema', 'unit_test_table', 'def', sa.MetaData()))
+        self.assertIsNone(self.cache.load('other:5439/db', 'my_schema', 'unit_test_table', 'abc', sa.MetaData()))
+
+    def test_split_table_name(self):
+        self.assertEqual(('my_schema', 'my_table'), split_table_name('my_schema.my_table'))
+        self.assertEqual((None, 'my_table'), split_table_name('my_table'))
+
+    def test_project_table(self):
+        projected = project_table(self.table, ['date_col', 'varchar_col'])
+        self.assertEqual(['date_col', 'varchar_col'], [col.name for col in projected.columns])
+        self.assertEqual((self.table.name, self.table.schema), (projected.name, projected.schema))
+        self.assertEqual(repr(self.table.c.varchar_col.type), repr(projected.c.varchar_col.type))
+
+        with self.assertRaises(ValueError):
+            project_table(self.table, ['varchar_col', 'no_such_col'])
+
+    def test_parse_column_list(self):
+        self.assertEqual(['a', 'b'], parse_column_list(' a, b,'))
+        self.assertEqual(['a', 'b'], parse_column_list(('a', 'b')))
+        self.assertIsNone(parse_column_list(''))
+
+
+if __name__ == "__main__":
+    main()
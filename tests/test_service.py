@@ -0,0 +1,199 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import threading
+from os import makedirs, path
+from unittest import main, TestCase
+
+import pyarrow.parquet as pq
+import sqlalchemy as sa
+
+from spectrify.service import DONE, FAILED, ConversionService, ManifestWatcher, make_server
+from spectrify.utils.compat import install_aliases
+from tests.helpers import CachingFileSystem, LocalS3Config
+
+install_aliases()
+from urllib.request import Request, urlopen  # noqa: E402
+from urllib.error import HTTPError  # noqa: E402
+
+
+class CountingSchemaReader(object):
+    def __init__(self, table):
+        self.table = table
+        self.calls = 0
+
+    def get_table_schema(self, table_name):
+        self.calls += 1
+        return self.table
+
+
+class LocalConversionService(ConversionService):
+    def get_s3_config(self, s3_path):
+        return LocalS3Config.from_base_path(s3_path)
+
+    def log(self, msg):
+        pass
+
+
+class TestConversionService(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.table = sa.Table(
+            'unit_test_table',
+            sa.MetaData(),
+            sa.Column('int_col', sa.INTEGER),
+            sa.Column('varchar_col', sa.VARCHAR(64)),
+        )
+        self.schema_reader = CountingSchemaReader(self.table)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_export(self, name, num_files=2, num_rows=10):
+        base_path = path.join(self.tmp_dir, name)
+        s3_config = LocalS3Config.from_base_path(base_path)
+        makedirs(s3_config.get_csv_dir())
+        makedirs(s3_config.get_spectrum_dir())
+        entries = []
+        for i in range(num_files):
+            file_path = path.join(s3_config.get_csv_dir(), '{:04d}_part_00.gz'.format(i))
+            with gzip.open(file_path, 'wb') as csv_file:
+                for row in range(num_rows):
+                    csv_file.write('{}|row {}\n'.format(row, row).encode('utf-8'))
+            entries.append({'url': 's3:/' + file_path, 'meta': {'record_count': num_rows, 'content_length': 100}})
+        with open(s3_config.get_manifest_path(), 'w') as manifest_file:
+            json.dump({'entries': entries}, manifest_file)
+        return base_path
+
+    def make_service(self):
+        return LocalConversionService(self.schema_reader, num_workers=2, warm_s3=False)
+
+    def test_jobs(self):
+        base_paths = [self.write_export('run1'), self.write_export('run2', num_files=3)]
+        with self.make_service() as service:
+            jobs = [service.submit('unit_test_table', base_path) for base_path in base_paths]
+            for job in jobs:
+                self.assertTrue(job.wait(30))
+
+        metrics = jobs[1].to_dict()
+        self.assertEqual(DONE, metrics['state'])
+        self.assertEqual(3, metrics['files_done'])
+        self.assertEqual(30, metrics['rows'])
+        self.assertEqual(300, metrics['input_bytes'])
+        self.assertTrue(metrics['output_bytes'] > 0)
+        # The schema is reflected once for both jobs
+        self.assertEqual(1, self.schema_reader.calls)
+        self.assertIs(service.get_table_schema('unit_test_table', ('int_col',)),
+                      service.get_table_schema('unit_test_table', 'int_col'))
+
+        spectrum_dir = path.join(base_paths[1], 'spectrum')
+        self.assertEqual(3, len(os.listdir(spectrum_dir)))
+        table = pq.read_table(path.join(spectrum_dir, '0000_part_00.parq'))
+        self.assertEqual(list(range(10)), table.column('int_col').to_pylist())
+
+    def test_failed_job(self):
+        with self.make_service() as service:
+            job = service.submit('unit_test_table', path.join(self.tmp_dir, 'missing'))
+            self.assertTrue(job.wait(30))
+        self.assertEqual(FAILED, job.state)
+        self.assertEqual({'num_workers': 2, 'jobs': {FAILED: 1}}, service.status())
+
+    def test_http_api(self):
+        base_path = self.write_export('run1')
+        with self.make_service() as service:
+            server = make_server(service, '127.0.0.1', 0)
+            url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+            thread = threading.Thread(target=server.serve_forever)
+            thread.start()
+            try:
+                body = json.dumps({'table': 'unit_test_table', 's3_path': base_path}).encode('utf-8')
+                request = Request(url + '/jobs', body, {'Content-Type': 'application/json'})
+                submitted = json.loads(urlopen(request).read().decode('utf-8'))
+                self.assertTrue(service.get_job(submitted['job_id']).wait(30))
+
+                job = json.loads(urlopen(url + '/jobs/' + submitted['job_id']).read().decode('utf-8'))
+                self.assertEqual(DONE, job['state'])
+                self.assertEqual(20, job['rows'])
+                jobs = json.loads(urlopen(url + '/jobs').read().decode('utf-8'))
+                self.assertEqual([submitted['job_id']], [listed['job_id'] for listed in jobs])
+
+                body = json.dumps({'table': 'unit_test_table', 's3_path': base_path, 'columns': ['int_col']})
+                request = Request(url + '/jobs', body.encode('utf-8'), {'Content-Type': 'application/json'})
+                submitted = json.loads(urlopen(request).read().decode('utf-8'))
+                self.assertTrue(service.get_job(submitted['job_id']).wait(30))
+                self.assertEqual(DONE, service.get_job(submitted['job_id']).state)
+                table = pq.read_table(path.join(base_path, 'spectrum', '0000_part_00.parq'))
+                self.assertEqual(['int_col'], table.column_names)
+
+                with self.assertRaises(HTTPError) as context:
+                    urlopen(Request(url + '/jobs', b'{}'))
+                self.assertEqual(400, context.exception.code)
+                body = json.dumps({'table': 'unit_test_table', 's3_path': base_path, 'columns': [1]})
+                with self.assertRaises(HTTPError) as context:
+                    urlopen(Request(url + '/jobs', body.encode('utf-8')))
+                self.assertEqual(400, context.exception.code)
+                with self.assertRaises(HTTPError) as context:
+                    urlopen(url + '/jobs/missing')
+                self.assertEqual(404, context.exception.code)
+            finally:
+                server.shutdown()
+                server.server_close()
+                thread.join()
+
+
+class TestManifestWatcher(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_manifest(self, name):
+        csv_dir = path.join(self.tmp_dir, name, 'csv')
+        makedirs(csv_dir)
+        with open(path.join(csv_dir, 'manifest'), 'w') as manifest_file:
+            json.dump({'entries': []}, manifest_file)
+
+    def test_poll(self):
+        submitted = []
+
+        class RecordingService(LocalConversionService):
+            def submit(self, table, s3_path, columns=None, timestamp_unit=None):
+                submitted.append((table, s3_path))
+
+        self.write_manifest('existing')
+        watcher = ManifestWatcher(RecordingService(None), 'unit_test_table', self.tmp_dir + '/')
+        watcher.poll()
+        self.assertEqual([], submitted)
+
+        self.write_manifest('new')
+        watcher.poll()
+        watcher.poll()
+        self.assertEqual([('unit_test_table', path.join(self.tmp_dir, 'new'))], submitted)
+
+    def test_poll_lists_again(self):
+        submitted = []
+        fs = CachingFileSystem(skip_instance_cache=True)
+
+        class CachingS3Config(LocalS3Config):
+            def get_fs(self):
+                return fs
+
+        class RecordingService(LocalConversionService):
+            def get_s3_config(self, s3_path):
+                return CachingS3Config.from_base_path(s3_path)
+
+            def submit(self, table, s3_path, columns=None, timestamp_unit=None):
+                submitted.append((table, s3_path))
+
+        watcher = ManifestWatcher(RecordingService(None), 'unit_test_table', self.tmp_dir)
+        self.write_manifest('new')
+        watcher.poll()
+        self.assertEqual([('unit_test_table', path.join(self.tmp_dir, 'new'))], submitted)
+
+
+if __name__ == "__main__":
+    main()
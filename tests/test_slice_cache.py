@@ -0,0 +1,145 @@
+import gzip
+import os
+import shutil
+import tempfile
+from io import BytesIO
+from unittest import main, TestCase
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from spectrify.utils.s3 import S3GZipCSVReader, SimpleS3Config
+from spectrify.utils.slice_cache import LocalSliceCache
+
+
+class FakeS3FileSystem(object):
+    def __init__(self, files):
+        # path -> (etag, contents)
+        self.files = files
+        self.opened = []
+
+    def info(self, path):
+        etag, contents = self.files[path]
+        return {'ETag': etag, 'size': len(contents)}
+
+    def open(self, path, mode='rb'):
+        self.opened.append(path)
+        return BytesIO(self.files[path][1])
+
+
+class TestLocalSliceCache(TestCase):
+    def setUp(self):
+        self.cache_dir = tempfile.mkdtemp()
+        self.fs = FakeS3FileSystem({
+            'bucket/a': ('"etag-a"', b'a' * 30),
+            'bucket/b': ('"etag-b"', b'b' * 30),
+            'bucket/empty': ('"etag-empty"', b''),
+        })
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+
+    def read(self, cache, path):
+        with cache.open(self.fs, path) as cached_file:
+            return cached_file.read()
+
+    def test_reads_are_cached(self):
+        cache = LocalSliceCache(self.cache_dir, max_bytes=100)
+        self.assertEqual(b'a' * 30, self.read(cache, 'bucket/a'))
+        self.assertEqual(b'a' * 30, self.read(cache, 'bucket/a'))
+        self.assertEqual(b'', self.read(cache, 'bucket/empty'))
+        self.assertEqual(['bucket/a', 'bucket/empty'], self.fs.opened)
+
+    def test_seek(self):
+        cache = LocalSliceCache(self.cache_dir, max_bytes=100)
+        with cache.open(self.fs, 'bucket/a') as cached_file:
+            cached_file.seek(25)
+            self.assertEqual(25, cached_file.tell())
+            self.assertEqual(b'a' * 5, cached_file.read(10))
+            self.assertEqual(b'', cached_file.read())
+
+    def test_changed_file_is_downloaded_again(self):
+        cache = LocalSliceCache(self.cache_dir, max_bytes=100)
+        self.read(cache, 'bucket/a')
+        self.fs.files['bucket/a'] = ('"etag-a2"', b'A' * 30)
+        self.assertEqual(b'A' * 30, self.read(cache, 'bucket/a'))
+        self.assertEqual(['bucket/a', 'bucket/a'], self.fs.opened)
+
+    def test_least_recently_used_are_evicted(self):
+        cache = LocalSliceCache(self.cache_dir, max_bytes=70)
+        self.fs.files['bucket/c'] = ('"etag-c"', b'c' * 30)
+        self.read(cache, 'bucket/a')
+        self.read(cache, 'bucket/b')
+        # Make a the most recently used entry
+        a_path = cache.get_path('bucket/a', '"etag-a"')
+        b_path = cache.get_path('bucket/b', '"etag-b"')
+        os.utime(b_path, (1000, 1000))
+        os.utime(a_path, (2000, 2000))
+
+        self.read(cache, 'bucket/c')
+        self.assertTrue(os.path.exists(a_path))
+        self.assertFalse(os.path.exists(b_path))
+        self.assertTrue(os.path.exists(cache.get_path('bucket/c', '"etag-c"')))
+
+    def test_files_without_etag_are_not_cached(self):
+        cache = LocalSliceCache(self.cache_dir, max_bytes=100)
+        self.fs.files['bucket/a'] = ('', b'a' * 30)
+        self.read(cache, 'bucket/a')
+        self.read(cache, 'bucket/a')
+        self.assertEqual(['bucket/a', 'bucket/a'], self.fs.opened)
+        self.assertEqual([], os.listdir(self.cache_dir))
+
+
+class CachingS3Config(SimpleS3Config):
+    def __init__(self, fs, slice_cache):
+        SimpleS3Config.__init__(self, 's3://bucket/csv/', 's3://bucket/spectrum/')
+        self.fs = fs
+        self.slice_cache = slice_cache
+
+    def get_fs(self):
+        return self.fs
+
+    def get_slice_cache(self):
+        return self.slice_cache
+
+
+class TestCachedReads(TestCase):
+    def test_gzip_csv_reader(self):
+        gzipped = BytesIO()
+        with gzip.GzipFile(fileobj=gzipped, mode='wb') as gzip_file:
+            gzip_file.write(b'1|one\n2|two\n')
+        fs = FakeS3FileSystem({'bucket/csv/0000_part_00.gz': ('"etag"', gzipped.getvalue())})
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            config = CachingS3Config(fs, LocalSliceCache(cache_dir, max_bytes=1000))
+            for _ in range(2):
+                with S3GZipCSVReader(config, 's3://bucket/csv/0000_part_00.gz', True, delimiter='|') as reader:
+                    self.assertEqual([['1', 'one'], ['2', 'two']], list(reader))
+            self.assertEqual(['bucket/csv/0000_part_00.gz'], fs.opened)
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_parquet_file(self):
+        parquet = BytesIO()
+        pq.write_table(pa.table({'id': [1, 2, 3]}), parquet)
+        fs = FakeS3FileSystem({'bucket/spectrum/0000_part_00.parq': ('"etag"', parquet.getvalue())})
+
+        cache_dir = tempfile.mkdtemp()
+        try:
+            cache = LocalSliceCache(cache_dir, max_bytes=10000)
+            with cache.open(fs, 'bucket/spectrum/0000_part_00.parq') as cached_file:
+                self.assertEqual([1, 2, 3], pq.read_table(cached_file).column('id').to_pylist())
+                self.assertEqual(3, pq.ParquetFile(cached_file).metadata.num_rows)
+
+            # Other files aren't read through the cache
+            config = CachingS3Config(fs, cache)
+            with config.fs_open('bucket/spectrum/0000_part_00.parq') as parquet_file:
+                self.assertEqual(3, pq.read_table(parquet_file).num_rows)
+            self.assertEqual(['bucket/spectrum/0000_part_00.parq'] * 2, fs.opened)
+        finally:
+            shutil.rmtree(cache_dir)
+
+
+if __name__ == "__main__":
+    main()
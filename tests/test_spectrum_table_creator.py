@@ -0,0 +1,51 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+from unittest import main, TestCase
+
+import sqlalchemy
+import textwrap
+
+from spectrify.create import SpectrumPartitionAdder, SpectrumTableCreator
+from spectrify.utils.s3 import SimpleS3Config
+
+
+class TestSpectrumTableCreator(TestCase):
+    def setUp(self):
+        self.s3_config = SimpleS3Config.from_base_path("s3://some_bucket/prefix")
+        self.sa_table = sqlalchemy.Table(
+            'unit_test_table',
+            sqlalchemy.MetaData(),
+            sqlalchemy.Column('int_col_1', sqlalchemy.INTEGER),
+        )
+
+    def test_statistics_query(self):
+        table_creator = SpectrumTableCreator(None, "schema", "other.table", self.sa_table, self.s3_config)
+        self.assertIsNone(table_creator.statistics_query)
+
+        table_creator = SpectrumTableCreator(
+            None, "schema", "other.table", self.sa_table, self.s3_config, num_rows=1234)
+        self.assertIn('create external table schema.other_table', table_creator.query)
+        self.assertEqual(
+            "alter table schema.other_table set table properties ('numRows'='1234')",
+            table_creator.statistics_query.strip(),
+        )
+
+    def test_add_partition_queries(self):
+        partition_adder = SpectrumPartitionAdder(
+            None, "schema", "table", self.s3_config, "dt=2020-01-01/region=o'hare/", num_rows=10)
+        add_query, statistics_query = partition_adder.format_queries()
+        self.assertEqual(
+            textwrap.dedent("""
+                alter table schema.table
+                add if not exists partition (dt='2020-01-01', region='o''hare')
+                location 's3://some_bucket/prefix/spectrum/dt=2020-01-01/region=o''hare/'
+            """),
+            textwrap.dedent(add_query),
+        )
+        self.assertEqual(
+            "alter table schema.table set table properties ('numRows'='10')",
+            statistics_query.strip(),
+        )
+
+
+if __name__ == "__main__":
+    main()
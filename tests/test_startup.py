@@ -0,0 +1,27 @@
+"""Tests that the CLI starts without importing heavy dependencies"""
+import json
+import subprocess
+import sys
+from unittest import main, TestCase
+
+HEAVY_MODULES = ['pyarrow', 'pandas', 'boto3', 's3fs', 'sqlalchemy', 'future']
+
+IMPORTED_MODULES_SCRIPT = """
+import json, sys
+from click.testing import CliRunner
+from spectrify.main import cli
+CliRunner().invoke(cli, ['--help'])
+print(json.dumps(sorted(sys.modules)))
+"""
+
+
+class TestStartup(TestCase):
+    def test_help_skips_heavy_imports(self):
+        output = subprocess.check_output([sys.executable, '-c', IMPORTED_MODULES_SCRIPT])
+        modules = json.loads(output.decode('utf-8').splitlines()[-1])
+        for module in HEAVY_MODULES:
+            self.assertNotIn(module, modules)
+
+
+if __name__ == "__main__":
+    main()
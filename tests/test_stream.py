@@ -0,0 +1,96 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import shutil
+import tempfile
+from datetime import date, datetime
+from decimal import Decimal
+from os import listdir, mkdir, path
+from unittest import main, TestCase
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import sqlalchemy as sa
+
+from spectrify.stream import RedshiftStreamer, should_stream
+from tests.helpers import LocalS3Config
+
+
+class TestRedshiftStreamer(TestCase):
+    # SQLite stands in for Redshift; the streamer only relies on SqlAlchemy
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.engine = sa.create_engine('sqlite:///' + path.join(self.tmp_dir, 'source.db'))
+        self.table = sa.Table(
+            'unit_test_table',
+            sa.MetaData(),
+            sa.Column('int_col', sa.INTEGER),
+            sa.Column('varchar_col', sa.VARCHAR(64)),
+            sa.Column('numeric_col', sa.NUMERIC(10, 2)),
+            sa.Column('date_col', sa.DATE),
+            sa.Column('timestamp_col', sa.TIMESTAMP),
+        )
+        self.table.metadata.create_all(self.engine)
+        self.rows = [
+            {
+                'int_col': i,
+                'varchar_col': 'row {}'.format(i) if i % 3 else None,
+                'numeric_col': Decimal('{}.25'.format(i)),
+                'date_col': date(2020, 1, 1 + i),
+                'timestamp_col': datetime(2020, 1, 1, i, 30),
+            }
+            for i in range(10)
+        ]
+        with self.engine.begin() as conn:
+            conn.execute(self.table.insert(), self.rows)
+
+        self.spectrum_dir = path.join(self.tmp_dir, 'spectrum')
+        mkdir(self.spectrum_dir)
+        self.s3_config = LocalS3Config(path.join(self.tmp_dir, 'csv'), self.spectrum_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def read_output(self):
+        tables = [pq.read_table(path.join(self.spectrum_dir, name)) for name in sorted(listdir(self.spectrum_dir))]
+        return [row for table in tables for row in table.to_pylist()]
+
+    def test_stream(self):
+        streamer = RedshiftStreamer(self.engine, self.table, self.s3_config, batch_size=3, rows_per_file=6)
+        self.assertEqual(10, streamer.stream())
+
+        self.assertEqual(['stream_0000.parq', 'stream_0001.parq'], sorted(listdir(self.spectrum_dir)))
+        self.assertEqual(self.rows, self.read_output())
+
+    def test_stream_where(self):
+        streamer = RedshiftStreamer(self.engine, self.table, self.s3_config, where='int_col >= 8')
+        self.assertEqual(2, streamer.stream())
+        self.assertEqual(self.rows[8:], self.read_output())
+
+    def test_stream_empty(self):
+        streamer = RedshiftStreamer(self.engine, self.table, self.s3_config, where='int_col < 0')
+        self.assertEqual(0, streamer.stream())
+        self.assertEqual([], self.read_output())
+
+    def test_stream_replaces_earlier_files(self):
+        # Files of an earlier UNLOAD, and of an earlier stream with more files
+        for name in ['0000_part_00.parq', 'stream_0000.parq', 'stream_0001.parq']:
+            pq.write_table(pa.table({'int_col': [100]}), path.join(self.spectrum_dir, name))
+        with open(path.join(self.spectrum_dir, '_SUCCESS'), 'w'):
+            pass
+
+        streamer = RedshiftStreamer(self.engine, self.table, self.s3_config)
+        self.assertEqual(10, streamer.stream())
+        self.assertEqual(['_SUCCESS', 'stream_0000.parq'], sorted(listdir(self.spectrum_dir)))
+
+    def test_should_stream(self):
+        # 10 rows of 64 + 4 + 8 + 4 + 8 bytes
+        self.assertTrue(should_stream(self.engine, 'unit_test_table', self.table, max_mb=0.001))
+        self.assertFalse(should_stream(self.engine, 'unit_test_table', self.table, max_mb=0.0005))
+        self.assertTrue(should_stream(
+            self.engine, 'unit_test_table', self.table, where='int_col < 5', max_mb=0.0005))
+
+    def test_should_stream_without_count(self):
+        self.assertFalse(should_stream(self.engine, 'missing_table', self.table))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import gzip
+import json
+import shutil
+import tempfile
+from os import listdir, makedirs, path
+from unittest import main, TestCase
+
+import pyarrow.parquet as pq
+import sqlalchemy as sa
+
+from spectrify.convert import SimpleManifestConverter
+from spectrify.export import ShardedRedshiftDataExporter
+from spectrify.transform import TableTransformer
+from spectrify.utils.parquet import count_rows
+from tests.helpers import LocalS3Config
+
+
+class FakeSchemaReader(object):
+    def __init__(self, table):
+        self.table = table
+
+    def get_table_schema(self, table_name):
+        return self.table
+
+
+class LocalShardedExporter(ShardedRedshiftDataExporter):
+    """'Unloads' the rows of a list, split into shards by int_col"""
+
+    def __init__(self, rows, *args, **kwargs):
+        ShardedRedshiftDataExporter.__init__(self, *args, **kwargs)
+        self.rows = rows
+
+    def get_shard_predicates(self, table_name):
+        return list(range(self.num_shards))
+
+    def export_shard(self, table_name, credentials, shard_config, predicate):
+        file_path = shard_config.get_csv_dir() + '0000_part_00.gz'
+        with gzip.open(file_path, 'wb') as csv_file:
+            for int_col, varchar_col in self.rows:
+                if int_col % self.num_shards == predicate:
+                    csv_file.write('{}|{}\n'.format(int_col, varchar_col).encode('utf-8'))
+        with open(shard_config.get_manifest_path(), 'w') as manifest_file:
+            json.dump({'entries': [{'url': 's3:/' + file_path}]}, manifest_file)
+        return shard_config
+
+
+class LocalTransformer(TableTransformer):
+    """Streams from SQLite, and exports and converts in this process"""
+
+    def __init__(self, table, *args, **kwargs):
+        self.table = table
+        self.num_rows = None
+        TableTransformer.__init__(self, *args, **kwargs)
+
+    def get_schema_reader(self):
+        return FakeSchemaReader(self.table)
+
+    def get_sharded_exporter(self):
+        with self.engine.connect() as conn:
+            rows = [tuple(row) for row in conn.execute(self.table.select())]
+        return LocalShardedExporter(
+            rows, self.engine, self.s3_config, self.shard_column, num_shards=self.num_shards, credentials='creds')
+
+    def get_converter(self, s3_config):
+        return SimpleManifestConverter(self.sa_table, s3_config)
+
+    def create_spectrum_table(self):
+        self.num_rows, _ = count_rows(self.s3_config, self.s3_config.get_spectrum_dir())
+
+
+class TestTableTransformer(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.engine = sa.create_engine('sqlite:///' + path.join(self.tmp_dir, 'source.db'))
+        self.table = sa.Table(
+            'unit_test_table',
+            sa.MetaData(),
+            sa.Column('int_col', sa.INTEGER),
+            sa.Column('varchar_col', sa.VARCHAR(64)),
+        )
+        self.table.metadata.create_all(self.engine)
+        with self.engine.begin() as conn:
+            conn.execute(self.table.insert(), [{'int_col': i, 'varchar_col': 'row {}'.format(i)} for i in range(10)])
+
+        self.s3_config = LocalS3Config.from_base_path(self.tmp_dir)
+        makedirs(self.s3_config.get_csv_dir())
+        self.spectrum_dir = self.s3_config.get_spectrum_dir()
+        makedirs(self.spectrum_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def transform(self, **kwargs):
+        transformer = LocalTransformer(
+            self.table, self.engine, 'unit_test_table', self.s3_config, 'spectrum', 'unit_test_table', **kwargs)
+        transformer.transform()
+        return transformer
+
+    def read_int_col(self):
+        return sorted(
+            value for name in listdir(self.spectrum_dir)
+            for value in pq.read_table(path.join(self.spectrum_dir, name)).column('int_col').to_pylist())
+
+    def test_stream_then_shards(self):
+        self.assertEqual(10, self.transform(stream=True).num_rows)
+        self.assertEqual(['stream_0000.parq'], listdir(self.spectrum_dir))
+
+        # Files of the stream, and of a run with more shards, don't remain
+        self.assertEqual(10, self.transform(shard_column='int_col', num_shards=3).num_rows)
+        self.assertEqual(10, self.transform(shard_column='int_col', num_shards=2).num_rows)
+        self.assertEqual(
+            ['shard_000_0000_part_00.parq', 'shard_001_0000_part_00.parq'], sorted(listdir(self.spectrum_dir)))
+        self.assertEqual(list(range(10)), self.read_int_col())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,15 @@
 # -*- coding: utf8 -*-
 from unittest import main, TestCase
+from io import BytesIO, TextIOWrapper
+import csv
 import gzip
 import tempfile
 
-import unicodecsv as csv
-
-from spectrify.utils.s3 import S3GZipCSVReader
+from spectrify.utils import s3
+from spectrify.utils.s3 import (
+    ByteCSVReader, PrefetchingS3Config, ReadAheadFile, S3GZipCSVReader, S3RangeCSVReader, find_record_start,
+    get_csv_reader, plan_byte_ranges
+)
 
 
 class FakeS3Config(object):
@@ -27,14 +31,162 @@ class TestUtilsS3CSVReader(TestCase):
             [u"Marc André Lemburg", u'31', u'M'],
             [u"François Pinard", u'31', u'M']
         ]
-        gzip_csv = tempfile.TemporaryFile()
-        with gzip.GzipFile(fileobj=gzip_csv, mode="wb") as _gzip:
-            csv_writer = csv.writer(_gzip)
-            csv_writer.writerows(encoded_csv_lines)
-
-        fake_s3_config = FakeS3Config(gzip_csv)
-        with S3GZipCSVReader(fake_s3_config, "", unicode_csv=True) as s3_gzip_csv_reader:
-            self.assertEqual(encoded_csv_lines, list(s3_gzip_csv_reader))
+        for read_ahead in (False, True):
+            gzip_csv = tempfile.TemporaryFile()
+            with gzip.GzipFile(fileobj=gzip_csv, mode="wb") as _gzip:
+                text_file = TextIOWrapper(_gzip, encoding='utf-8', newline='')
+                csv_writer = csv.writer(text_file)
+                csv_writer.writerows(encoded_csv_lines)
+                text_file.detach()
+
+            fake_s3_config = FakeS3Config(gzip_csv)
+            with S3GZipCSVReader(fake_s3_config, "", read_ahead=read_ahead) as s3_gzip_csv_reader:
+                self.assertEqual(encoded_csv_lines, list(s3_gzip_csv_reader))
+
+
+class FailingFile(BytesIO):
+    def read(self, size=-1):
+        if self.tell() >= 10:
+            raise IOError('Connection reset')
+        return BytesIO.read(self, size)
+
+
+class TestReadAheadFile(TestCase):
+    def test_read(self):
+        data = bytes(bytearray(range(256))) * 100
+        read_ahead = ReadAheadFile(BytesIO(data), block_size=1000, max_blocks=2)
+        self.assertEqual(data[:10], read_ahead.read(10))
+        self.assertEqual(data[10:], read_ahead.read())
+        self.assertEqual(b'', read_ahead.read(10))
+        read_ahead.close()
+
+    def test_error(self):
+        read_ahead = ReadAheadFile(FailingFile(b'x' * 100), block_size=10)
+        self.assertEqual(b'x' * 10, read_ahead.read(10))
+        with self.assertRaises(IOError):
+            read_ahead.read(10)
+        read_ahead.close()
+
+    def test_close_early(self):
+        # The background thread is blocked on a full queue
+        read_ahead = ReadAheadFile(BytesIO(b'x' * 1000), block_size=10, max_blocks=1)
+        read_ahead.read(1)
+        read_ahead.close()
+        self.assertFalse(read_ahead.thread.is_alive())
+
+
+class TestByteCSVReader(TestCase):
+    data = 'a|ü|\\|\\\n|x\\\\|y\n\nb||c'.encode('utf-8')
+    expected = [
+        [b'a', '\u00fc'.encode('utf-8'), b'|\n', b'x\\', b'y'],
+        [b''],
+        [b'b', b'', b'c'],
+    ]
+
+    def test_every_block_size(self):
+        for block_size in range(1, len(self.data) + 1):
+            blocks = [self.data[i:i + block_size] for i in range(0, len(self.data), block_size)]
+            self.assertEqual(self.expected, list(ByteCSVReader(blocks)), 'block_size=%d' % block_size)
+
+    def test_dialects(self):
+        blocks = [b'1|"a"\n']
+        self.assertIsInstance(
+            get_csv_reader(blocks, delimiter='|', escapechar='\\', quoting=csv.QUOTE_NONE), ByteCSVReader)
+        # Other dialects are parsed by the csv module
+        self.assertEqual([['1', 'a']], list(get_csv_reader(blocks, delimiter='|')))
+
+
+class TestUtilsS3RangeCSVReader(TestCase):
+    # Rows as written by Redshift UNLOAD ... ESCAPE: newlines, delimiters and
+    # backslashes inside values are escaped with a backslash.
+    records = [
+        b'1|plain\n',
+        b'2|escaped \\\n newline\n',
+        b'3|trailing backslash \\\\\n',
+        b'4|escaped \\| delimiter\n',
+        b'5|\\\\\\\n\\\\\n',
+        b'6|last\n',
+    ]
+    data = b''.join(records)
+    expected = [
+        [b'1', b'plain'],
+        [b'2', b'escaped \n newline'],
+        [b'3', b'trailing backslash \\'],
+        [b'4', b'escaped | delimiter'],
+        [b'5', b'\\\n\\'],
+        [b'6', b'last'],
+    ]
+
+    def read_range(self, start, end):
+        fake_s3_config = FakeS3Config(BytesIO(self.data))
+        with S3RangeCSVReader(fake_s3_config, "", start, end,
+                              delimiter='|', escapechar='\\', quoting=csv.QUOTE_NONE) as reader:
+            return list(reader)
+
+    def test_whole_file(self):
+        self.assertEqual(self.expected, self.read_range(0, len(self.data)))
+
+    def test_find_record_start(self):
+        record_starts = [sum(len(r) for r in self.records[:i]) for i in range(len(self.records) + 1)]
+        for offset in range(len(self.data) + 1):
+            expected_start = min(pos for pos in record_starts if pos >= offset)
+            self.assertEqual(expected_start, find_record_start(BytesIO(self.data), offset))
+
+    def test_every_split_size(self):
+        for split_size in range(1, len(self.data) + 1):
+            rows = []
+            for start, end in plan_byte_ranges(len(self.data), split_size):
+                rows.extend(self.read_range(start, end))
+            self.assertEqual(self.expected, rows, 'split_size=%d' % split_size)
+
+    def test_small_scan_blocks(self):
+        # Escape sequences will straddle the scan blocks
+        blocksize = s3.SPECTRIFY_SCAN_BLOCKSIZE
+        s3.SPECTRIFY_SCAN_BLOCKSIZE = 3
+        try:
+            self.test_find_record_start()
+            self.test_every_split_size()
+        finally:
+            s3.SPECTRIFY_SCAN_BLOCKSIZE = blocksize
+
+
+class FakeMultiFileS3Config(object):
+    def __init__(self, files):
+        self.files = files
+        self.opened = []
+
+    def fs_open(self, path, *args, **kwargs):
+        self.opened.append(path)
+        return BytesIO(self.files[path])
+
+
+class TestPrefetchingS3Config(TestCase):
+    def setUp(self):
+        self.files = {
+            'bucket/a': b'a' * 25,
+            'bucket/b': b'b' * 5,
+            'bucket/c': b'c' * 10,
+        }
+        self.fake_s3_config = FakeMultiFileS3Config(self.files)
+
+    def test_prefetched_reads(self):
+        with PrefetchingS3Config(self.fake_s3_config, max_bytes=100, block_size=10) as config:
+            config.prefetch(['s3://bucket/a', 's3://bucket/b'])
+            for path in ['bucket/a', 'bucket/b']:
+                fileobj = config.fs_open(path)
+                self.assertEqual(self.files[path][:3], fileobj.read(3))
+                self.assertEqual(self.files[path][3:], fileobj.read())
+                fileobj.close()
+            self.assertEqual(0, config.reserved_bytes)
+
+            # Not prefetched; read straight from the wrapped config
+            self.assertEqual(self.files['bucket/c'], config.fs_open('bucket/c').read())
+        self.assertEqual(['bucket/a', 'bucket/b', 'bucket/c'], sorted(self.fake_s3_config.opened))
+
+    def test_memory_budget(self):
+        with PrefetchingS3Config(self.fake_s3_config, max_bytes=15, block_size=10) as config:
+            config.prefetch(['s3://bucket/a', 's3://bucket/b'])
+            self.assertEqual(['bucket/a'], list(config.pending))
 
 
 if __name__ == "__main__":
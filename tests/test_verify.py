@@ -0,0 +1,109 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import json
+import shutil
+import tempfile
+from os import mkdir, path
+from unittest import main, TestCase
+
+import sqlalchemy as sa
+
+from spectrify.compact import ParquetCompactor
+from spectrify.utils.parquet import Writer
+from spectrify.verify import UNMATCHED_ENTRIES, ManifestVerifier
+from tests.helpers import LocalS3Config
+
+
+class TestManifestVerifier(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.s3_config = LocalS3Config.from_base_path(self.tmp_dir)
+        mkdir(self.s3_config.get_csv_dir())
+        mkdir(self.s3_config.get_spectrum_dir())
+        self.table = sa.Table(
+            'unit_test_table',
+            sa.MetaData(),
+            sa.Column('int_col', sa.INTEGER),
+            sa.Column('varchar_col', sa.VARCHAR(64)),
+        )
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_manifest(self, record_counts):
+        entries = [
+            {'url': 's3://bucket/csv/{}'.format(name), 'meta': {'record_count': count}}
+            for name, count in record_counts
+        ]
+        with open(self.s3_config.get_manifest_path(), 'w') as manifest_file:
+            json.dump({'entries': entries}, manifest_file)
+
+    def write_parquet(self, name, num_rows, sa_table=None):
+        with open(path.join(self.s3_config.get_spectrum_dir(), name), 'wb') as parquet_file:
+            with Writer(parquet_file, sa_table if sa_table is not None else self.table) as writer:
+                writer.write_row_group([list(range(num_rows)), ['a'] * num_rows][:len(writer.col_names)])
+
+    def verify(self):
+        verifier = ManifestVerifier(self.table, self.s3_config)
+        verifier.log = lambda msg: None
+        return {check.url.rsplit('/', 1)[-1]: check for check in verifier.verify()}
+
+    def test_ok(self):
+        self.write_manifest([('0000_part_00.gz', 3), ('0001_part_00', 5)])
+        self.write_parquet('0000_part_00.parq', 3)
+        # A file split into byte ranges (see SplittingManifestConverter)
+        self.write_parquet('0001_part_00.0000.parq', 2)
+        self.write_parquet('0001_part_00.0001.parq', 3)
+
+        checks = self.verify()
+        self.assertTrue(all(check.ok for check in checks.values()))
+        self.assertEqual(2, len(checks['0001_part_00'].parquet_paths))
+        self.assertEqual(5, checks['0001_part_00'].actual_rows)
+
+    def test_problems(self):
+        self.write_manifest([
+            ('0000_part_00.gz', 3), ('0001_part_00.gz', 3), ('0002_part_00.gz', 3), ('0003_part_00.gz', 3),
+        ])
+        self.write_parquet('0001_part_00.parq', 2)
+        self.write_parquet('0002_part_00.parq', 3)
+        with open(path.join(self.s3_config.get_spectrum_dir(), '0002_part_00.parq'), 'r+b') as parquet_file:
+            parquet_file.truncate(100)
+        self.write_parquet('0003_part_00.parq', 3, sa_table=sa.Table(
+            'other_table', sa.MetaData(), sa.Column('int_col', sa.BIGINT)))
+
+        checks = self.verify()
+        self.assertEqual(['missing'], checks['0000_part_00.gz'].problems)
+        self.assertEqual(['has 2 rows, expected 3'], checks['0001_part_00.gz'].problems)
+        self.assertIn('unreadable', checks['0002_part_00.gz'].problems[0])
+        self.assertIn('columns', checks['0003_part_00.gz'].problems[0])
+
+    def test_compacted(self):
+        self.write_manifest([('0000_part_00.gz', 3), ('0001_part_00', 5), ('0002_part_00.gz', 4)])
+        self.write_parquet('0000_part_00.parq', 3)
+        self.write_parquet('0001_part_00.0000.parq', 2)
+        self.write_parquet('0001_part_00.0001.parq', 3)
+        self.write_parquet('0002_part_00.parq', 4)
+        compactor = ParquetCompactor(self.s3_config, target_size=2**20)
+        compactor.log = lambda msg: None
+        compactor.compact()
+        # New rows of an incremental merge don't come from the manifest
+        self.write_parquet('merged_0123456789ab.parq', 2)
+
+        checks = self.verify()
+        self.assertEqual(['0000_part_00.gz', '0001_part_00', '0002_part_00.gz'], sorted(checks))
+        self.assertTrue(all(check.ok for check in checks.values()))
+        self.assertEqual(5, checks['0001_part_00'].actual_rows)
+
+    def test_unmatched_files(self):
+        # A streamed table, with the manifest of an earlier UNLOAD
+        self.write_manifest([('0000_part_00.gz', 3), ('0001_part_00.gz', 5)])
+        self.write_parquet('stream_0000.parq', 8)
+        checks = self.verify()
+        self.assertEqual([UNMATCHED_ENTRIES], list(checks))
+        self.assertTrue(checks[UNMATCHED_ENTRIES].ok)
+
+        self.write_parquet('stream_0001.parq', 1)
+        self.assertEqual(['has 9 rows in total, expected 8'], self.verify()[UNMATCHED_ENTRIES].problems)
+
+
+if __name__ == "__main__":
+    main()
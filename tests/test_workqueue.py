@@ -0,0 +1,125 @@
+from __future__ import absolute_import, division, print_function, unicode_literals
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from os import path
+from unittest import main, TestCase
+
+import sqlalchemy as sa
+
+from spectrify.workqueue import DONE, FAILED, LEASED, PENDING, QueueWorker, SqlWorkQueue
+
+
+class FakeConverter(object):
+    def __init__(self, fail_urls=()):
+        self.converted = []
+        self.fail_urls = fail_urls
+
+    def convert_csv(self, url):
+        if url in self.fail_urls:
+            raise ValueError('Bad file')
+        self.converted.append(url)
+
+
+class TestSqlWorkQueue(TestCase):
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.queue_url = 'sqlite:///' + path.join(self.tmp_dir, 'queue.db')
+        self.queue = SqlWorkQueue.from_url(self.queue_url, max_attempts=2)
+        self.urls = ['s3://bucket/csv/0000_part_00.gz', 's3://bucket/csv/0001_part_00.gz']
+        self.queue.enqueue('job', self.urls)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_enqueue_is_idempotent(self):
+        self.assertEqual(0, self.queue.enqueue('job', self.urls))
+        self.assertEqual({PENDING: 2}, self.queue.status('job'))
+
+    def test_claim_and_complete(self):
+        task_a = self.queue.claim('job', 'worker-a')
+        task_b = self.queue.claim('job', 'worker-b')
+        self.assertEqual(set(self.urls), {task_a.url, task_b.url})
+        self.assertIsNone(self.queue.claim('job', 'worker-c'))
+        self.assertEqual({LEASED: 2}, self.queue.status('job'))
+        self.assertFalse(self.queue.is_finished('job'))
+
+        self.assertTrue(self.queue.heartbeat(task_a))
+        self.assertTrue(self.queue.complete(task_a))
+        self.assertTrue(self.queue.complete(task_b))
+        self.assertEqual({DONE: 2}, self.queue.status('job'))
+        self.assertTrue(self.queue.is_finished('job'))
+
+    def test_expired_lease_is_reassigned(self):
+        task_a = self.queue.claim('job', 'worker-a', lease_seconds=-1)
+        task_b = self.queue.claim('job', 'worker-b')
+        self.assertEqual(task_a.url, task_b.url)
+        self.assertEqual(2, task_b.attempts)
+
+        # The original owner can no longer renew or complete the task
+        self.assertFalse(self.queue.heartbeat(task_a))
+        self.assertFalse(self.queue.complete(task_a))
+        self.assertTrue(self.queue.complete(task_b))
+
+    def test_lease_uses_database_clock(self):
+        task_a = self.queue.claim('job', 'worker-a')
+        # A worker whose clock is far ahead doesn't see the lease as expired
+        real_time = time.time
+        time.time = lambda: real_time() + 3600
+        try:
+            task_b = self.queue.claim('job', 'worker-b')
+            self.assertNotEqual(task_a.url, task_b.url)
+            self.assertIsNone(self.queue.claim('job', 'worker-c'))
+        finally:
+            time.time = real_time
+
+    def test_retries_while_locked(self):
+        queue = SqlWorkQueue(sa.create_engine(self.queue_url, connect_args={'timeout': 0}))
+        lock = sqlite3.connect(path.join(self.tmp_dir, 'queue.db'), isolation_level=None, check_same_thread=False)
+        lock.execute('begin exclusive')
+        unlock = threading.Timer(0.3, lock.rollback)
+        unlock.start()
+        try:
+            self.assertIsNotNone(queue.claim('job', 'worker-a'))
+        finally:
+            unlock.join()
+            lock.close()
+
+        queue.lock_retries = 0
+        lock = sqlite3.connect(path.join(self.tmp_dir, 'queue.db'), isolation_level=None)
+        lock.execute('begin exclusive')
+        try:
+            with self.assertRaises(sa.exc.OperationalError):
+                queue.status('job')
+        finally:
+            lock.rollback()
+            lock.close()
+
+    def test_too_many_attempts(self):
+        for _ in range(2):
+            task = self.queue.claim('job', 'worker-a', lease_seconds=-1)
+            self.assertEqual(self.urls[0], task.url)
+        self.queue.claim('job', 'worker-a')
+        self.assertEqual({FAILED: 1, LEASED: 1}, self.queue.status('job'))
+
+    def test_fail_and_retry(self):
+        task = self.queue.claim('job', 'worker-a')
+        self.assertTrue(self.queue.fail(task, 'oops'))
+        self.assertEqual({PENDING: 2}, self.queue.status('job'))
+        task = self.queue.claim('job', 'worker-a')
+        self.assertTrue(self.queue.fail(task, 'oops again'))
+        self.assertEqual({PENDING: 1, FAILED: 1}, self.queue.status('job'))
+
+    def test_worker(self):
+        converter = FakeConverter(fail_urls=[self.urls[1]])
+        worker = QueueWorker(self.queue, converter, worker_id='worker-a', poll_seconds=0)
+        worker.log = lambda msg: None
+        self.assertEqual(1, worker.run('job'))
+        self.assertEqual([self.urls[0]], converter.converted)
+        self.assertEqual({DONE: 1, FAILED: 1}, self.queue.status('job'))
+
+
+if __name__ == "__main__":
+    main()